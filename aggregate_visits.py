@@ -0,0 +1,136 @@
+import math
+import numpy as np
+from visit_table import MISSING_TIME
+
+EARTH_RADIUS = 6378137.0
+MAX_LATITUDE = 85.05112878
+SQRT3 = math.sqrt(3)
+
+
+def to_web_mercator(longitudes, latitudes):
+    """
+    Returns the Web Mercator (EPSG:3857) x/y in meters of arrays of longitudes and latitudes
+    """
+    latitudes = np.clip(latitudes, -MAX_LATITUDE, MAX_LATITUDE)
+    x = np.radians(longitudes) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(latitudes) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def from_web_mercator(x, y):
+    """
+    Returns the longitudes and latitudes of arrays of Web Mercator x/y in meters
+    """
+    longitudes = np.degrees(x / EARTH_RADIUS)
+    latitudes = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return longitudes, latitudes
+
+
+def grid_cells(x, y, cell_size):
+    """
+    Returns the (column, row) of the square cell of side `cell_size` containing each point
+    """
+    return np.floor(x / cell_size).astype(np.int64), np.floor(y / cell_size).astype(np.int64)
+
+
+def hex_cells(x, y, cell_size):
+    """
+    Returns the axial (q, r) coordinates of the pointy-top hexagon of circumradius `cell_size` containing each point
+    """
+    q = (SQRT3 / 3 * x - y / 3) / cell_size
+    r = (2 / 3 * y) / cell_size
+    # round the cube coordinates (q, -q-r, r) and fix the component with the largest rounding error
+    s = -q - r
+    rq, rr, rs = np.rint(q), np.rint(r), np.rint(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def cell_polygon(mode, column, row, cell_size):
+    """
+    Returns the closed ring of [longitude, latitude] corners of a cell
+    """
+    if mode == "grid":
+        xs = np.array([column, column + 1, column + 1, column, column]) * cell_size
+        ys = np.array([row, row, row + 1, row + 1, row]) * cell_size
+    else:
+        center_x = cell_size * SQRT3 * (column + row / 2)
+        center_y = cell_size * 1.5 * row
+        angles = np.radians(np.arange(30, 391, 60))
+        xs = center_x + cell_size * np.cos(angles)
+        ys = center_y + cell_size * np.sin(angles)
+    longitudes, latitudes = from_web_mercator(xs, ys)
+    return [[round(longitude, 6), round(latitude, 6)] for longitude, latitude in zip(longitudes.tolist(), latitudes.tolist())]
+
+
+def dwell_seconds(table):
+    """
+    Returns the duration in seconds of every visit of a VisitTable (0 when the start or end time is missing)
+    """
+    start, end = table["start"], table["end"]
+    valid = (start != MISSING_TIME) & (end != MISSING_TIME) & (end >= start)
+    return np.where(valid, end - start, 0)
+
+
+def aggregate(table, mode="grid", cell_size=250, dwell_weights=False):
+    """
+    Bin the visits of a VisitTable into square grid cells or hexagons
+
+    Parameters:
+        - `table` (VisitTable): the place visits
+        - `mode` (str): "grid" or "hex"
+        - `cell_size` (float): side of a grid cell, or circumradius of a hexagon, in Web Mercator meters
+        - `dwell_weights` (bool): also sum the time spent in each cell from the placeVisit durations
+
+    Returns: a dict of arrays, one entry per occupied cell: `column`, `row`, `count` and optionally `dwell_seconds`
+    """
+    if mode not in ("grid", "hex"):
+        raise ValueError(f"Unknown aggregation mode: {mode}")
+    x, y = to_web_mercator(table.longitudes(), table.latitudes())
+    columns, rows = (grid_cells if mode == "grid" else hex_cells)(x, y, cell_size)
+
+    cells, inverse = np.unique(np.stack([columns, rows], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    result = {
+        "column": cells[:, 0] if len(cells) else np.empty(0, np.int64),
+        "row": cells[:, 1] if len(cells) else np.empty(0, np.int64),
+        "count": np.bincount(inverse, minlength=len(cells)),
+    }
+    if dwell_weights:
+        result["dwell_seconds"] = np.bincount(inverse, weights=dwell_seconds(table), minlength=len(cells))
+    return result
+
+
+def iter_cell_features(cells, mode="grid", cell_size=250):
+    """
+    Yields one GeoJSON Polygon feature per cell returned by `aggregate`, with the visit count (and dwell time) as properties
+    """
+    columns = cells["column"].tolist()
+    rows = cells["row"].tolist()
+    counts = cells["count"].tolist()
+    dwell = cells["dwell_seconds"].tolist() if "dwell_seconds" in cells else None
+    for i in range(len(counts)):
+        properties = {"cell": f"{mode}:{cell_size:g}:{columns[i]}:{rows[i]}", "count": counts[i]}
+        if dwell is not None:
+            properties["dwell_hours"] = round(dwell[i] / 3600, 3)
+        yield {
+            "type": "Feature",
+            "properties": properties,
+            "geometry": {"type": "Polygon", "coordinates": [cell_polygon(mode, columns[i], rows[i], cell_size)]},
+        }
+
+
+def add_aggregate_arguments(parser):
+    """
+    Add the options of the aggregated heatmap output to an argument parser
+    """
+    parser.add_argument("--aggregate", choices=["grid", "hex"], default=None,
+                        help="also write a heatmap with one feature per occupied grid cell or hexagon (<name>_<mode>.json)")
+    parser.add_argument("--cell-size", type=float, default=250,
+                        help="side of a grid cell or circumradius of a hexagon, in Web Mercator meters")
+    parser.add_argument("--dwell-weights", action="store_true",
+                        help="add the time spent in each cell, from the placeVisit durations")
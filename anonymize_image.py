@@ -1,25 +1,49 @@
 import os
+import re
 import sys
+import time
 import json
-import requests
+import base64
+import threading
+from io import BytesIO
+import argparse
 import shutil
-from PIL import Image
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
 from novita_client import NovitaClient
-from novita_client.utils import base64_to_image, image_to_base64
+import http_client
+from http_client import TokenBucket, RetryableError, make_session, call_with_retry, run_concurrently
+from image_cache import ImageCache
+import metrics
+
+# the endpoints can be overridden in config.py (E.g. to point at a local stub server)
+BLUR_FACE_API_URL = 'https://www.ailabapi.com/api/portrait/effects/blurred-faces'
+TEXT_REMOVAL_API_URL = None
 from config import *
 from common_utils import *
 
-client = NovitaClient(TEXT_REMOVAL_API_KEY)
+client = NovitaClient(TEXT_REMOVAL_API_KEY, TEXT_REMOVAL_API_URL)
+
+# connection pool shared by every AILab request and download, and the rate limit of each provider
+session = make_session()
+blur_rate_limiter = TokenBucket()
+text_rate_limiter = TokenBucket()
+
+def configure_http(concurrency=1, blur_rate=None, text_rate=None):
+    """
+    Size the connection pools for `concurrency` parallel requests and set the rate limit (requests per second) of each provider
+    """
+    global session, blur_rate_limiter, text_rate_limiter
+    session = make_session(max(10, concurrency))
+    blur_rate_limiter = TokenBucket(blur_rate, capacity=concurrency)
+    text_rate_limiter = TokenBucket(text_rate, capacity=concurrency)
+    if hasattr(client, "session"):
+        client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(10, concurrency)))
+        client.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max(10, concurrency)))
 
 def save_image_from_url(url, save_path):
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            with open(save_path, 'wb') as f:
-                f.write(response.content)
-        else:
-            print("Failed to download image: HTTP status code",
-                  response.status_code)
+        http_client.download_to_file(session, url, save_path)
     except Exception as e:
         print("An error occurred:", e)
 
@@ -29,23 +53,108 @@ def copy_image(source_path, destination_path):
     except Exception as e:
         print("An error occurred:", e)
 
-def make_blur_request(image_path, filename):
-    url = 'https://www.ailabapi.com/api/portrait/effects/blurred-faces'
+def make_blur_request(image_path, filename=None):
     headers = {'ailabapi-api-key': BLUR_FACE_API_KEY}
     payload={}
-    files = [
-        ('image', (filename, open(image_path, 'rb'), 'application/octet-stream'))
-    ]
-    response = requests.request("POST", url, headers=headers, data=payload, files=files)
+    with open(image_path, 'rb') as image_file:
+        files = [
+            ('image', (filename or os.path.basename(image_path), image_file, 'application/octet-stream'))
+        ]
+        response = http_client.request(session, "POST", BLUR_FACE_API_URL, blur_rate_limiter,
+                                       headers=headers, data=payload, files=files)
     response_json = json.loads(response.text)
     if response_json["error_detail"]["status_code"] == 200:
         return response_json['data']['image_url']
     else:
         return "422"
+
+def request_text_removal(image_b64):
+    """
+    Send a base64-encoded image to NovitaAI, retrying with backoff when the API answers 429 or 5xx
+
+    Returns: the response of `client.remove_text`
+    """
+
+    def send():
+        try:
+            return client.remove_text(image_b64)
+        except Exception as e:
+            status = re.search(r"status (\d{3})", str(e))
+            if status and int(status.group(1)) in http_client.RETRY_STATUS_CODES:
+                raise RetryableError(str(e))
+            raise
+
+    return call_with_retry(send, text_rate_limiter)
     
-def remove_text(input_dir, output_dir):
+_buffers = threading.local()
+
+def _encode_buffer():
+    """
+    Returns an empty BytesIO reused by every image processed in the current thread
+    """
+    if not hasattr(_buffers, "buffer"):
+        _buffers.buffer = BytesIO()
+    _buffers.buffer.seek(0)
+    _buffers.buffer.truncate()
+    return _buffers.buffer
+
+def remove_text_from_image(img_path, output_path, cache=None):
+    """
+    Remove the texts of one image with NovitaAI and save the result, resized for the map tooltips, to `output_path`.
+    The image is decoded once (JPEG draft mode decodes straight to about the target size), encoded once for the API payload and written once.
+
+    Parameters:
+        - `cache` (ImageCache): if given, an image processed before is copied from the cache instead of calling the API
+
+    Returns: a dict of the seconds spent in each step
+    """
+    timings = {}
+    start = time.perf_counter()
+    if cache is not None:
+        key = cache.key(img_path, "remove-text", {"thumbnail": [1024, 1024], "size": [400, 300]})
+        if cache.get(key, output_path):
+            timings["cache"] = time.perf_counter() - start
+            return timings
+        timings["cache"] = time.perf_counter() - start
+
+    step = time.perf_counter()
+    with Image.open(img_path) as img:
+        img.draft("RGB", (1024, 1024))
+        img.thumbnail((1024, 1024))
+        img.load()
+    timings["decode"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    buffer = _encode_buffer()
+    img.save(buffer, "JPEG")
+    image_b64 = base64.b64encode(buffer.getbuffer()).decode('ascii')
+    timings["encode"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    res = request_text_removal(image_b64)
+    timings["api"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    with Image.open(BytesIO(base64.b64decode(res.image_file))) as result:
+        result.draft("RGB", (400, 300))
+        result = ImageOps.exif_transpose(result).convert("RGB")
+    resize_image(result, output_path, 400, 300)
+    timings["decode_resize_write"] = time.perf_counter() - step
+
+    if cache is not None:
+        cache.put(key, output_path)
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+def remove_text(input_dir, output_dir, concurrency=1, cache=None):
     """
     Make API calls to NovitaAI to remove texts from images
+
+    Parameters:
+        - `concurrency` (int): number of images sent to the API at the same time
+        - `cache` (ImageCache): cache of the images already processed
+
+    Returns: a list of (image path, timings) tuples, see `remove_text_from_image`
     """
     if os.path.exists(input_dir) == False:
         print("Invalid path: " + str(input_dir))
@@ -54,54 +163,128 @@ def remove_text(input_dir, output_dir):
     os.makedirs(output_dir, exist_ok = True)
 
     subfolders = [f for f in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, f))]
+    tasks = []
     for subfolder in subfolders:
         subfolder_path = os.path.join(input_dir, subfolder)
         for filename in os.listdir(subfolder_path):
             if filename.endswith('.jpg'):
-                img_path = os.path.join(subfolder_path, filename)
-                with open(img_path, "rb") as image_file:
-                    img = Image.open(image_file)
-                    img.thumbnail((1024, 1024))
-                    output_dir_path = os.path.join(output_dir, filename)
-                    img.save(output_dir_path)
-
-                with open(output_dir_path, "rb") as image:
-                    img = Image.open(image)
-                    res = client.remove_text(image_to_base64(img))
-                    resize_image(base64_to_image(res.image_file), output_dir_path, 400, 300)
-        shutil.rmtree(subfolder_path)
-
-def blur_face_in_image(input_file_path, output_file_path):
+                tasks.append((os.path.join(subfolder_path, filename), os.path.join(output_dir, filename)))
+
+    def remove_text_task(task):
+        try:
+            return remove_text_from_image(*task, cache=cache)
+        except Exception as e:
+            print(f"Failed to remove text from {task[0]}:", e)
+            return None
+
+    with metrics.stage("remove_text", len(tasks)):
+        results = run_concurrently(remove_text_task, tasks, concurrency)
+    for timings in results:
+        for step, seconds in (timings or {}).items():
+            if step != "total":
+                metrics.current().add("remove_text." + step, seconds, items=1)
+    # only remove the blurred images once every image of the folder has been processed
+    failed_paths = {task[0] for task, timings in zip(tasks, results) if timings is None}
+    for subfolder in subfolders:
+        subfolder_path = os.path.join(input_dir, subfolder)
+        if not any(path.startswith(subfolder_path + os.sep) for path in failed_paths):
+            shutil.rmtree(subfolder_path)
+
+    return [(task[0], timings) for task, timings in zip(tasks, results) if timings is not None]
+
+def print_timings(timings_by_image):
+    """
+    Print the per-image time breakdown returned by `remove_text` followed by the mean of each step
+    """
+    totals = {}
+    for img_path, timings in timings_by_image:
+        print(os.path.basename(img_path) + ": " + ", ".join(f"{step} {seconds * 1000:.1f}ms" for step, seconds in timings.items()))
+        for step, seconds in timings.items():
+            totals.setdefault(step, []).append(seconds)
+    if totals:
+        print("mean: " + ", ".join(f"{step} {sum(values) / len(values) * 1000:.1f}ms" for step, values in totals.items()))
+
+def blur_face_in_image(input_file_path, output_file_path, cache=None):
+    if cache is not None:
+        key = cache.key(input_file_path, "blur-face", {"api": BLUR_FACE_API_URL})
+        if cache.get(key, output_file_path):
+            return
+
     image_url = make_blur_request(input_file_path)
     if image_url != "422":
         save_image_from_url(image_url, output_file_path)
     else:
+        # any API error ends up here (quota, authentication, ...), so the original is never cached as a blurred result
         copy_image(input_file_path, output_file_path)
+        return
+
+    if cache is not None and os.path.exists(output_file_path):
+        cache.put(key, output_file_path)
+
+def blur_face(input_dir, output_dir, concurrency=1, cache=None):
+    """
+    Make API calls to AILab to blur the faces in images
 
-def blur_face(input_dir, output_dir):
+    Parameters:
+        - `concurrency` (int): number of images sent to the API at the same time
+        - `cache` (ImageCache): cache of the images already processed
+    """
     if os.path.exists(input_dir) == False:
         print("Invalid path: " + str(input_dir))
     
     os.makedirs(output_dir, exist_ok=True)
     subfolders = [f for f in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, f))]
+    tasks = []
     for subfolder in subfolders:
         subfolder_path = os.path.join(input_dir, subfolder)
         output_file_dir = os.path.join(output_dir, subfolder)
         os.makedirs(output_file_dir, exist_ok=True)
         for filename in os.listdir(subfolder_path):
-            image_url = make_blur_request(os.path.join(subfolder_path, filename), filename)
-            output_file_path= os.path.join(output_file_dir, filename)
-            if image_url != "422":
-                save_image_from_url(image_url, output_file_path)
-            else:
-                copy_image(os.path.join(subfolder_path, filename), output_file_path)
+            tasks.append((os.path.join(subfolder_path, filename), os.path.join(output_file_dir, filename)))
+
+    def blur_face_task(task):
+        try:
+            blur_face_in_image(*task, cache=cache)
+        except Exception as e:
+            # never fall back to the original image here, it may still show faces
+            print(f"Failed to blur faces in {task[0]}:", e)
+
+    with metrics.stage("blur_face", len(tasks)):
+        run_concurrently(blur_face_task, tasks, concurrency)
     
     return output_dir
 
 if __name__ == "__main__":
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
-    blurred_output_dir = blur_face(input_dir, output_dir)
-    remove_text(blurred_output_dir, output_dir)
+    parser = argparse.ArgumentParser(description="Blur faces and remove texts from Instagram story images")
+    parser.add_argument("input_dir", help="path to the folder containing the stories images")
+    parser.add_argument("output_dir", help="path to the output folder")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of images sent to the APIs at the same time")
+    parser.add_argument("--blur-rate", type=float, default=None,
+                        help="maximum number of requests per second sent to AILab")
+    parser.add_argument("--text-rate", type=float, default=None,
+                        help="maximum number of requests per second sent to NovitaAI")
+    parser.add_argument("--cache-dir", default=None,
+                        help="folder caching the processed images so that unchanged images are not sent to the APIs again")
+    parser.add_argument("--cache-max-size-mb", type=float, default=None,
+                        help="maximum size of the cache; the least recently used images are evicted beyond it")
+    parser.add_argument("--timings", action="store_true",
+                        help="print the time spent decoding, encoding, waiting on the API and writing each image")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache_dir is not None:
+        max_size = int(args.cache_max_size_mb * 1024 * 1024) if args.cache_max_size_mb is not None else None
+        cache = ImageCache(args.cache_dir, max_size)
+
+    configure_http(args.concurrency, args.blur_rate, args.text_rate)
+    with metrics.instrumented_run(args, "anonymize_image"):
+        blurred_output_dir = blur_face(args.input_dir, args.output_dir, args.concurrency, cache)
+        timings_by_image = remove_text(blurred_output_dir, args.output_dir, args.concurrency, cache)
+    if args.timings:
+        print_timings(timings_by_image)
 
-            
\ No newline at end of file
+    if cache is not None:
+        cache.save_stats()
+        print("Cache: " + json.dumps(cache.summary()))
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import traceback
+from functools import partial
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from common_utils import find_month_files
+from filter_locations import DEFAULT_KEYWORDS
+from to_heatmap import GeoJSONWriter, iter_output_features
+import metrics
+import main
+
+REPORT_FILENAME = "batch_report.json"
+PARTICIPANT_KEYS = ("name", "input_dir", "stories_file", "media_mapping", "buffer_hours", "filters", "options")
+
+
+def load_config(config_path):
+    """
+    Load a cohort config file. Paths are relative to the folder of the config file.
+
+        {
+            "output_dir": "./output",
+            "workers": 4,
+            "merged_output": "cohort.json",
+            "defaults": {"buffer_hours": 2, "filters": {"parks": ["park", "garden"]}, "options": ["--compact"]},
+            "participants": [
+                {"name": "participant1", "input_dir": "./data/participant1/google-takeout/Semantic-Location-History",
+                 "stories_file": "./data/participant1/instagram/content/stories.json"},
+                ...
+            ]
+        }
+
+    `defaults` holds the settings shared by every participant, each of which can override them:
+        - `buffer_hours` (int): hours each place visit is extended on both sides when matching stories (0 by default)
+        - `filters` (dict): maps the name of each filtered output file to its keywords (null for the default keywords)
+        - `options` (list): other command line options of main.py (E.g. ["--gzip", "--aggregate", "grid"])
+
+    Returns: the config with the participants merged with the defaults
+    """
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+
+    def resolve(path):
+        return None if path is None else os.path.join(base_dir, os.path.expanduser(path))
+
+    defaults = config.get("defaults", {})
+    participants = []
+    for i, entry in enumerate(config.get("participants", [])):
+        participant = {"buffer_hours": 0, "filters": None, "options": [], "stories_file": None, "media_mapping": None}
+        participant.update(defaults)
+        participant.update(entry)
+        unknown = set(participant) - set(PARTICIPANT_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown participant settings: {', '.join(sorted(unknown))}")
+        if "input_dir" not in participant:
+            raise ValueError(f"Participant {i + 1} has no input_dir")
+        participant.setdefault("name", f"participant{i + 1}")
+        for key in ("input_dir", "stories_file", "media_mapping"):
+            participant[key] = resolve(participant[key])
+        participants.append(participant)
+
+    names = [participant["name"] for participant in participants]
+    if len(set(names)) != len(names):
+        raise ValueError("Participant names must be unique, they name the output folders")
+    config["participants"] = participants
+    config["output_dir"] = resolve(config.get("output_dir", "output"))
+    config["merged_output"] = resolve(config.get("merged_output"))
+    return config
+
+
+def participant_argv(participant, output_dir):
+    """
+    Returns the main.py command line arguments of a participant
+    """
+    argv = [participant["input_dir"], os.path.join(output_dir, participant["name"])]
+    if participant["stories_file"] is not None:
+        argv.append(participant["stories_file"])
+    if participant["media_mapping"] is not None:
+        argv += ["--media-mapping", participant["media_mapping"]]
+    return argv + list(participant["options"])
+
+
+def run_batch_participant(participant, output_dir):
+    """
+    Run main.py on one participant, with its output written to <output_dir>/<name>/run.log. Run in a worker process.
+
+    Returns: a dict with the `status` ("ok" or "failed"), the `seconds` taken, the `output_file` or the `error`, and the
+    run metrics of the participant's stages
+    """
+    # forked workers inherit the random state of the parent, so every participant would otherwise draw the same noise
+    random.seed()
+    participant_dir = os.path.join(output_dir, participant["name"])
+    os.makedirs(participant_dir, exist_ok=True)
+    result = {"name": participant["name"], "log": os.path.join(participant_dir, "run.log")}
+    start = time.perf_counter()
+    with open(result["log"], 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            args = main.parse_args(participant_argv(participant, output_dir))
+            keyword_sets = None
+            if participant["filters"]:
+                keyword_sets = {filename: DEFAULT_KEYWORDS if keywords is None else keywords
+                                for filename, keywords in participant["filters"].items()}
+            output_file, stages = metrics.run_instrumented(
+                partial(main.run_participant, args, participant["buffer_hours"]), keyword_sets)
+            participant_metrics = metrics.RunMetrics()
+            participant_metrics.merge(stages)
+            result.update(status="ok", output_file=output_file, stages=participant_metrics.report())
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            result.update(status="failed", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def input_size(participant):
+    """
+    Returns the total size of the monthly files of a participant, used to start the largest participants first
+    """
+    try:
+        return sum(os.path.getsize(file_path) for _, _, file_path in find_month_files(participant["input_dir"]))
+    except OSError:
+        return 0
+
+
+def run_batch(config, workers=None):
+    """
+    Run every participant of a config (see `load_config`) over a pool of processes. A participant that fails is
+    reported without stopping the others.
+
+    Parameters:
+        - `workers` (int): number of participants processed at the same time (the `workers` of the config, or the
+          number of CPUs, by default)
+
+    Returns: the result of every participant in the order of the config, see `run_batch_participant`
+    """
+    output_dir = config["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    participants = config["participants"]
+    results = {}
+    pending = []
+    for participant in participants:
+        if not os.path.isdir(participant["input_dir"]):
+            print("Invalid path: " + str(participant["input_dir"]))
+            results[participant["name"]] = {"name": participant["name"], "status": "failed", "seconds": 0.0,
+                                            "error": "Invalid path: " + str(participant["input_dir"])}
+        else:
+            pending.append(participant)
+    # the largest participants are started first so that a long one does not run alone at the end
+    pending.sort(key=input_size, reverse=True)
+
+    workers = workers or config.get("workers") or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(pending) or 1))) as executor:
+        futures = {executor.submit(run_batch_participant, participant, output_dir): participant for participant in pending}
+        for future in as_completed(futures):
+            name = futures[future]["name"]
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker process died (E.g. out of memory)
+                result = {"name": name, "status": "failed", "seconds": None, "error": f"{type(e).__name__}: {e}"}
+            results[name] = result
+            detail = f"{result['seconds']:.1f} s" if result["status"] == "ok" else result["error"]
+            print(f"[{len(results)}/{len(participants)}] {name} {result['status']} ({detail})")
+    return [results[participant["name"]] for participant in participants]
+
+
+def merge_geojson(results, output_path):
+    """
+    Write the features of every participant that succeeded to one cohort GeoJSON file, each with a `participant`
+    property
+
+    Returns: the number of features written
+    """
+    with GeoJSONWriter(output_path, gzip_output=output_path.endswith(".gz")) as writer:
+        for result in results:
+            if result["status"] != "ok":
+                continue
+            for feature in iter_output_features(result["output_file"]):
+                feature["properties"] = dict(feature.get("properties") or {}, participant=result["name"])
+                writer.write(feature)
+    print(f"Cohort GeoJSON file with {writer.count} features has been saved to {output_path}")
+    return writer.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run main.py on every participant of a cohort config file in parallel")
+    parser.add_argument("config", help="JSON file listing the participants, see load_config")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of participants processed at the same time")
+    parser.add_argument("--merged-output", default=None,
+                        help="also write the features of every participant to this GeoJSON file")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config):
+        print("Invalid path: " + str(args.config))
+        sys.exit(1)
+    config = load_config(args.config)
+    results = run_batch(config, args.workers)
+
+    report_path = os.path.join(config["output_dir"], REPORT_FILENAME)
+    with open(report_path, 'w') as f:
+        json.dump({"participants": results}, f, indent=2)
+    failed = [result["name"] for result in results if result["status"] != "ok"]
+    print(f"{len(results) - len(failed)} participants processed, {len(failed)} failed; report saved at {report_path}")
+    if failed:
+        print("Failed: " + ", ".join(failed))
+
+    merged_output = args.merged_output or config["merged_output"]
+    if merged_output:
+        merge_geojson(results, merged_output)
+    sys.exit(1 if failed else 0)
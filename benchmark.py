@@ -0,0 +1,195 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import datetime
+
+STAGES = ["main", "anonymize_data", "create_story_point", "load_history", "load_history_cached", "filter_locations"]
+
+
+def run_stage(stage, dataset, work_dir, buffer_hours=2):
+    """
+    Run one stage of the pipeline on a dataset written by synthetic_data.py. Called in a fresh process for every stage
+    so that the peak memory is the stage's own.
+
+    Parameters:
+        - `stage` (str): one of STAGES
+        - `dataset` (dict): the paths returned by `synthetic_data.generate_participant`
+        - `work_dir` (str): scratch folder of the outputs, shared by the stages of a run
+    """
+    input_dir, stories_file = dataset["input_dir"], dataset["stories_file"]
+    output_dir = os.path.join(work_dir, "output")
+    if stage == "main":
+        import main
+        sys.argv = ["main.py", input_dir, output_dir, stories_file, "--force"]
+        # answers to the prompts: no filtering, buffer hours
+        sys.stdin = io.StringIO(f"false\n{buffer_hours}\n")
+        main.main()
+    elif stage == "anonymize_data":
+        from location_anonymizer import anonymize_data
+        anonymize_data(input_dir, os.path.join(work_dir, "anonymized"), force=True)
+    elif stage == "create_story_point":
+        from from_instagram import extract_stories_with_exif_data, create_story_point
+        create_story_point(extract_stories_with_exif_data(stories_file), stories_file, input_dir, buffer_hours)
+    elif stage in ("load_history", "load_history_cached"):
+        from data_validator import DataValidator
+        cache_path = os.path.join(work_dir, "validator_cache.json")
+        if stage == "load_history" and os.path.exists(cache_path):
+            os.remove(cache_path)
+        DataValidator(input_dir, cache_path=cache_path).load_history()
+    elif stage == "filter_locations":
+        from filter_locations import filter_locations
+        filter_locations(os.path.join(output_dir, "output.json"), os.path.join(work_dir, "filtered.json"))
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+
+def measure_stage(stage, dataset, work_dir, buffer_hours=2):
+    """
+    Run a stage in a subprocess and return its wall time in seconds and peak resident memory in MB
+    """
+    result_file = os.path.join(work_dir, f"{stage}.result.json")
+    command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--dataset", json.dumps(dataset),
+               "--work-dir", work_dir, "--buffer-hours", str(buffer_hours), "--result-file", result_file]
+    completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        print(f"{stage} failed:\n{completed.stderr}")
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    with open(result_file, 'r') as f:
+        return json.load(f)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(sizes, stages=STAGES, repeat=1, work_dir=None, buffer_hours=2):
+    """
+    Generate a synthetic participant for each size and time every stage on it
+
+    Parameters:
+        - `sizes` (list): dicts of `synthetic_data.generate_participant` arguments (E.g. {"num_years": 5, "visits_per_month": 200})
+        - `stages` (list): the stages to run, in order ("filter_locations" reads the output of "main")
+        - `repeat` (int): number of runs of each stage; the fastest is kept
+
+    Returns: the results, ready to be saved as JSON
+    """
+    from synthetic_data import generate_participant
+    results = {
+        "revision": git_revision(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "runs": [],
+    }
+    root = work_dir or tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        for size in sizes:
+            name = "_".join(f"{key}{value}" for key, value in sorted(size.items()))
+            size_dir = os.path.join(root, name)
+            dataset = generate_participant(size_dir, **size)
+            run = {"size": size, "stages": {}}
+            for stage in stages:
+                measurements = [measure_stage(stage, dataset, size_dir, buffer_hours) for _ in range(repeat)]
+                valid = [m for m in measurements if "error" not in m]
+                run["stages"][stage] = min(valid, key=lambda m: m["seconds"]) if valid else measurements[0]
+                print(f"{name:<40} {stage:<22} " + format_measurement(run["stages"][stage]))
+            results["runs"].append(run)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def format_measurement(measurement):
+    if "error" in measurement:
+        return "error: " + measurement["error"]
+    return f"{measurement['seconds']:9.3f} s {measurement['peak_rss_mb']:9.1f} MB"
+
+
+def compare(baseline, results):
+    """
+    Print the time and peak memory of each stage relative to a baseline result file
+    """
+    baseline_runs = {json.dumps(run["size"], sort_keys=True): run for run in baseline["runs"]}
+    print(f"Compared with revision {baseline.get('revision')} ({baseline.get('date')})")
+    for run in results["runs"]:
+        before = baseline_runs.get(json.dumps(run["size"], sort_keys=True))
+        if before is None:
+            continue
+        for stage, measurement in run["stages"].items():
+            old = before["stages"].get(stage)
+            if not old or "error" in old or "error" in measurement:
+                continue
+            print(f"{json.dumps(run['size']):<60} {stage:<22} time x{measurement['seconds'] / old['seconds']:.2f}"
+                  f"  memory x{measurement['peak_rss_mb'] / old['peak_rss_mb']:.2f}")
+
+
+def parse_size(value):
+    """
+    Parse a "years=2,visits=100,stories=100" command line argument
+    """
+    names = {"years": "num_years", "visits": "visits_per_month", "stories": "num_stories", "places": "num_places",
+             "exif": "exif_ratio"}
+    size = {}
+    for item in value.split(","):
+        key, _, number = item.partition("=")
+        if key not in names:
+            raise argparse.ArgumentTypeError(f"Unknown size parameter {key!r}, expected one of {', '.join(names)}")
+        size[names[key]] = float(number) if key == "exif" else int(number)
+    return size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic data of several sizes")
+    parser.add_argument("--size", dest="sizes", action="append", type=parse_size, default=None,
+                        help="dataset size, E.g. years=5,visits=200,stories=500 (repeatable)")
+    parser.add_argument("--stage", dest="stages", action="append", choices=STAGES, default=None,
+                        help="stage to run (repeatable, every stage by default)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of runs of each stage, the fastest is kept")
+    parser.add_argument("--buffer-hours", type=int, default=2)
+    parser.add_argument("--output", default=None, help="JSON file the results are saved to")
+    parser.add_argument("--compare", default=None, help="JSON results of another revision to compare with")
+    parser.add_argument("--keep-data", default=None, help="write the datasets to this folder and keep them")
+    # internal: run a single stage in this process
+    parser.add_argument("--run-stage", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--dataset", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        # import the pipeline before starting the clock so that only the stage itself is timed
+        import main, location_anonymizer, from_instagram, data_validator, filter_locations
+        start = time.perf_counter()
+        run_stage(args.run_stage, json.loads(args.dataset), args.work_dir, args.buffer_hours)
+        seconds = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+        with open(args.result_file, 'w') as f:
+            json.dump({"seconds": seconds, "peak_rss_mb": peak}, f)
+        sys.exit(0)
+
+    sizes = args.sizes or [{"num_years": 1, "visits_per_month": 100, "num_stories": 100},
+                           {"num_years": 5, "visits_per_month": 300, "num_stories": 500}]
+    results = run_benchmark(sizes, args.stages or STAGES, args.repeat, args.keep_data, args.buffer_hours)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
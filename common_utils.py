@@ -1,38 +1,132 @@
 from datetime import datetime
 import json
+import gzip
 import os
+import re
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
 import sys
+import time
+import argparse
+from functools import partial
+from timestamps import LOCAL, TimestampParser
+import metrics
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def copy_files(source_dir, target_dir):
+_timestamp_parser = TimestampParser(naive_tz=LOCAL)
+
+COPY_MODES = ("copy", "hardlink", "reflink", "symlink")
+# ioctl request cloning a whole file on Btrfs, XFS and other copy-on-write file systems (linux/fs.h)
+FICLONE = 0x40049409
+
+def copy_files(source_dir, target_dir, mode="copy", workers=8):
     """
     Copy all files from source_dir and its subdirectories to target_dir.
 
+    Files sharing a name are saved as name_1.ext, name_2.ext, ... without overwriting the files already in target_dir.
+    The target names are assigned up front from an in-memory set and the files are then copied by a pool of threads.
+
     Parameters:
         source_dir (str): The root directory to search for files.
         target_dir (str): The directory where all files will be copied.
+        mode (str): "copy" copies the bytes; "hardlink" and "reflink" (a copy-on-write clone, or an in-kernel
+            copy_file_range) avoid copying when both folders are on the same file system and fall back to a copy
+            otherwise; "symlink" links to the source files.
+        workers (int): number of files copied at the same time.
+
+    Returns: a list of (source path, target path) tuples
     """
-    os.makedirs(target_dir, exist_ok=True)  # Ensure the target directory exists
-    
+    source_paths = []
     for root, dirs, files in os.walk(source_dir):
-        for file in files:
-            # Construct full file path
-            file_path = os.path.join(root, file)
-            # Construct target file path
-            target_file_path = os.path.join(target_dir, file)
-            
-            # Avoid overwriting existing files in target_dir by appending a number to the filename
-            counter = 1
-            original_target_file_path = target_file_path
-            while os.path.exists(target_file_path):
-                base, extension = os.path.splitext(original_target_file_path)
-                target_file_path = f"{base}_{counter}{extension}"
+        dirs.sort()
+        source_paths.extend(os.path.join(root, file) for file in sorted(files))
+    copies = plan_copies(source_paths, target_dir)
+    copy_all(copies, mode, workers)
+    return copies
+
+def plan_copies(source_paths, target_dir):
+    """
+    Returns a (source path, target path) tuple for each file copied into `target_dir`, renaming the files whose name is
+    already taken (by a file in `target_dir` or an earlier source) to name_1.ext, name_2.ext, ...
+    """
+    os.makedirs(target_dir, exist_ok=True)  # Ensure the target directory exists
+    used_names = set(os.listdir(target_dir))
+    # next suffix to try for each name, so a name shared by many files does not probe every suffix again
+    next_suffix = {}
+    copies = []
+    for source_path in source_paths:
+        file = os.path.basename(source_path)
+        target_name = file
+        if target_name in used_names:
+            base, extension = os.path.splitext(file)
+            counter = next_suffix.get(file, 1)
+            while f"{base}_{counter}{extension}" in used_names:
                 counter += 1
-            
-            # Copy the file
-            shutil.copy2(file_path, target_file_path)
-            # print(f"Copied '{file_path}' to '{target_file_path}'")
+            next_suffix[file] = counter + 1
+            target_name = f"{base}_{counter}{extension}"
+        used_names.add(target_name)
+        copies.append((source_path, os.path.join(target_dir, target_name)))
+    return copies
+
+def copy_all(copies, mode="copy", workers=8):
+    """
+    Copy the (source path, target path) tuples of `copies` with a pool of `workers` threads (see `copy_files` for the modes)
+    """
+    if mode not in COPY_MODES:
+        raise ValueError(f"Unknown copy mode: {mode}")
+    copy = partial(_copy_file, mode=mode)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda paths: copy(*paths), copies))
+
+def _copy_file(source_path, target_path, mode="copy"):
+    if mode == "symlink":
+        os.symlink(os.path.abspath(source_path), target_path)
+        return
+    if mode == "hardlink":
+        try:
+            os.link(source_path, target_path)
+            return
+        except OSError:
+            pass  # different file systems, or links not supported
+    elif mode == "reflink":
+        if _reflink(source_path, target_path):
+            return
+    shutil.copy2(source_path, target_path)
+
+def _reflink(source_path, target_path):
+    """
+    Clone a file with FICLONE, or copy it in the kernel with copy_file_range (which shares the extents on file systems
+    supporting it). Returns False if neither is available, leaving no target file behind.
+    """
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        try:
+            if fcntl is None:
+                raise OSError("ioctl is not available")
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            if not hasattr(os, "copy_file_range"):
+                copied = False
+            else:
+                try:
+                    remaining = os.fstat(source.fileno()).st_size
+                    while remaining > 0:
+                        count = os.copy_file_range(source.fileno(), target.fileno(), remaining)
+                        if count == 0:
+                            break
+                        remaining -= count
+                    copied = remaining == 0
+                except OSError:
+                    copied = False
+            if not copied:
+                target.close()
+                os.remove(target_path)
+                return False
+    shutil.copystat(source_path, target_path)
+    return True
 
 def convert_to_timestamp(time_str: str):
     """
@@ -44,33 +138,28 @@ def convert_to_timestamp(time_str: str):
         - "%Y-%m-%dT%H:%M:%SZ"
         - "%Y:%m:%d %H:%M:%S"
         - "%Y%m%dT%H%M%S.%fZ"
-    """
-    date_formats = ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ",
-                    "%Y:%m:%d %H:%M:%S", "%Y%m%dT%H%M%S.%fZ"]
-    datetime_obj = None
-    for date_format in date_formats:
-        try:
-            datetime_obj = datetime.strptime(time_str, date_format)
-            break
-        except ValueError:
-            continue
-    if datetime is None:
-        print("The input Datetime format is not recognized")
-    else:
-        if datetime_obj is None:
-            print(time_str)
-        return datetime_obj.timestamp()
+        - any other ISO 8601 timestamp, or a UNIX timestamp
 
+    A trailing "Z" or offset is honored, timestamps without one (E.g. EXIF dates) are in the local time of the machine.
+    The format is detected once and reused for the following calls (see `timestamps.TimestampParser`).
+    """
+    timestamp = _timestamp_parser.epoch(time_str)
+    if timestamp is None:
+        print("The input Datetime format is not recognized: " + str(time_str))
+    return timestamp
 
-def load_timeline(input_file_path):
+def load_timeline(input_file_path, stream=False):
     """
     Returns the timeline
 
     Parameters:
         - `input_file_path` (str): path to the input file
+        - `stream` (bool): if True, `timelineObjects` is a generator parsing the entries one at a time from the file instead of a list
 
     Returns: a dictionary representing the timeline
     """
+    if stream:
+        return {"timelineObjects": iter_timeline_objects(input_file_path, stream=True)}
     with open(input_file_path, 'r') as json_file:
         try:
             maps_json = json.load(json_file)
@@ -79,6 +168,127 @@ def load_timeline(input_file_path):
     return maps_json
 
 
+def iter_timeline_objects(input_file_path, stream=False):
+    """
+    Yields the timeline objects of a monthly file one at a time
+
+    Parameters:
+        - `input_file_path` (str): path to the input file
+        - `stream` (bool): if True, parse the file incrementally so that only one timeline object is held in memory; otherwise load the whole file with `json.load`
+
+    Raises: `json.JSONDecodeError` if the file is not valid JSON
+    """
+    if stream:
+        yield from iter_json_array_items(input_file_path, "timelineObjects")
+    else:
+        with open(input_file_path, 'r', encoding='utf-8') as json_file:
+            maps_json = json.load(json_file)
+        if maps_json:
+            yield from maps_json.get("timelineObjects", [])
+
+
+def iter_json_array_items(input_file_path, key, chunk_size=1 << 16, required=False):
+    """
+    Yields the items of the array stored under `key` in the top-level object of a JSON file, parsing the file incrementally.
+    Memory is bounded by the size of the largest item (plus the values of other top-level keys preceding `key`).
+
+    Parameters:
+        - `input_file_path` (str): path to the JSON file (gzipped if its name ends with .gz)
+        - `key` (str): the top-level key holding the array (E.g. "timelineObjects" or "features")
+        - `chunk_size` (int): number of characters read from the file at a time
+        - `required` (bool): raise a KeyError if the top-level object has no `key`, instead of yielding nothing
+
+    Raises: `json.JSONDecodeError` if the file is not valid JSON
+    """
+    opener = gzip.open if input_file_path.endswith('.gz') else open
+    with opener(input_file_path, 'rt', encoding='utf-8') as json_file:
+        reader = _IncrementalJSONReader(json_file, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            if required:
+                raise KeyError(key)
+            return
+        while True:
+            name = reader.decode()
+            reader.expect(':')
+            if name == key:
+                reader.expect('[')
+                if reader.peek() == ']':
+                    return
+                while True:
+                    yield reader.decode()
+                    if reader.expect(',]') == ']':
+                        return
+            reader.decode()
+            if reader.expect(',}') == '}':
+                if required:
+                    raise KeyError(key)
+                return
+
+
+class _IncrementalJSONReader:
+    """
+    Decodes JSON values one at a time from a file object, keeping only the unread part of the file in memory
+    """
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # read at least as much as is buffered so that re-decoding a large value stays linear
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character without consuming it ('' at the end of the file)
+        """
+        while True:
+            self.pos = self._WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, chars):
+        """
+        Consumes the next non-whitespace character, which must be one of `chars`
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decodes the next JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+
 def find_subfolders(input_dir_path):
     """
     Returns a list of all subfolders under the input directory
@@ -92,6 +302,70 @@ def find_subfolders(input_dir_path):
         input_dir_path) if os.path.isdir(os.path.join(input_dir_path, f))]
     return subfolders
 
+MONTHS = ["JANUARY", "FEBRUARY", "MARCH", "APRIL", "MAY", "JUNE", "JULY",
+          "AUGUST", "SEPTEMBER", "OCTOBER", "NOVEMBER", "DECEMBER"]
+
+def month_sort_key(subfolder, filename):
+    """
+    Returns a key ordering monthly files (E.g. 2020/2020_JANUARY.json) by (year, month); unrecognized names sort after the months of their folder by name
+    """
+    month_name = os.path.splitext(filename)[0].split("_")[-1].upper()
+    month = MONTHS.index(month_name) if month_name in MONTHS else len(MONTHS)
+    return (subfolder, month, filename)
+
+def month_code(filename):
+    """
+    Returns the month of a monthly file (E.g. 2020_JANUARY.json) as an int like 202001, or 0 if the name is not recognized
+    """
+    year, _, month_name = os.path.splitext(filename)[0].rpartition("_")
+    if not year.isdigit() or month_name.upper() not in MONTHS:
+        return 0
+    return int(year) * 100 + MONTHS.index(month_name.upper()) + 1
+
+def month_label(code):
+    """
+    Returns the name of the monthly file of a `month_code` without extension (E.g. "2020_JANUARY")
+    """
+    return f"{code // 100}_{MONTHS[code % 100 - 1]}"
+
+def find_month_files(input_dir_path):
+    """
+    Returns the monthly JSON files of a Semantic-Location-History folder in (year, month) order
+
+    Parameters:
+        - `input_dir_path` (str): the path to the Semantic-Location-History folder
+
+    Returns: a list of (subfolder, filename, file_path) tuples, one per monthly file
+    """
+    month_files = []
+    for subfolder in find_subfolders(input_dir_path):
+        subfolder_path = os.path.join(input_dir_path, subfolder)
+        for filename in os.listdir(subfolder_path):
+            if filename.endswith('.json'):
+                month_files.append((subfolder, filename, os.path.join(subfolder_path, filename)))
+    month_files.sort(key=lambda month_file: month_sort_key(month_file[0], month_file[1]))
+    return month_files
+
+def parallel_map(func, items, workers=None):
+    """
+    Returns the results of `func` applied to every item, in the order of `items`
+
+    Parameters:
+        - `func`: a module-level function or a `functools.partial` of one (it is pickled to the worker processes)
+        - `items` (list): the items to process
+        - `workers` (int): number of worker processes; the items are processed in this process when it is None or 1
+
+    The stages timed by `func` (see metrics.py) are added to the metrics of this run.
+    """
+    if workers is None or workers <= 1:
+        return [func(item) for item in items]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result, stages in executor.map(partial(metrics.run_instrumented, func), items):
+            metrics.current().merge(stages)
+            results.append(result)
+    return results
+
 def ask_true_false(prompt_msg: str):
     while True:
         response = input(prompt_msg + " (true/false) ").lower()
@@ -102,9 +376,19 @@ def ask_true_false(prompt_msg: str):
         else:
             print("Invalid input. Please enter 'true' or 'false'.")
 
-def resize_image(img, output_path, max_width, max_height):
-    width, height = img.size
+RESAMPLING_FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
 
+def fit_within(width, height, max_width, max_height):
+    """
+    Returns the (width, height) of an image scaled down to fit within a maximum width and height, preserving the aspect ratio
+    """
     # Calculate the aspect ratio
     aspect_ratio = width / height
 
@@ -119,71 +403,98 @@ def resize_image(img, output_path, max_width, max_height):
     else:
         new_width = width
         new_height = height
+    return new_width, new_height
+
+def resize_image(img, output_path, max_width, max_height, resample=None):
+    """
+    Resize an image to fit within a maximum width and height, preserving the aspect ratio, and save it
+
+    Args:
+        img (PIL.Image): The image to resize.
+        output_path (str): Path to save the resized image.
+        max_width (int): Maximum width of the resized image.
+        max_height (int): Maximum height of the resized image.
+        resample (str): Name of the resampling filter (see RESAMPLING_FILTERS); Pillow's default when None.
+    """
+    new_size = fit_within(img.width, img.height, max_width, max_height)
 
     # Resize the image
-    resized_img = img.resize((new_width, new_height))
+    if resample is None:
+        resized_img = img.resize(new_size)
+    else:
+        resized_img = img.resize(new_size, RESAMPLING_FILTERS[resample])
     # Save the resized image
     resized_img.save(output_path)
 
-# def resize_image(input_path, output_path, max_width, max_height):
-#     """
-#     Resize an image file to fit within a maximum width and height, preserving the aspect ratio.
-
-#     Args:
-#         input_path (str): Path to the input image file.
-#         output_path (str): Path to save the resized image.
-#         max_width (int): Maximum width of the resized image.
-#         max_height (int): Maximum height of the resized image.
-#     """
-#     # Open the image file
-#     with Image.open(input_path) as img:
-#         # Get the current width and height
-#         width, height = img.size
-
-#         # Calculate the aspect ratio
-#         aspect_ratio = width / height
-
-#         # Calculate new width and height based on the aspect ratio
-#         if width > max_width or height > max_height:
-#             if width / max_width > height / max_height:
-#                 new_width = max_width
-#                 new_height = int(new_width / aspect_ratio)
-#             else:
-#                 new_height = max_height
-#                 new_width = int(new_height * aspect_ratio)
-#         else:
-#             new_width = width
-#             new_height = height
-
-#         # Resize the image
-#         resized_img = img.resize((new_width, new_height))
-#         # Save the resized image
-#         resized_img.save(output_path)
-
-def resize_images_in_folder(input_folder, output_folder, max_width, max_height):
+def thumbnail_image(input_path, output_path, max_width, max_height, resample=None):
+    """
+    Resize an image file to fit within a maximum width and height. JPEG files are decoded in draft mode, directly at the smallest scale still larger than the target size.
+    """
+    with Image.open(input_path) as img:
+        img.draft("RGB", (max_width, max_height))
+        resize_image(img, output_path, max_width, max_height, resample)
+
+def _thumbnail_task(paths, max_width, max_height, resample):
+    input_path, output_path = paths
+    try:
+        thumbnail_image(input_path, output_path, max_width, max_height, resample)
+        return True
+    except Exception as e:
+        print(f"Failed to resize {input_path}:", e)
+        return False
+
+def resize_images_in_folder(input_folder, output_folder, max_width, max_height, workers=None, resample="bicubic", force=False):
     """
     Resize all images in a folder to fit within a maximum width and height, preserving the aspect ratio.
+    Images whose output is newer than the input are skipped unless `force` is set.
 
     Args:
         input_folder (str): Path to the input folder containing images.
         output_folder (str): Path to save the resized images.
         max_width (int): Maximum width of the resized images.
         max_height (int): Maximum height of the resized images.
+        workers (int): Number of processes the images are spread over.
+        resample (str): Name of the resampling filter (see RESAMPLING_FILTERS).
+        force (bool): Resize every image even if its output is up to date.
+
+    Returns: the number of resized images
     """
     # Create the output folder if it doesn't exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    os.makedirs(output_folder, exist_ok=True)
 
+    tasks = []
+    skipped = 0
     # Loop through each file in the input folder
-    for file_name in os.listdir(input_folder):
-        if file_name.endswith('.jpg'):
+    for file_name in sorted(os.listdir(input_folder)):
+        if file_name.lower().endswith(('.jpg', '.jpeg')):
             input_path = os.path.join(input_folder, file_name)
             output_path = os.path.join(output_folder, file_name)
-            # Resize the image and save it to the output folder
-            resize_image(input_path, output_path, max_width, max_height)
+            if not force and os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path):
+                skipped += 1
+                continue
+            tasks.append((input_path, output_path))
+
+    start = time.perf_counter()
+    results = parallel_map(partial(_thumbnail_task, max_width=max_width, max_height=max_height, resample=resample),
+                           tasks, workers)
+    elapsed = time.perf_counter() - start
+    resized = sum(results)
+    rate = resized / elapsed if elapsed > 0 else 0
+    print(f"Resized {resized} images in {elapsed:.2f}s ({rate:.1f} images/s), {skipped} up to date, {len(tasks) - resized} failed")
+    return resized
 
 
 if __name__ == "__main__":
-    input_folder = "./data/anonymized_stories/participant1"
-    output_folder = "./data/anonymized_stories/participant11"
-    resize_images_in_folder(input_folder, output_folder, 400, 300)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Resize all JPEG images of a folder for the map tooltips")
+    parser.add_argument("input_folder", help="path to the folder containing the images")
+    parser.add_argument("output_folder", help="path to the folder the resized images are saved to")
+    parser.add_argument("--max-width", type=int, default=400)
+    parser.add_argument("--max-height", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of processes the images are spread over")
+    parser.add_argument("--resample", choices=sorted(RESAMPLING_FILTERS), default="bicubic",
+                        help="resampling filter")
+    parser.add_argument("--force", action="store_true", help="resize images whose output is already up to date")
+    args = parser.parse_args()
+    resize_images_in_folder(args.input_folder, args.output_folder, args.max_width, args.max_height,
+                            args.workers, args.resample, args.force)
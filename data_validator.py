@@ -2,57 +2,215 @@ import sys
 import os
 import json
 import re
+import hashlib
 import chardet
 from pprint import pprint
 from common_utils import *
+from run_manifest import file_fingerprint
+from visit_table import VisitTable, GOOGLE, MISSING
+from history_store import HistoryStore, PLACE_VISIT
+import numpy as np
+
+CACHE_VERSION = 2
+
+
+def default_cache_path(input_dir):
+    """
+    Returns the path of the validator cache of a Semantic-Location-History folder when no output folder is given: a file
+    named after the folder's absolute path under the user cache directory, never inside the folder itself
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    digest = hashlib.sha256(os.path.abspath(input_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "sound-of-silence", "validator", digest + ".json")
+
+
+def summarize_timeline_objects(timeline_objects):
+    """
+    Returns the statistics of a monthly file needed by `DataValidator.analyze_history`
+
+    Parameters:
+        - `timeline_objects` (iterable): the timelineObjects of a monthly file, either a list or a generator streaming them
+
+    Returns: a dict with the number of placeVisits having a placeId, the sorted unique placeIds and the number of addresses in CA
+    """
+    total_num_places_visited = 0
+    num_of_locations_in_CA = 0
+    place_ids = set()
+    for timeline_object in timeline_objects:
+        if "placeVisit" in timeline_object:
+            if "location" in timeline_object["placeVisit"]:
+                location = timeline_object["placeVisit"]["location"]
+                if "placeId" in location:
+                    total_num_places_visited += 1
+                    place_ids.add(location["placeId"])
+                if "address" in location:
+                    if re.search(r'\bCA\b', location["address"]):
+                        num_of_locations_in_CA += 1
+    return {
+        "status": "ok",
+        "num_places_visited": total_num_places_visited,
+        "place_ids": sorted(place_ids),
+        "num_of_locations_in_CA": num_of_locations_in_CA,
+    }
+
+
+def summarize_visit_table(table):
+    """
+    Returns the summaries of `summarize_timeline_objects` by year and month from the visits of a VisitTable (E.g. a
+    visits store written by main.py). The stores hold anonymized visits, so the home visits do not count as in CA.
+    """
+    return _summarize_columns(table["source"] == GOOGLE, table["month"], table["place_id"], table["address"], table.strings)
+
+
+def summarize_history_store(store):
+    """
+    Returns the summaries of `summarize_timeline_objects` by year and month from the place visits of a HistoryStore
+    (see history_store.py). The store holds the raw history, so the statistics are those of the monthly files.
+    """
+    months = np.asarray(store["month"])
+    place_visits = np.asarray(store["kind"]) == PLACE_VISIT
+    return _summarize_columns(place_visits, months, np.asarray(store["place_id"]), np.asarray(store["address"]),
+                              store.strings)
+
+
+def _summarize_columns(visits, months, place_ids, addresses, strings):
+    """
+    Returns the summaries by year and month of the rows selected by the boolean array `visits`, from the codes of their
+    placeId and address in the string table `strings`
+    """
+    in_ca = np.array([re.search(r'\bCA\b', string) is not None for string in strings] + [False], dtype=bool)
+    summaries_by_year = {}
+    for month in np.unique(months[visits & (months > 0)]).tolist():
+        rows = visits & (months == month)
+        month_place_ids = place_ids[rows]
+        month_place_ids = month_place_ids[month_place_ids != MISSING]
+        summaries_by_year.setdefault(str(month // 100), {})[month_label(month)] = {
+            "status": "ok",
+            "num_places_visited": len(month_place_ids),
+            "place_ids": sorted(strings[code] for code in np.unique(month_place_ids).tolist()),
+            "num_of_locations_in_CA": int(in_ca[addresses[rows]].sum()),
+        }
+    return summaries_by_year
+
 
 class DataValidator:
-    def __init__(self, input_dir, output_dir = None):
+    def __init__(self, input_dir, output_dir = None, stream = False, cache_path = None):
         self.input_dir = input_dir
         self.output_dir = output_dir
+        # parse each monthly file incrementally while summarizing it instead of loading it whole
+        self.stream = stream
+        # the summaries of the monthly files are kept there, keyed by their content hash, so unchanged files are not parsed again
+        if cache_path is None:
+            cache_path = os.path.join(output_dir, ".validator_cache.json") if output_dir else default_cache_path(input_dir)
+        self.cache_path = cache_path
         self.stats = {'basic_stats': {}}
-    
+
+    def load_cache(self):
+        """
+        Returns the cached summaries by monthly file, or an empty dict if there is no usable cache
+        """
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            print(f"Ignoring unreadable cache: {self.cache_path}")
+            return {}
+        return cache.get("files", {}) if cache.get("version") == CACHE_VERSION else {}
+
+    def save_cache(self, files):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with open(self.cache_path + ".tmp", 'w') as f:
+                json.dump({"version": CACHE_VERSION, "files": files}, f)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError as e:
+            print(f"Could not save the cache {self.cache_path}: {e}")
+
+    def summarize_file(self, file_path):
+        """
+        Returns the summary of a monthly file, with the status "empty" or "error" if it has no data or cannot be parsed
+        """
+        try:
+            if self.stream:
+                return summarize_timeline_objects(iter_json_array_items(file_path, "timelineObjects", required=True))
+            with open(file_path, 'r', encoding='utf-8') as json_file:
+                maps_json = json.load(json_file)
+        except json.JSONDecodeError:
+            print(f"Error parsing JSON in file: {file_path}")
+            return {"status": "error"}
+        except KeyError:
+            # streamed file without timelineObjects
+            maps_json = None
+        if not maps_json or "timelineObjects" not in maps_json:
+            print(f"No data found in the file {file_path}")
+            return {"status": "empty"}
+        return summarize_timeline_objects(maps_json["timelineObjects"])
+
     def load_history(self):
         subfolders = [folder for folder in os.listdir(self.input_dir) if os.path.isdir(os.path.join(self.input_dir, folder))]
 
         num_empty_files = 0
         num_empty_data_files = 0
-        places_visited = set()
 
-        timeline_objects_by_year = {} 
+        cached_files = self.load_cache()
+        files = {}
+        cache_changed = False
+        summaries_by_year = {}
         for subfolder in subfolders:
             subfolder_path = os.path.join(self.input_dir, subfolder)
-            places_visited_by_year = set()
             for filename in os.listdir(subfolder_path):
                 if filename.endswith('.json'):
                     file_path = os.path.join(subfolder_path, filename)
-                    with open(file_path, 'r', encoding='utf-8') as json_file:
-                        try:
-                            maps_json = json.load(json_file)
-                            if not maps_json:
-                                print(f"No data found in the file {file_path}")
-                                num_empty_data_files += 1
-                            else:
-                                if subfolder not in timeline_objects_by_year:
-                                    timeline_objects_by_year[subfolder] = {filename.rstrip(".json"): maps_json}
-                                else:
-                                    timeline_objects_by_year[subfolder][filename.rstrip(".json")] = maps_json
-                                # places_visited_by_month = analyze_file(maps_json, filename)
-                                # places_visited_by_year = places_visited_by_year.union(places_visited_by_month)
-                                # places_visited = places_visited.union(places_visited_by_month)
-                        except json.JSONDecodeError:
-                            print(f"Error parsing JSON in file: {file_path}")
-                            num_empty_files += 1
-        self.analyze_history(timeline_objects_by_year)
+                    key = subfolder + "/" + filename
+                    cached = cached_files.get(key)
+                    fingerprint = file_fingerprint(file_path, cached["fingerprint"] if cached else None)
+                    if cached and cached["fingerprint"]["sha256"] == fingerprint["sha256"]:
+                        summary = cached["summary"]
+                        cache_changed |= cached["fingerprint"] != fingerprint
+                    else:
+                        summary = self.summarize_file(file_path)
+                        cache_changed = True
+                    files[key] = {"fingerprint": fingerprint, "summary": summary}
+
+                    if summary["status"] == "error":
+                        num_empty_files += 1
+                    elif summary["status"] == "empty":
+                        num_empty_data_files += 1
+                    else:
+                        summaries_by_year.setdefault(subfolder, {})[filename.rstrip(".json")] = summary
+        if cache_changed or files.keys() != cached_files.keys():
+            self.save_cache(files)
+
+        self.analyze_history(summaries_by_year)
         self.stats['basic_stats']['num_empty_files'] = num_empty_files
         self.stats['basic_stats']['num_empty_data_files'] = num_empty_data_files
-        
-    
-    def analyze_history(self, timeline_objects_by_year, **kwargs):
+
+
+    def load_store(self, path):
+        """
+        Collect the statistics from a visits store (.npz) written by main.py instead of the monthly files, see
+        `summarize_visit_table`
         """
-        Collect the statistics of locations in the provided file
+        self.analyze_history(summarize_visit_table(VisitTable.load(path)))
+        self.stats['basic_stats']['num_empty_files'] = 0
+        self.stats['basic_stats']['num_empty_data_files'] = 0
+
+    def load_history_store(self, path):
+        """
+        Collect the statistics from a HistoryStore folder (see history_store.py) instead of parsing the monthly files
+        """
+        self.analyze_history(summarize_history_store(HistoryStore(path)))
+        self.stats['basic_stats']['num_empty_files'] = 0
+        self.stats['basic_stats']['num_empty_data_files'] = 0
+
+    def analyze_history(self, summaries_by_year, **kwargs):
+        """
+        Collect the statistics of locations by merging the summaries of the monthly files
 
         Arguments:
+            - `summaries_by_year`: the summaries returned by `summarize_timeline_objects` by month and year (a loaded monthly file is summarized on the fly)
             - `min_places_visited_per_month`: the minimum number of unique places visited per month
             - `min_month_history`: the minimum number of months in history
         """
@@ -70,39 +228,30 @@ class DataValidator:
         num_of_locations_in_CA = {}
         
     
-        for year in timeline_objects_by_year:
+        for year in summaries_by_year:
             num_of_years += 1
             unique_places_visited_by_year = set()
-            
 
-            for month in timeline_objects_by_year[year]:
-                num_of_locations_in_CA_by_month = 0
-                total_num_places_visited = 0
+            for month in summaries_by_year[year]:
                 num_of_months += 1
-                unique_places_visited_by_month = set()
-                # print("year " + year + "month " + month)
-                timeline_objects_by_month = timeline_objects_by_year[year][month]["timelineObjects"]
-                for timeline_object in timeline_objects_by_month:
-                    if "placeVisit" in timeline_object:
-                        if "location" in timeline_object["placeVisit"]:
-                            if "placeId" in timeline_object["placeVisit"]["location"]:
-                                total_num_places_visited += 1
-                                unique_places_visited_by_month.add(timeline_object["placeVisit"]["location"]["placeId"])
-                                unique_places_visited_by_year.add(timeline_object["placeVisit"]["location"]["placeId"])
-                            if "address" in timeline_object["placeVisit"]["location"]:
-                                if re.search(r'\bCA\b', timeline_object["placeVisit"]["location"]["address"]):
-                                    num_of_locations_in_CA_by_month += 1
-                unique_rate_by_month[month] = "{:.3%}".format(len(unique_places_visited_by_month) / total_num_places_visited) + f"     {len(unique_places_visited_by_month)} out of {total_num_places_visited} places visited"
+                summary = summaries_by_year[year][month]
+                if "timelineObjects" in summary:
+                    summary = summarize_timeline_objects(summary["timelineObjects"])
+                unique_places_visited_by_month = set(summary["place_ids"])
+                unique_places_visited_by_year |= unique_places_visited_by_month
+                total_num_places_visited = summary["num_places_visited"]
+                if total_num_places_visited:
+                    unique_rate_by_month[month] = "{:.3%}".format(len(unique_places_visited_by_month) / total_num_places_visited) + f"     {len(unique_places_visited_by_month)} out of {total_num_places_visited} places visited"
 
                 num_of_unique_places_by_month[month] = len(unique_places_visited_by_month)
 
                 if (len(unique_places_visited_by_month) < min_num_of_unique_places_visited_per_month):
                     months_too_few_places_visited.append(month)
-                if num_of_locations_in_CA_by_month > 0:
-                    num_of_locations_in_CA[month] = num_of_locations_in_CA_by_month
-                
+                if summary["num_of_locations_in_CA"] > 0:
+                    num_of_locations_in_CA[month] = summary["num_of_locations_in_CA"]
+
         self.stats['basic_stats']['num_of_years'] = num_of_years
         self.stats['basic_stats']['num_of_months'] = num_of_months
         self.stats['num_of_unique_places_visited_by_month'] = num_of_unique_places_by_month
         self.stats['months_too_few_places_visited'] = months_too_few_places_visited
-        
\ No newline at end of file
+        self.stats['num_of_locations_in_CA_by_month'] = num_of_locations_in_CA
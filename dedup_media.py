@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from common_utils import COPY_MODES, copy_all
+
+MAPPING_FILENAME = "media_mapping.json"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".heic")
+
+
+def fast_hash(path):
+    """
+    Returns the BLAKE2b digest of the content of a file (faster than SHA-256 and plenty to tell images apart)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def perceptual_hash(path):
+    """
+    Returns the 64-bit difference hash (dHash) of an image: each bit tells whether a pixel of the 9x8 grayscale
+    thumbnail is brighter than its right neighbour, so re-encoded or resized copies get the same or a close hash.
+    Returns None if the file cannot be decoded.
+    """
+    try:
+        with Image.open(path) as img:
+            img.draft("L", (64, 64))
+            pixels = img.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    except OSError:
+        return None
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+
+def find_uri_root(source_dir):
+    """
+    Returns the folder the `uri` of the stories are relative to: the parent of the "media" folder containing `source_dir`
+    (E.g. "instagram" for "instagram/media/stories"), or `source_dir` itself
+    """
+    path = os.path.abspath(source_dir)
+    while True:
+        if os.path.basename(path) == "media":
+            return os.path.dirname(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return source_dir
+        path = parent
+
+
+def group_duplicates(paths, perceptual=False, max_distance=4, workers=8):
+    """
+    Returns the index of the canonical file of every path: the first file with the same content, or with a perceptual
+    hash within `max_distance` bits when `perceptual` is True
+
+    Only files sharing their size with another file are hashed to find exact copies.
+    """
+    canonical = list(range(len(paths)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        by_size = {}
+        for i, size in enumerate(executor.map(os.path.getsize, paths)):
+            by_size.setdefault(size, []).append(i)
+        candidates = [i for group in by_size.values() if len(group) > 1 for i in group]
+        first_by_hash = {}
+        for i, digest in zip(candidates, executor.map(fast_hash, [paths[i] for i in candidates])):
+            canonical[i] = first_by_hash.setdefault(digest, i)
+
+        if perceptual:
+            images = [i for i in range(len(paths)) if canonical[i] == i and paths[i].lower().endswith(IMAGE_EXTENSIONS)]
+            hashes = dict(zip(images, executor.map(perceptual_hash, [paths[i] for i in images])))
+            _group_near_duplicates(canonical, hashes, max_distance)
+    return canonical
+
+
+def _group_near_duplicates(canonical, hashes, max_distance):
+    # two hashes within max_distance bits agree on at least one of max_distance + 1 bands of bits
+    num_bands = max_distance + 1
+    band_bits = -(-64 // num_bands)
+    buckets = {}
+    for i in sorted(hashes):
+        value = hashes[i]
+        if value is None:
+            continue
+        match = None
+        for band in range(num_bands):
+            key = (band, (value >> (band * band_bits)) & ((1 << band_bits) - 1))
+            for j in buckets.get(key, ()):
+                if bin(value ^ hashes[j]).count("1") <= max_distance:
+                    match = j if match is None else min(match, j)
+        if match is not None:
+            canonical[i] = match
+            continue
+        for band in range(num_bands):
+            buckets.setdefault((band, (value >> (band * band_bits)) & ((1 << band_bits) - 1)), []).append(i)
+
+    # files pointing at an exact copy of a near duplicate point at its canonical file
+    for i in range(len(canonical)):
+        canonical[i] = canonical[canonical[i]]
+
+
+def dedup_media(source_dir, target_dir, perceptual=False, max_distance=4, mode="copy", workers=8, uri_root=None):
+    """
+    Store every distinct story media of `source_dir` once in `target_dir`, keeping the month subfolders so that the
+    result can be passed to anonymize_image.py, and write a media_mapping.json file there mapping the `uri` of every
+    media (E.g. "media/stories/202108/xxx.jpg") to the uri of the copy that was kept
+
+    Parameters:
+        - `source_dir` (str): E.g. the "media/stories" folder of the Instagram export
+        - `target_dir` (str): the folder the unique files are copied to
+        - `perceptual` (bool): also treat images with close perceptual hashes (re-encoded or resized copies) as duplicates
+        - `max_distance` (int): maximum number of differing bits between the perceptual hashes of duplicates
+        - `mode` (str): how the files are copied, see `common_utils.copy_files`
+        - `uri_root` (str): the folder the uris are relative to; found from `source_dir` when not given
+
+    Returns: the mapping from uri to canonical uri
+    """
+    paths = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        paths.extend(os.path.join(root, file) for file in sorted(files))
+    canonical = group_duplicates(paths, perceptual, max_distance, workers)
+
+    copies = []
+    for i, path in enumerate(paths):
+        if canonical[i] == i:
+            target_path = os.path.join(target_dir, os.path.relpath(path, source_dir))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            if not os.path.exists(target_path):
+                copies.append((path, target_path))
+    copy_all(copies, mode, workers)
+
+    uri_root = uri_root or find_uri_root(source_dir)
+    uris = [os.path.relpath(path, uri_root).replace(os.sep, "/") for path in paths]
+    mapping = {uri: uris[canonical[i]] for i, uri in enumerate(uris)}
+    num_unique = sum(1 for i in range(len(paths)) if canonical[i] == i)
+    with open(os.path.join(target_dir, MAPPING_FILENAME), 'w') as f:
+        json.dump({"num_files": len(paths), "num_unique": num_unique, "media": mapping}, f, indent=2)
+    print(f"{num_unique} unique files out of {len(paths)} saved to {target_dir}")
+    return mapping
+
+
+def load_media_mapping(path):
+    """
+    Returns the uri to canonical uri mapping written by `dedup_media`
+    """
+    with open(path, 'r') as f:
+        return json.load(f)["media"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store each distinct story media once and map every story uri to it")
+    parser.add_argument("source_dir", help="the media/stories folder of the Instagram export")
+    parser.add_argument("target_dir", help="the folder the unique files are copied to")
+    parser.add_argument("--perceptual", action="store_true",
+                        help="also treat re-encoded or resized copies of an image as duplicates")
+    parser.add_argument("--max-distance", type=int, default=4,
+                        help="maximum number of differing bits (out of 64) between the perceptual hashes of duplicates")
+    parser.add_argument("--mode", choices=COPY_MODES, default="copy")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source_dir):
+        print("Invalid path: " + str(args.source_dir))
+        sys.exit(1)
+    dedup_media(args.source_dir, args.target_dir, args.perceptual, args.max_distance, args.mode, args.workers)
@@ -1,9 +1,26 @@
+import os
+import re
 import json
+import gzip
 import sys
+import argparse
+from contextlib import ExitStack
+import numpy as np
+from common_utils import iter_json_array_items
+from to_heatmap import GeoJSONWriter
+from visit_table import VisitTable, INSTAGRAM
+
+# Keywords to keep in features
+DEFAULT_KEYWORDS = [
+    "park", "plaza", "church", "school", "community center",
+    "parking lot", "playground", "promenade", "boardwalk",
+    "mall", "garden", "beach", "strip", "overlook"
+]
 
 def load_json_file(filepath):
-    """ Load JSON data from a file. """
-    with open(filepath, 'r') as file:
+    """ Load JSON data from a file (gzipped if its name ends with .gz). """
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt') as file:
         return json.load(file)
 
 def save_json_file(data, filepath):
@@ -11,39 +28,175 @@ def save_json_file(data, filepath):
     with open(filepath, 'w') as file:
         json.dump(data, file, indent=4)
 
-def filter_features(features, keywords):
-    """ Filter features to include only those containing specified keywords in the name. """
-    filtered_features = []
-    for feature in features:
-        name = feature.get('properties', {}).get('name', '').lower()
-        if any(keyword in name for keyword in keywords):
-            filtered_features.append(feature)
-    return filtered_features
+class KeywordMatcher:
+    """
+    Classifies texts against several named keyword sets with a single compiled regular expression.
+
+    The expression is a lookahead trying every keyword, longest first, at each position of the text, so one scan finds
+    every keyword occurring in the text: a keyword hidden by a longer one starting at the same position (E.g. "park" in
+    "parking lot") is implied by the longer match.
+
+    Parameters:
+        - `keyword_sets` (dict): maps the name of each set to its list of keywords
+        - `word_boundary` (bool): only match keywords as whole words ("park" no longer matches "parking lot")
+    """
+
+    def __init__(self, keyword_sets, word_boundary=False):
+        self.word_boundary = word_boundary
+        sets_by_keyword = {}
+        for set_name, keywords in keyword_sets.items():
+            for keyword in keywords:
+                keyword = keyword.lower()
+                if keyword:
+                    sets_by_keyword.setdefault(keyword, set()).add(set_name)
+
+        keywords = sorted(sets_by_keyword, key=len, reverse=True)
+        self.pattern = None
+        if keywords:
+            alternatives = "|".join(re.escape(keyword) for keyword in keywords)
+            if word_boundary:
+                self.pattern = re.compile(rf"(?=\b({alternatives})\b)")
+            else:
+                self.pattern = re.compile(rf"(?=({alternatives}))")
+
+        # the sets matched by a keyword include those of every keyword it contains
+        self.sets_by_match = {}
+        for keyword in keywords:
+            matched_sets = set()
+            for other in keywords:
+                if len(other) <= len(keyword) and self._contains(keyword, other):
+                    matched_sets |= sets_by_keyword[other]
+            self.sets_by_match[keyword] = frozenset(matched_sets)
+
+    def _contains(self, text, keyword):
+        if self.word_boundary:
+            return re.search(rf"\b{re.escape(keyword)}\b", text) is not None
+        return keyword in text
+
+    def classify(self, text):
+        """
+        Returns the names of the keyword sets having a keyword in `text`
+        """
+        matched_sets = set()
+        if self.pattern is None or not text:
+            return matched_sets
+        for match in self.pattern.finditer(text.lower()):
+            matched_sets |= self.sets_by_match[match.group(1)]
+        return matched_sets
 
-def filter_locations(input_path, output_path, keywords=None):
-    # Load JSON data
-    data = load_json_file(input_path)
+    def classify_feature(self, feature, fields=("name",)):
+        """
+        Returns the names of the keyword sets having a keyword in any of the `fields` properties of a feature
+        """
+        properties = feature.get('properties') or {}
+        matched_sets = set()
+        for field in fields:
+            value = properties.get(field)
+            if isinstance(value, str):
+                matched_sets |= self.classify(value)
+        return matched_sets
 
-    # Keywords to keep in features
-    default_keywords = [
-        "park", "plaza", "church", "school", "community center",
-        "parking lot", "playground", "promenade", "boardwalk",
-        "mall", "garden", "beach", "strip", "overlook"
-    ]
-    default_keywords = [keyword.lower() for keyword in default_keywords]
+def filter_features(features, keywords, fields=("name",), word_boundary=False):
+    """ Filter features to include only those containing specified keywords in the name (or the other `fields`). """
+    matcher = KeywordMatcher({"keywords": keywords}, word_boundary)
+    return [feature for feature in features if matcher.classify_feature(feature, fields)]
 
-    # Filter features
-    filtered_data = data.copy()
-    filtered_data['features'] = filter_features(data['features'], default_keywords if keywords is None else keywords)
+def filter_locations_multi(input_path, output_paths, keyword_sets, fields=("name",), word_boundary=False, compact=False):
+    """
+    Classify every feature of a GeoJSON file against several keyword sets in one streaming pass and write one filtered GeoJSON file per set
 
-    # Save filtered JSON
-    save_json_file(filtered_data, output_path)
+    Parameters:
+        - `input_path` (str): path to the GeoJSON file (gzipped if its name ends with .gz)
+        - `output_paths` (dict): maps the name of each keyword set to the path of its output file
+        - `keyword_sets` (dict): maps the name of each keyword set to its list of keywords
+        - `fields` (tuple): the properties searched for keywords (E.g. ("name", "address"))
+        - `word_boundary` (bool): only match keywords as whole words
+        - `compact` (bool): write the outputs without whitespace
 
-    print(f"Filtered GeoJson file has been saved to {output_path}")
+    Returns: a dict mapping the name of each keyword set to the number of features written
+    """
+    if input_path.endswith('.npz'):
+        return filter_visit_table(VisitTable.load(input_path), output_paths, keyword_sets, fields, word_boundary, compact)
+    matcher = KeywordMatcher(keyword_sets, word_boundary)
+    # every output is deleted (see GeoJSONWriter.abort) if the input cannot be read to the end
+    with ExitStack() as stack:
+        writers = {set_name: stack.enter_context(GeoJSONWriter(output_paths[set_name], compact)) for set_name in keyword_sets}
+        for feature in iter_json_array_items(input_path, 'features'):
+            for set_name in matcher.classify_feature(feature, fields):
+                writers[set_name].write(feature)
+
+    for set_name, writer in writers.items():
+        print(f"Filtered GeoJson file with {writer.count} features has been saved to {writer.output_path}")
+    return {set_name: writer.count for set_name, writer in writers.items()}
+
+def filter_visit_table(table, output_paths, keyword_sets, fields=("name",), word_boundary=False, compact=False, precision=None):
+    """
+    Same as `filter_locations_multi` for the visits of a VisitTable (E.g. a visits store written by main.py): each
+    distinct name or address is classified once instead of once per visit, and only the matching rows are converted to GeoJSON
+
+    Returns: a dict mapping the name of each keyword set to the number of features written
+    """
+    matcher = KeywordMatcher(keyword_sets, word_boundary)
+    set_names = list(keyword_sets)
+    # matches[code, i]: whether the string of `code` has a keyword of the i-th set; the extra last row is for MISSING
+    string_matches = np.zeros((len(table.strings) + 1, len(set_names)), dtype=bool)
+    for code, string in enumerate(table.strings):
+        for set_name in matcher.classify(string):
+            string_matches[code, set_names.index(set_name)] = True
+    row_matches = np.zeros((len(table), len(set_names)), dtype=bool)
+    for field in fields:
+        row_matches |= string_matches[table[field]]
+    # story points keep their own properties
+    for row in np.flatnonzero(table["source"] == INSTAGRAM).tolist():
+        for set_name in matcher.classify_feature({"properties": table.extras[row][1]}, fields):
+            row_matches[row, set_names.index(set_name)] = True
+
+    counts = {}
+    for i, set_name in enumerate(set_names):
+        with GeoJSONWriter(output_paths[set_name], compact, precision) as writer:
+            for feature in table.iter_features(np.flatnonzero(row_matches[:, i])):
+                writer.write(feature)
+        print(f"Filtered GeoJson file with {writer.count} features has been saved to {writer.output_path}")
+        counts[set_name] = writer.count
+    return counts
+
+def filter_locations(input_path, output_path, keywords=None, fields=("name",), word_boundary=False, compact=False):
+    keywords = DEFAULT_KEYWORDS if keywords is None else keywords
+    filter_locations_multi(input_path, {"keywords": output_path}, {"keywords": keywords},
+                           fields, word_boundary, compact)
+
+def parse_keyword_set(value):
+    """
+    Parse a "name=keyword1,keyword2" command line argument
+    """
+    if "=" not in value:
+        raise argparse.ArgumentTypeError(f"Expected name=keyword1,keyword2: {value}")
+    set_name, keywords = value.split("=", 1)
+    return set_name, [keyword.strip() for keyword in keywords.split(",") if keyword.strip()]
 
 if __name__ == "__main__":
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Filter the features of a GeoJSON file on keywords")
+    parser.add_argument("input_path", help="path to the GeoJSON file, or to the visits store (.npz) written by main.py --output-format visits")
+    parser.add_argument("output_path", help="path to the output file, or the output folder when keyword sets are given")
+    parser.add_argument("--set", dest="keyword_sets", action="append", type=parse_keyword_set, default=[],
+                        help="a named keyword set written to <output_path>/<name>.json, E.g. --set parks=park,garden (repeatable)")
+    parser.add_argument("--sets-file", default=None,
+                        help="JSON file mapping the name of each keyword set to its list of keywords")
+    parser.add_argument("--field", dest="fields", action="append", choices=["name", "address"], default=None,
+                        help="property searched for keywords (repeatable, name by default)")
+    parser.add_argument("--word-boundary", action="store_true", help="only match keywords as whole words")
+    parser.add_argument("--compact", action="store_true", help="write the outputs without whitespace")
+    args = parser.parse_args()
+    fields = tuple(args.fields or ["name"])
+
+    keyword_sets = dict(args.keyword_sets)
+    if args.sets_file is not None:
+        keyword_sets.update(load_json_file(args.sets_file))
 
-    keywords = input("List of keywords: ").split()
-    filter_locations(input_dir, output_dir, keywords)
\ No newline at end of file
+    if keyword_sets:
+        os.makedirs(args.output_path, exist_ok=True)
+        output_paths = {set_name: os.path.join(args.output_path, set_name + ".json") for set_name in keyword_sets}
+        filter_locations_multi(args.input_path, output_paths, keyword_sets, fields, args.word_boundary, args.compact)
+    else:
+        keywords = input("List of keywords: ").split()
+        filter_locations(args.input_path, args.output_path, keywords, fields, args.word_boundary, args.compact)
@@ -2,8 +2,14 @@ import json
 import sys
 import os
 from common_utils import convert_to_timestamp
+from timestamps import UTC, MISSING_TIME, TimestampParser, parse_epoch_array
 from geojson import Point
 import datetime
+import bisect
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
 
 
 def is_unix_timestamp(timestamp_str):
@@ -46,6 +52,11 @@ def extract_stories_with_exif_data(path_to_stories_data):
         except json.JSONDecodeError:
             print(f"Error parsing JSON in file: {path_to_stories_data}")
 
+    with metrics.stage("extract_stories", len(stories_data["ig_stories"])):
+        return _extract_stories_info(stories_data)
+
+
+def _extract_stories_info(stories_data):
     stories_info = []
     for story in stories_data["ig_stories"]:
         story_data = {}
@@ -86,15 +97,38 @@ def extract_media_path(media_path):
         print("The input string does not contain 'media/stories'")
 
 
-def create_story_point(stories_info, input_path, google_data_path, buffer_hours=0):
+def story_image_url(input_path, uri, media_mapping=None):
+    """
+    Returns the url of a story image on the local static server. With the `media_mapping` of dedup_media.py, duplicates
+    of an image point at the single copy that was kept.
+    """
+    if media_mapping is not None:
+        uri = media_mapping.get(uri, uri)
+    return "http://localhost:3000/" + extract_participant_name(input_path) + "/" + uri.split("/")[-1]
+
+
+def create_story_point(stories_info, input_path, google_data_path, buffer_hours=0, media_mapping=None, history_store=None):
     """
     Parameters: 
         - `stories_info` (list): a list of extracted exif data from the Instagram stories
+        - `input_path` (str): path to the stories.json file
+        - `google_data_path` (str): path to the Semantic-Location-History folder, indexed once for stories without coordinates
+        - `buffer_hours` (int): number of hours each place visit is extended on both sides when matching
+        - `media_mapping` (dict): the uri to canonical uri mapping written by dedup_media.py, if the images were deduplicated
+        - `history_store` (HistoryStore): if given, the stories are matched against this store of the history instead of parsing the folder
 
     Returns:
         - `points` (list): a list of geojson Points each of which contains the geojson data of where the image used in that story was taken along with the timestamp and corresponding url to the image
+
+    The "story_matching" stage of the run metrics includes the "timeline_index" stage building the index.
     """
+    with metrics.stage("story_matching", len(stories_info)):
+        return _create_story_points(stories_info, input_path, google_data_path, buffer_hours, media_mapping, history_store)
+
+
+def _create_story_points(stories_info, input_path, google_data_path, buffer_hours, media_mapping, history_store):
     points = []
+    timeline_index = None
     for story_info in stories_info:
         properties = {}
         if "longitude" in story_info and "latitude" in story_info:
@@ -103,15 +137,15 @@ def create_story_point(stories_info, input_path, google_data_path, buffer_hours=
             if story_info["url"].lower().endswith("jpg"):
                 properties["has_url"] = True
             if "datetime_original" in story_info:
-                if is_unix_timestamp(story_info["datetime_original"]) == False:
-                    timestamp = convert_to_timestamp(story_info["datetime_original"])
-                properties["timestamp"] = timestamp
-                properties["datetime"] = str(datetime.datetime.fromtimestamp(timestamp))
+                timestamp = convert_to_timestamp(story_info["datetime_original"])
+                if timestamp is not None:
+                    properties["timestamp"] = timestamp
+                    properties["datetime"] = str(datetime.datetime.fromtimestamp(timestamp))
             if str(extract_media_path(story_info["url"])).endswith(".jpg"):
                 properties["relative_url"] = story_info["url"]
                 if story_info["url"].startswith("media/stories/"):
                     properties["has_image"] = True
-                    url = "http://localhost:3000/" + extract_participant_name(input_path) + "/" + story_info["url"].split("/")[-1]
+                    url = story_image_url(input_path, story_info["url"], media_mapping)
                     properties["url"] = url
                     properties["<img>_tooltip"] = url
             point_and_properties = (
@@ -120,7 +154,11 @@ def create_story_point(stories_info, input_path, google_data_path, buffer_hours=
             )
             points.append(point_and_properties)
         else:
-            result = find_matching_place_visit_coordinates(story_info, google_data_path, buffer_hours)
+            if timeline_index is None and history_store is not None:
+                timeline_index = TimelineIndex.from_store(history_store)
+            elif timeline_index is None:
+                timeline_index = TimelineIndex.from_directory(google_data_path)
+            result = find_matching_place_visit_coordinates(story_info, google_data_path, buffer_hours, timeline_index)
             if result == False:
                 pass
             else:
@@ -128,81 +166,198 @@ def create_story_point(stories_info, input_path, google_data_path, buffer_hours=
                     properties["has_image"] = True
                     properties["longitude"] = result[1]/ 10e6
                     properties["latitude"] = result[0]/ 10e6
-                    url = "http://localhost:3000/" + extract_participant_name(input_path) + "/" + story_info["url"].split("/")[-1]
+                    url = story_image_url(input_path, story_info["url"], media_mapping)
                     properties["url"] = url
                     properties["<img>_tooltip"] = url
                     point_and_properties = (Point((properties["longitude"], properties["latitude"])), properties)
                     points.append(point_and_properties)
     return points
 
-def find_matching_place_visit_coordinates(story_info, path, buffer_hours):
-    timestamp_str = story_info.get('datetime_original') or story_info.get('datetime_story')
-    if not timestamp_str:
-        print("Error: No valid timestamp found.")
-        return None
+class TimelineIndex:
+    """
+    Interval index over the placeVisit/activitySegment durations of a participant's
+    Semantic Location History, built once and queried for every story.
 
-    creation_time = None
-    if timestamp_str.isdigit():
-        creation_time = datetime.datetime.fromtimestamp(int(timestamp_str))
-    elif is_iso_timestamp(timestamp_str):
-        creation_time = datetime.datetime.fromisoformat(timestamp_str.rstrip('Z'))
-    else:
-        try:
-            creation_time = datetime.datetime.strptime(timestamp_str, "%Y:%m:%d %H:%M:%S")
-        except ValueError:
-            print("Error: Timestamp format is not recognized.")
-            return None
+    Intervals are kept sorted by start time (in microseconds since the epoch, parsed by
+    `timestamps.parse_epoch_array` with naive timestamps taken as UTC) together with their
+    E7 coordinates, so a lookup only inspects the intervals whose start falls in a bisected
+    window. Intervals without a parseable start or end time are left out of the index.
+    """
 
-    def check_timestamp_in_place_visit(creation_time, timeline_objects, buffer_hours):
-        buffer_delta = datetime.timedelta(hours=buffer_hours)
-        closest_location = None
-        closest_time_difference = datetime.timedelta.max
+    _EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.locations = []
+        self.max_span = 0
+
+    @classmethod
+    def to_micros(cls, dt):
+        """
+        Return the number of microseconds between `dt` and the epoch. Naive datetimes are taken as UTC like the
+        timestamps of the timeline.
+        """
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(UTC).replace(tzinfo=None)
+        return (dt - cls._EPOCH) // datetime.timedelta(microseconds=1)
+
+    @classmethod
+    def from_directory(cls, path):
+        """
+        Build the index from every JSON file under the Semantic-Location-History folder
+
+        Parameters:
+            - `path` (str): path to the Semantic-Location-History folder
+        """
+        with metrics.stage("timeline_index") as stage:
+            intervals = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    # hidden files are not monthly files (E.g. the .validator_cache.json of earlier versions)
+                    if file.endswith('.json') and not file.startswith('.'):
+                        with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                            place_visit_json = json.load(f)
+                        intervals.extend(cls.extract_intervals(place_visit_json))
+            stage["items"] = len(intervals)
+            return cls.from_intervals(intervals)
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Build the index from the timed rows of a HistoryStore (see history_store.py), already sorted by start time
+
+        Parameters:
+            - `store` (HistoryStore): the store of the participant's history
+        """
+        with metrics.stage("timeline_index") as stage:
+            index = cls()
+            rows = store.timed
+            index.starts = store["start"][rows].tolist()
+            index.ends = store["end"][rows].tolist()
+            index.locations = list(zip(store["lat_e7"][rows].tolist(), store["lon_e7"][rows].tolist()))
+            index.max_span = store.max_span
+            stage["items"] = len(index.starts)
+            return index
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """
+        Build the index from a list of (start_micros, end_micros, (latitudeE7, longitudeE7)) tuples
+        """
+        index = cls()
+        # a stable sort keeps the file order for intervals starting at the same time
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        for start, end, location in intervals:
+            index.starts.append(start)
+            index.ends.append(end)
+            index.locations.append(location)
+            index.max_span = max(index.max_span, end - start)
+        return index
 
+    @classmethod
+    def extract_intervals(cls, timeline_objects):
+        """
+        Return the (start, end, location) intervals of one monthly timeline file
+
+        Parameters:
+            - `timeline_objects` (dict): the parsed monthly file containing `timelineObjects`
+        """
         if 'timelineObjects' not in timeline_objects:
             print("no timelineObjects")
 
+        start_timestamps = []
+        end_timestamps = []
+        locations = []
         for timeline_object in timeline_objects.get('timelineObjects', []):
             if "placeVisit" in timeline_object:
-                duration = timeline_object['placeVisit']['duration']
-                start_timestamp = datetime.datetime.fromisoformat(duration['startTimestamp'].rstrip('Z')) - buffer_delta
-                end_timestamp = datetime.datetime.fromisoformat(duration['endTimestamp'].rstrip('Z')) + buffer_delta
-                if start_timestamp <= creation_time <= end_timestamp:
-                    time_difference = min(abs(creation_time - start_timestamp), abs(creation_time - end_timestamp))
-                    if time_difference < closest_time_difference:
-                        closest_time_difference = time_difference
-                        location = timeline_object['placeVisit']['location']
-                        closest_location = (location['latitudeE7'], location['longitudeE7'])
-
+                place_visit = timeline_object['placeVisit']
+                start_timestamps.append(place_visit['duration']['startTimestamp'])
+                end_timestamps.append(place_visit['duration']['endTimestamp'])
+                locations.append((place_visit['location']['latitudeE7'], place_visit['location']['longitudeE7']))
             if "activitySegment" in timeline_object:
                 activity = timeline_object["activitySegment"]
-                if "duration" in activity:
-                    duration = activity['duration']
-                    start_timestamp = datetime.datetime.fromisoformat(duration['startTimestamp'].rstrip('Z')) - buffer_delta
-                    end_timestamp = datetime.datetime.fromisoformat(duration['endTimestamp'].rstrip('Z')) + buffer_delta
-                    if start_timestamp <= creation_time <= end_timestamp:
-                        time_difference = min(abs(creation_time - start_timestamp), abs(creation_time - end_timestamp))
-                        if time_difference < closest_time_difference:
-                            closest_time_difference = time_difference
-                            location = activity["startLocation"]
-                            closest_location = (location['latitudeE7'], location['longitudeE7'])
+                if "duration" in activity and "startLocation" in activity:
+                    start_timestamps.append(activity['duration']['startTimestamp'])
+                    end_timestamps.append(activity['duration']['endTimestamp'])
+                    locations.append((activity["startLocation"]['latitudeE7'], activity["startLocation"]['longitudeE7']))
+        # the timestamps of a month are parsed in one vectorized call
+        starts = parse_epoch_array(start_timestamps, unit="us").tolist()
+        ends = parse_epoch_array(end_timestamps, unit="us").tolist()
+        # an empty or unparseable timestamp (MISSING_TIME) would make `max_span` cover the whole index
+        return [(start, end, location) for start, end, location in zip(starts, ends, locations)
+                if start != MISSING_TIME and end != MISSING_TIME]
+
+    def find(self, creation_time, buffer_hours=0):
+        """
+        Return the (latitudeE7, longitudeE7) of the interval containing `creation_time`
+        whose (buffered) boundary is the closest, or None if no interval matches
+
+        Parameters:
+            - `creation_time` (datetime): the time the story was created
+            - `buffer_hours` (int): number of hours each interval is extended on both sides
+        """
+        time = self.to_micros(creation_time)
+        buffer = buffer_hours * 3600 * 10 ** 6
+        lo = bisect.bisect_left(self.starts, time - buffer - self.max_span)
+        hi = bisect.bisect_right(self.starts, time + buffer)
+
+        closest_location = None
+        closest_time_difference = None
+        for i in range(lo, hi):
+            end = self.ends[i] + buffer
+            if time <= end:
+                time_difference = min(time - (self.starts[i] - buffer), end - time)
+                if closest_time_difference is None or time_difference < closest_time_difference:
+                    closest_time_difference = time_difference
+                    closest_location = self.locations[i]
 
         if closest_location is not None:
-            print("Found a matching location with time difference: " + str(closest_time_difference))
+            logger.debug("Found a matching location with time difference: %s", datetime.timedelta(microseconds=closest_time_difference))
 
         return closest_location
 
-    
-    # Traverse the directory structure
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.endswith('.json'):
-                with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
-                    place_visit_json = json.load(f)
-                    result = check_timestamp_in_place_visit(creation_time, place_visit_json, buffer_hours)
-                    if result:
-                        return result
-    
-    return False
 
+# remembers the format of the "datetime_original" and "datetime_story" fields after their first story
+_story_time_parser = TimestampParser()
 
 
+def parse_story_time(story_info):
+    """
+    Return the creation time of a story as a datetime, or None if it cannot be parsed
+    """
+    source = 'datetime_original' if story_info.get('datetime_original') else 'datetime_story'
+    timestamp_str = story_info.get(source)
+    if not timestamp_str:
+        print("Error: No valid timestamp found.")
+        return None
+
+    creation_time = _story_time_parser.parse(timestamp_str, source)
+    if creation_time is None:
+        print("Error: Timestamp format is not recognized.")
+    return creation_time
+
+
+def find_matching_place_visit_coordinates(story_info, path, buffer_hours, timeline_index=None):
+    """
+    Return the (latitudeE7, longitudeE7) of the place visit or activity segment matching
+    the story's creation time, or False if there is no match
+
+    Parameters:
+        - `story_info` (dict): extracted exif data of a story
+        - `path` (str): path to the Semantic-Location-History folder
+        - `buffer_hours` (int): number of hours each interval is extended on both sides
+        - `timeline_index` (TimelineIndex): a prebuilt index; built from `path` when not given
+    """
+    creation_time = parse_story_time(story_info)
+    if creation_time is None:
+        return None
+
+    if timeline_index is None:
+        timeline_index = TimelineIndex.from_directory(path)
+
+    result = timeline_index.find(creation_time, buffer_hours)
+    if result:
+        return result
+    return False
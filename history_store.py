@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import argparse
+import datetime
+import numpy as np
+from common_utils import find_month_files, iter_timeline_objects, month_code, parallel_map
+from run_manifest import file_fingerprint
+from timestamps import UTC, MISSING_TIME, parse_datetime, parse_epoch_array
+from to_heatmap import GeoJSONWriter, add_geojson_arguments
+import metrics
+
+PLACE_VISIT = 0
+ACTIVITY_SEGMENT = 1
+KINDS = {PLACE_VISIT: "placeVisit", ACTIVITY_SEGMENT: "activitySegment"}
+
+MISSING = -1
+
+
+def month_history_columns(month_file):
+    """
+    Returns the columns of the place visits and activity segments of one monthly file, in file order. Run in a worker
+    process when the store is built with `workers`.
+
+    Parameters:
+        - `month_file` (tuple): a (subfolder, filename, file_path) tuple as returned by `find_month_files`
+
+    Returns: a dict of the numeric columns as NumPy arrays and of the string columns as lists (None when missing)
+    """
+    subfolder, filename, file_path = month_file
+    starts, ends, lat_e7, lon_e7, kinds = [], [], [], [], []
+    strings = {column: [] for column in HistoryStore.STRING_COLUMNS}
+    with metrics.stage("history_parse") as stage:
+        for timeline_object in iter_timeline_objects(file_path):
+            if "placeVisit" in timeline_object:
+                place_visit = timeline_object["placeVisit"]
+                location = place_visit.get("location", {})
+                if "latitudeE7" not in location or "longitudeE7" not in location:
+                    continue
+                duration = place_visit.get("duration", {})
+                kinds.append(PLACE_VISIT)
+                strings["place_id"].append(location.get("placeId"))
+                strings["semantic_type"].append(location.get("semanticType"))
+                strings["name"].append(location.get("name"))
+                strings["address"].append(location.get("address"))
+                strings["activity_type"].append(None)
+            elif "activitySegment" in timeline_object:
+                activity = timeline_object["activitySegment"]
+                location = activity.get("startLocation", {})
+                if "duration" not in activity or "latitudeE7" not in location or "longitudeE7" not in location:
+                    continue
+                duration = activity["duration"]
+                kinds.append(ACTIVITY_SEGMENT)
+                strings["place_id"].append(location.get("placeId"))
+                strings["semantic_type"].append(location.get("semanticType"))
+                strings["name"].append(None)
+                strings["address"].append(None)
+                strings["activity_type"].append(activity.get("activityType"))
+            else:
+                continue
+            starts.append(duration.get("startTimestamp"))
+            ends.append(duration.get("endTimestamp"))
+            lat_e7.append(location["latitudeE7"])
+            lon_e7.append(location["longitudeE7"])
+        stage["items"] = len(kinds)
+    columns = {
+        # the timestamps of a month are parsed in one vectorized call
+        "start": parse_epoch_array(starts, unit="us"),
+        "end": parse_epoch_array(ends, unit="us"),
+        "lat_e7": np.array(lat_e7, dtype=np.int32),
+        "lon_e7": np.array(lon_e7, dtype=np.int32),
+        "kind": np.array(kinds, dtype=np.int8),
+        "month": np.full(len(kinds), month_code(filename), dtype=np.int32),
+    }
+    columns.update(strings)
+    return columns
+
+
+class HistoryStore:
+    """
+    Columnar store of the place visits and activity segments of a participant's Semantic Location History, written
+    once under a folder by `build` and opened with memory mapping, so a query only reads the pages of the rows it returns.
+
+    Every column is a fixed-width .npy file: int64 start/end epochs in microseconds (MISSING_TIME when missing),
+    int32 E7 coordinates (the start location of activity segments), the kind of each row (PLACE_VISIT or
+    ACTIVITY_SEGMENT), the month of its file (E.g. 202001) and int32 codes into a string table (MISSING when missing)
+    for the placeId, semantic type, name, address and activity type. Rows are sorted by start time, with the file order
+    kept for rows starting at the same time, so time ranges are found by binary search (see `query`).
+
+    The store holds the raw, not anonymized, history: keep it with the input data (E.g. in the .cache folder of the
+    participant's output), never with the anonymized outputs.
+
+    Parameters:
+        - `path` (str): the folder of the store
+    """
+
+    FORMAT_VERSION = 1
+    META_FILENAME = "meta.json"
+    COLUMNS = {"start": np.int64, "end": np.int64, "lat_e7": np.int32, "lon_e7": np.int32, "kind": np.int8,
+               "month": np.int32, "place_id": np.int32, "semantic_type": np.int32, "name": np.int32,
+               "address": np.int32, "activity_type": np.int32}
+    STRING_COLUMNS = ("place_id", "semantic_type", "name", "address", "activity_type")
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.META_FILENAME), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != self.FORMAT_VERSION:
+            raise ValueError(f"{path} is not a history store of format {self.FORMAT_VERSION}")
+        self.strings = self.meta["strings"]
+        # the rows with a start and an end time, and the longest of their durations
+        self.timed = slice(self.meta["first_timed_row"], self.meta["num_rows"])
+        self.max_span = self.meta["max_span"]
+        self.columns = {}
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def __getitem__(self, column):
+        """
+        Returns a column as a read-only memory-mapped NumPy array, opened on first use
+        """
+        if column not in self.columns:
+            array = np.load(os.path.join(self.path, column + ".npy"), mmap_mode='r')
+            # NumPy cannot memory-map an empty file
+            self.columns[column] = array if array.size else np.zeros(0, dtype=self.COLUMNS[column])
+        return self.columns[column]
+
+    def string(self, code):
+        return None if code == MISSING else self.strings[code]
+
+    @classmethod
+    def is_store(cls, path):
+        return os.path.isfile(os.path.join(path, cls.META_FILENAME))
+
+    @classmethod
+    def build(cls, input_dir, path, workers=None):
+        """
+        Write the store of every monthly file of a Semantic-Location-History folder, replacing the store at `path`
+
+        Parameters:
+            - `input_dir` (str): path to the Semantic-Location-History folder
+            - `path` (str): the folder of the store
+            - `workers` (int): number of processes the monthly files are parsed in
+
+        Returns: the opened HistoryStore
+        """
+        month_files = find_month_files(input_dir)
+        month_columns = parallel_map(month_history_columns, month_files, workers)
+        with metrics.stage("history_store") as stage:
+            strings = []
+            string_codes = {}
+
+            def intern(string):
+                if string is None:
+                    return MISSING
+                code = string_codes.get(string)
+                if code is None:
+                    code = string_codes[string] = len(strings)
+                    strings.append(string)
+                return code
+
+            columns = {}
+            for column, dtype in cls.COLUMNS.items():
+                if column in cls.STRING_COLUMNS:
+                    codes = [intern(string) for month in month_columns for string in month[column]]
+                    columns[column] = np.array(codes, dtype=dtype)
+                else:
+                    columns[column] = np.concatenate([np.zeros(0, dtype=dtype)] + [month[column] for month in month_columns])
+            # a stable sort keeps the file order for rows starting at the same time; rows without a start come first
+            order = np.argsort(columns["start"], kind="stable")
+            timed = (columns["start"] != MISSING_TIME) & (columns["end"] != MISSING_TIME)
+            # rows without an end are moved right after the ones without a start, so the timed rows are contiguous
+            order = np.concatenate([order[~timed[order]], order[timed[order]]])
+            num_rows = len(order)
+            first_timed_row = int(num_rows - timed.sum())
+            spans = columns["end"][order[first_timed_row:]] - columns["start"][order[first_timed_row:]]
+
+            meta_path = os.path.join(path, cls.META_FILENAME)
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            for column, values in columns.items():
+                np.save(os.path.join(path, column + ".npy"), values[order])
+            meta = {
+                "version": cls.FORMAT_VERSION,
+                "num_rows": num_rows,
+                "first_timed_row": first_timed_row,
+                "max_span": int(spans.max()) if len(spans) else 0,
+                "strings": strings,
+                "sources": {subfolder + "/" + filename: file_fingerprint(file_path)
+                            for subfolder, filename, file_path in month_files},
+            }
+            # the metadata is written last, a store interrupted while being written is rebuilt by `open_or_build`
+            with open(meta_path + ".tmp", 'w') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+            stage["items"] = num_rows
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, input_dir, path, workers=None):
+        """
+        Open the store of a Semantic-Location-History folder, (re)building it first if it does not exist yet or if a
+        monthly file was added, removed or changed since it was written
+
+        Returns: the opened HistoryStore
+        """
+        if cls.is_store(path):
+            try:
+                store = cls(path)
+            except (ValueError, KeyError, json.JSONDecodeError):
+                store = None
+            if store is not None and store.is_current(input_dir):
+                return store
+            print("Updating the history store at " + path)
+        else:
+            print("Building the history store at " + path)
+        return cls.build(input_dir, path, workers)
+
+    def is_current(self, input_dir):
+        """
+        Returns whether the store was built from the current monthly files of `input_dir`
+        """
+        sources = self.meta["sources"]
+        month_files = find_month_files(input_dir)
+        if len(month_files) != len(sources):
+            return False
+        for subfolder, filename, file_path in month_files:
+            previous = sources.get(subfolder + "/" + filename)
+            if previous is None or file_fingerprint(file_path, previous)["sha256"] != previous["sha256"]:
+                return False
+        return True
+
+    @staticmethod
+    def to_micros(time):
+        """
+        Returns a datetime (naive datetimes are taken as UTC like the timestamps of the timeline) or an epoch in
+        microseconds as an epoch in microseconds
+        """
+        if isinstance(time, datetime.datetime):
+            if time.tzinfo is not None:
+                time = time.astimezone(UTC).replace(tzinfo=None)
+            return (time - datetime.datetime(1970, 1, 1)) // datetime.timedelta(microseconds=1)
+        return int(time)
+
+    def starting_between(self, start, end):
+        """
+        Returns the slice of the rows starting in [`start`, `end`), found by binary search
+
+        Parameters:
+            - `start`, `end` (datetime or int): the time range, as datetimes or epochs in microseconds
+        """
+        starts = self["start"][self.timed]
+        lo = int(np.searchsorted(starts, self.to_micros(start), side="left"))
+        hi = int(np.searchsorted(starts, self.to_micros(end), side="left"))
+        return slice(self.timed.start + lo, self.timed.start + hi)
+
+    def query(self, start, end, kinds=None):
+        """
+        Returns the rows of the visits and activity segments overlapping [`start`, `end`]. Only the rows that may
+        overlap the range (those starting in it or at most the longest duration before it) are read.
+
+        Parameters:
+            - `start`, `end` (datetime or int): the time range, as datetimes or epochs in microseconds
+            - `kinds` (iterable): the kinds of rows to return (PLACE_VISIT and/or ACTIVITY_SEGMENT); every kind when None
+
+        Returns: a dict of every column restricted to the matching rows, in start time order
+        """
+        start, end = self.to_micros(start), self.to_micros(end)
+        window = self.starting_between(start - self.max_span, end + 1)
+        overlapping = self["end"][window] >= start
+        if kinds is not None:
+            overlapping &= np.isin(self["kind"][window], list(kinds))
+        return {column: np.asarray(self[column][window])[overlapping] for column in self.COLUMNS}
+
+    def iter_features(self, rows):
+        """
+        Yields the rows returned by `query` as GeoJSON Feature dicts with their kind, times, names and types
+        """
+        strings = self.strings
+        for i in range(len(rows["start"])):
+            properties = {"kind": KINDS[int(rows["kind"][i])]}
+            for column in self.STRING_COLUMNS:
+                code = int(rows[column][i])
+                if code != MISSING:
+                    properties[column] = strings[code]
+            properties["start"] = int(rows["start"][i]) // 10 ** 6
+            properties["end"] = int(rows["end"][i]) // 10 ** 6
+            longitude, latitude = int(rows["lon_e7"][i]) / 10e6, int(rows["lat_e7"][i]) / 10e6
+            properties["longitude"] = longitude
+            properties["latitude"] = latitude
+            yield {"type": "Feature", "properties": properties,
+                   "geometry": {"type": "Point", "coordinates": [round(longitude, 6), round(latitude, 6)]}}
+
+
+def parse_query_time(time_str):
+    """
+    Returns a datetime from an ISO 8601 date or timestamp (naive ones are taken as UTC), or a UNIX timestamp
+    """
+    dt = parse_datetime(time_str)
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=UTC)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a memory-mapped store of a participant's location history, or "
+                                                 "export the visits and activity segments of a time range from it")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="write (or update) the store of a Semantic-Location-History folder")
+    build_parser.add_argument("input_dir", help="path to the Semantic-Location-History folder")
+    build_parser.add_argument("store_dir", help="folder of the store")
+    build_parser.add_argument("--workers", type=int, default=None,
+                              help="number of processes the monthly files are parsed in")
+    build_parser.add_argument("--force", action="store_true", help="rebuild the store even if it is up to date")
+    query_parser = subparsers.add_parser("query", help="export the rows overlapping a time range as GeoJSON")
+    query_parser.add_argument("store_dir", help="folder of the store")
+    query_parser.add_argument("start", help="start of the range (E.g. 2020-01-01 or 2020-01-01T08:00:00Z)")
+    query_parser.add_argument("end", help="end of the range")
+    query_parser.add_argument("output_file", help="path to the GeoJSON file; the locations are NOT anonymized")
+    query_parser.add_argument("--kind", choices=list(KINDS.values()), default=None,
+                              help="only export the place visits or the activity segments")
+    add_geojson_arguments(query_parser)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if not os.path.isdir(args.input_dir):
+            print("Invalid path: " + str(args.input_dir))
+            sys.exit(1)
+        if args.force:
+            store = HistoryStore.build(args.input_dir, args.store_dir, args.workers)
+        else:
+            store = HistoryStore.open_or_build(args.input_dir, args.store_dir, args.workers)
+        print(f"History store with {len(store)} rows and {len(store.strings)} strings saved at {args.store_dir}")
+    else:
+        if not HistoryStore.is_store(args.store_dir):
+            print("Invalid path: " + str(args.store_dir))
+            sys.exit(1)
+        store = HistoryStore(args.store_dir)
+        kinds = None if args.kind is None else [kind for kind, name in KINDS.items() if name == args.kind]
+        rows = store.query(parse_query_time(args.start), parse_query_time(args.end), kinds)
+        output_file = args.output_file + (".gz" if args.gzip and not args.output_file.endswith(".gz") else "")
+        with GeoJSONWriter(output_file, args.compact, args.precision, args.gzip) as writer:
+            for feature in store.iter_features(rows):
+                writer.write(feature)
+        print(f"{writer.count} visits and activity segments saved to {output_file}")
@@ -0,0 +1,151 @@
+import os
+import time
+import random
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of requests sent to one provider
+
+    Parameters:
+        - `rate` (float): number of requests allowed per second; None or 0 disables the limit
+        - `capacity` (int): number of requests that can be sent in a burst
+    """
+
+    def __init__(self, rate=None, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RetryableError(Exception):
+    """
+    Raised by a call wrapped in `call_with_retry` to ask for another attempt
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def make_session(pool_size=10):
+    """
+    Returns a `requests.Session` keeping up to `pool_size` connections alive per host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def call_with_retry(func, rate_limiter=None, retries=4, backoff=1.0, retry_on=(RetryableError, requests.ConnectionError, requests.Timeout)):
+    """
+    Returns `func()`, calling it again with exponential backoff (and jitter) when it raises one of `retry_on`
+
+    Parameters:
+        - `func`: the call to make
+        - `rate_limiter` (TokenBucket): acquired before every attempt
+        - `retries` (int): number of additional attempts
+        - `backoff` (float): delay in seconds before the first retry, doubled after every attempt
+    """
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            if getattr(e, "retry_after", None) is not None:
+                delay = max(delay, e.retry_after)
+            time.sleep(delay + random.uniform(0, backoff / 2))
+
+
+def request(session, method, url, rate_limiter=None, retries=4, backoff=1.0, timeout=60, **kwargs):
+    """
+    Send a request through `session`, retrying with backoff on connection errors, 429 and 5xx responses
+
+    Parameters:
+        - `session` (requests.Session): the pooled session
+        - `rate_limiter` (TokenBucket): the limiter of the provider
+        - `timeout` (float): timeout in seconds of every attempt
+        - `kwargs`: passed to `session.request`; file objects in `files` are rewound before each attempt
+
+    Returns: the last `requests.Response`
+    """
+    def send():
+        for file_tuple in kwargs.get("files") or []:
+            file_obj = file_tuple[1][1]
+            if hasattr(file_obj, "seek"):
+                file_obj.seek(0)
+        response = session.request(method, url, timeout=timeout, **kwargs)
+        if response.status_code in RETRY_STATUS_CODES:
+            retry_after = response.headers.get("Retry-After")
+            response.close()
+            raise RetryableError(f"HTTP status code {response.status_code} from {url}",
+                                 float(retry_after) if retry_after and retry_after.isdigit() else None)
+        return response
+
+    return call_with_retry(send, rate_limiter, retries, backoff)
+
+
+def download_to_file(session, url, save_path, rate_limiter=None, chunk_size=1 << 16, **kwargs):
+    """
+    Stream the body of `url` to `save_path` without holding it in memory. The file only appears once the download is complete.
+
+    Returns: True if the file has been saved
+    """
+    response = request(session, "GET", url, rate_limiter, stream=True, **kwargs)
+    with response:
+        if response.status_code != 200:
+            print("Failed to download image: HTTP status code", response.status_code)
+            return False
+        tmp_path = save_path + ".part"
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+        except BaseException:
+            # E.g. the connection dropped in the middle of the body
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, save_path)
+    return True
+
+
+def run_concurrently(func, items, concurrency=1):
+    """
+    Returns the results of `func` applied to every item using `concurrency` threads, in the order of `items`
+    """
+    if concurrency <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(func, items))
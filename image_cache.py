@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+
+# once full, the cache is trimmed to this fraction of its maximum size so that the following puts do not evict again
+LOW_WATER_MARK = 0.9
+
+
+class ImageCache:
+    """
+    Persistent on-disk cache of processed images, keyed by the content hash of the source image plus the operation and its parameters
+
+    Parameters:
+        - `cache_dir` (str): the folder holding the cached images and the hit/miss statistics
+        - `max_size` (int): maximum total size in bytes of the cached images; beyond it, the least recently used ones are
+          evicted down to LOW_WATER_MARK of it
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.stats_path = os.path.join(cache_dir, "stats.json")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        if os.path.exists(self.stats_path):
+            with open(self.stats_path, 'r') as f:
+                self.stats.update(json.load(f))
+        self.size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def file_hash(path):
+        """
+        Returns the SHA-256 hex digest of the content of a file
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, source_path, operation, params=None):
+        """
+        Returns the cache key of applying `operation` with `params` to the image at `source_path`
+        """
+        description = json.dumps({"operation": operation, "params": params or {}}, sort_keys=True)
+        return hashlib.sha256((self.file_hash(source_path) + description).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def get(self, key, output_path):
+        """
+        Copy the cached result of `key` to `output_path`
+
+        Returns: True on a cache hit
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, output_path)
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.stats["misses"] += 1
+            return False
+        with self.lock:
+            self.stats["hits"] += 1
+        return True
+
+    def put(self, key, result_path):
+        """
+        Store the image at `result_path` as the result of `key`
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(result_path, tmp_path)
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += os.path.getsize(path) - previous_size
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict(int(self.max_size * LOW_WATER_MARK))
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.objects_dir):
+            for file in files:
+                if not file.endswith(".tmp"):
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, stat.st_mtime
+
+    def evict(self, max_size):
+        """
+        Delete the least recently used entries until the cache holds at most `max_size` bytes
+
+        Returns: the number of deleted entries
+        """
+        with self.lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            self.size = sum(size for _, size, _ in entries)
+            evicted = 0
+            for path, size, _ in entries:
+                if self.size <= max_size:
+                    break
+                os.remove(path)
+                self.size -= size
+                evicted += 1
+            self.stats["evictions"] += evicted
+        return evicted
+
+    def clear(self):
+        """
+        Delete every cached image and the statistics, leaving any other file of the cache folder untouched
+        """
+        with self.lock:
+            shutil.rmtree(self.objects_dir, ignore_errors=True)
+            if os.path.exists(self.stats_path):
+                os.remove(self.stats_path)
+            os.makedirs(self.objects_dir, exist_ok=True)
+            self.size = 0
+            self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def save_stats(self):
+        """
+        Persist the hit/miss counts
+        """
+        with self.lock:
+            with open(self.stats_path, 'w') as f:
+                json.dump(self.stats, f, indent=2)
+
+    def summary(self):
+        """
+        Returns the statistics of the cache along with the number and total size of its entries
+        """
+        entries = list(self._entries())
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats,
+                    entries=len(entries),
+                    size_bytes=sum(size for _, size, _ in entries),
+                    hit_rate="{:.1%}".format(self.stats["hits"] / lookups) if lookups else "n/a")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or trim the anonymized image cache")
+    parser.add_argument("command", choices=["stats", "evict", "clear"])
+    parser.add_argument("cache_dir", help="path to the cache folder")
+    parser.add_argument("--max-size-mb", type=float, default=None,
+                        help="size the cache is trimmed to by the evict command (required by it)")
+    args = parser.parse_args()
+    if args.command == "evict" and args.max_size_mb is None:
+        parser.error("the evict command requires --max-size-mb")
+
+    if not os.path.isdir(args.cache_dir):
+        print("Invalid path: " + str(args.cache_dir))
+        sys.exit(1)
+    cache = ImageCache(args.cache_dir)
+    if args.command == "evict":
+        print(f"Evicted {cache.evict(int(args.max_size_mb * 1024 * 1024))} entries")
+        cache.save_stats()
+    elif args.command == "clear":
+        cache.clear()
+        print(f"Cleared {args.cache_dir}")
+        sys.exit(0)
+    print(json.dumps(cache.summary(), indent=2))
@@ -1,7 +1,24 @@
 import sys
+import argparse
 import json
 import random
 import os
+import math
+import hashlib
+from functools import partial
+import numpy as np
+from geojson import Point
+from common_utils import find_month_files, iter_timeline_objects, parallel_map
+from timestamps import MISSING_TIME, parse_epoch_array
+from run_manifest import RunManifest
+import metrics
+
+ANCHOR_TYPES = ("TYPE_HOME", "TYPE_WORK")
+GEOFENCE_MODES = ("perturb", "suppress")
+# meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320.0
+# a place is taken as home (or work) when at least this many hours were spent there at night (or during office hours)
+MIN_ANCHOR_HOURS = 20
 
 def generate_noise():
     """
@@ -10,6 +27,32 @@ def generate_noise():
     return random.randrange(1, 10) * (10 ** 4)
 
 
+def anonymize_timeline_object(timeline_object, random_noise):
+    """
+    Anonymize the sensitive location data (E.g. Home Address) of a single timeline object in place
+
+    Parameters:
+        - `timeline_object` (dict): a timeline object from Google Takeout Data
+        - `random_noise` (int): the noise value of this participant
+
+    Returns: the anonymized timeline object
+    """
+    if "placeVisit" in timeline_object:
+        if "location" in timeline_object["placeVisit"]:
+            if "semanticType" in timeline_object["placeVisit"]["location"]:
+                if timeline_object["placeVisit"]["location"]["semanticType"] == "TYPE_HOME":
+                    timeline_object["placeVisit"]["location"]["semanticType"] = "TYPE_UNKNOWN"
+                    timeline_object["placeVisit"]["location"]["latitudeE7"] += random_noise
+                    timeline_object["placeVisit"]["location"]["longitudeE7"] -= random_noise
+                    timeline_object["placeVisit"]["location"]["address"] = "Google Searched Place"
+        if "otherCandidateLocations" in timeline_object["placeVisit"]:
+            for candidate in timeline_object["placeVisit"]["otherCandidateLocations"]:
+                if "semanticType" in candidate:
+                    if candidate["semanticType"] == "TYPE_HOME":
+                        candidate["semanticType"] = "TYPE_SEARCHED_ADDRESS"
+    return timeline_object
+
+
 def anonymize_sensitive_locations(timeline_objects, random_noise):
     """
     Anonymize sensitive location data (E.g. Home Address)
@@ -19,63 +62,550 @@ def anonymize_sensitive_locations(timeline_objects, random_noise):
 
     Returns: A list of anonymized timeline_objects
     """
-    for idx, timeline_object in enumerate(timeline_objects):
-        if "placeVisit" in timeline_object:
-            if "location" in timeline_object["placeVisit"]:
-                if "semanticType" in timeline_object["placeVisit"]["location"]:
-                    if timeline_object["placeVisit"]["location"]["semanticType"] == "TYPE_HOME":
-                        timeline_objects[idx]["placeVisit"]["location"]["semanticType"] = "TYPE_UNKNOWN"
-                        timeline_objects[idx]["placeVisit"]["location"]["latitudeE7"] += random_noise
-                        timeline_objects[idx]["placeVisit"]["location"]["longitudeE7"] -= random_noise
-                        timeline_objects[idx]["placeVisit"]["location"]["address"] = "Google Searched Place"
-            if "otherCandidateLocations" in timeline_object["placeVisit"]:
-                for candidate in timeline_object["placeVisit"]["otherCandidateLocations"]:
-                    if "semanticType" in candidate:
-                        if candidate["semanticType"] == "TYPE_HOME":
-                            candidate["semanticType"] = "TYPE_SEARCHED_ADDRESS"
+    for timeline_object in timeline_objects:
+        anonymize_timeline_object(timeline_object, random_noise)
     return timeline_objects
 
-def anonymize_data(input_dir, output_dir):
+
+class Geofence:
+    """
+    Anonymizes every location within `radius` meters of the home and work anchors of a participant: the placeVisits,
+    their candidate locations and the start and end of the activitySegments, whether they are tagged TYPE_HOME or not.
+
+    The anchors are stored in a grid whose cells are `radius` wide, so only the locations falling in the 3x3 cells
+    around an anchor have their distance measured.
+
+    Parameters:
+        - `anchors` (list): (latitudeE7, longitudeE7) of the anchors
+        - `radius` (float): the radius in meters
+        - `mode` (str): "perturb" moves the locations in the radius by the participant's noise like a TYPE_HOME visit,
+          "suppress" removes them (the placeVisit, the candidate location or the activitySegment endpoint)
+    """
+
+    def __init__(self, anchors, radius=200, mode="perturb"):
+        if mode not in GEOFENCE_MODES:
+            raise ValueError(f"Unknown geofence mode: {mode}")
+        self.anchors = np.array(sorted(set(anchors)), dtype=np.int64).reshape(-1, 2)
+        self.radius = radius
+        self.mode = mode
+        self.anchor_lat = self.anchors[:, 0] / 10 ** 7
+        self.anchor_lon = self.anchors[:, 1] / 10 ** 7
+        self.anchor_cos = np.cos(np.radians(self.anchor_lat))
+        # longitude cells are sized at the anchor farthest from the equator so that none is narrower than the radius
+        max_lat = float(np.abs(self.anchor_lat).max()) if len(self.anchors) else 0.0
+        self.cell_lat = radius / METERS_PER_DEGREE
+        self.cell_lon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(max_lat)), 1e-6))
+        self.cells = {}
+        for anchor, key in enumerate(self._cell_keys(self.anchor_lat, self.anchor_lon)):
+            row, column = divmod(int(key), 1 << 32)
+            for d_row in (-1, 0, 1):
+                for d_column in (-1, 0, 1):
+                    self.cells.setdefault(((row + d_row) << 32) + column + d_column, []).append(anchor)
+        self.cell_keys = np.array(sorted(self.cells), dtype=np.int64)
+
+    def _cell_keys(self, lat, lon):
+        # one int64 per cell: the row in the high 32 bits plus the column (offset so that it stays positive)
+        rows = np.floor(np.asarray(lat) / self.cell_lat).astype(np.int64)
+        columns = np.floor(np.asarray(lon) / self.cell_lon).astype(np.int64) + (1 << 31)
+        return (rows << 32) + columns
+
+    def contains(self, lat_e7, lon_e7):
+        """
+        Returns a boolean array telling which of the locations (E7 coordinate arrays) are within the radius of an anchor
+        """
+        lat = np.asarray(lat_e7, dtype=np.float64) / 10 ** 7
+        lon = np.asarray(lon_e7, dtype=np.float64) / 10 ** 7
+        inside = np.zeros(len(lat), dtype=bool)
+        if not len(self.anchors) or not len(lat):
+            return inside
+        candidates = np.flatnonzero(np.isin(self._cell_keys(lat, lon), self.cell_keys))
+        if len(candidates):
+            # equirectangular distance to every anchor, only for the few locations next to one
+            d_lat = (lat[candidates, None] - self.anchor_lat[None, :]) * METERS_PER_DEGREE
+            d_lon = (lon[candidates, None] - self.anchor_lon[None, :]) * METERS_PER_DEGREE * self.anchor_cos[None, :]
+            inside[candidates] = ((d_lat ** 2 + d_lon ** 2) <= self.radius ** 2).any(axis=1)
+        return inside
+
+    def signature(self):
+        """
+        Returns a digest of the anchors, radius and mode, recorded in the run manifest instead of the anchors themselves
+        """
+        digest = hashlib.sha256(self.anchors.tobytes())
+        digest.update(f"{self.radius}:{self.mode}".encode())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def _collect(timeline_objects):
+        """
+        Returns the (kind, container, key) of every location of the timeline objects (container[key] being the location
+        dict), the index of the timeline object of each, and the indexes of the timeline objects with a TYPE_HOME location
+        """
+        refs = []
+        owners = []
+        tagged = set()
+        for i, timeline_object in enumerate(timeline_objects):
+            visit = timeline_object.get("placeVisit")
+            if visit is not None:
+                location = visit.get("location")
+                if location is not None and "latitudeE7" in location and "longitudeE7" in location:
+                    refs.append(("visit", visit, "location"))
+                    owners.append(i)
+                    if location.get("semanticType") == "TYPE_HOME":
+                        tagged.add(i)
+                candidates = visit.get("otherCandidateLocations")
+                if candidates:
+                    for j, candidate in enumerate(candidates):
+                        if "latitudeE7" in candidate and "longitudeE7" in candidate:
+                            refs.append(("candidate", candidates, j))
+                            owners.append(i)
+                            if candidate.get("semanticType") == "TYPE_HOME":
+                                tagged.add(i)
+            segment = timeline_object.get("activitySegment")
+            if segment is not None:
+                for key in ("startLocation", "endLocation"):
+                    location = segment.get(key)
+                    if location is not None and "latitudeE7" in location and "longitudeE7" in location:
+                        refs.append(("endpoint", segment, key))
+                        owners.append(i)
+        return refs, owners, tagged
+
+    def _anonymize(self, timeline_object, locations, inside, random_noise):
+        # returns the anonymized timeline object, or None if it is suppressed
+        suppressed_candidates = []
+        for (kind, container, key), is_inside in zip(locations, inside):
+            location = container[key]
+            if is_inside and self.mode == "suppress":
+                if kind == "visit":
+                    return None
+                if kind == "candidate":
+                    suppressed_candidates.append(key)
+                else:
+                    del container[key]
+                continue
+            if not is_inside and location.get("semanticType") != "TYPE_HOME":
+                continue
+            # in the radius, or a TYPE_HOME location outside it: anonymized like `anonymize_timeline_object`
+            if kind != "endpoint":
+                if kind == "visit":
+                    if location.get("semanticType") in ANCHOR_TYPES:
+                        location["semanticType"] = "TYPE_UNKNOWN"
+                    location["address"] = "Google Searched Place"
+                elif location.get("semanticType") in ANCHOR_TYPES:
+                    location["semanticType"] = "TYPE_SEARCHED_ADDRESS"
+                    if not is_inside:
+                        continue
+            location["latitudeE7"] += random_noise
+            location["longitudeE7"] -= random_noise
+        if suppressed_candidates:
+            visit = timeline_object["placeVisit"]
+            visit["otherCandidateLocations"] = [candidate for i, candidate in enumerate(visit["otherCandidateLocations"])
+                                                if i not in suppressed_candidates]
+        return timeline_object
+
+    def apply(self, timeline_objects, random_noise):
+        """
+        Anonymize the locations of a month in the radius of the anchors, the TYPE_HOME ones outside it like
+        `anonymize_sensitive_locations`
+
+        Returns: the list of the anonymized timeline objects, without the suppressed placeVisits
+        """
+        refs, owners, tagged = self._collect(timeline_objects)
+        inside = self.contains([container[key]["latitudeE7"] for _, container, key in refs],
+                               [container[key]["longitudeE7"] for _, container, key in refs])
+        owners = np.array(owners, dtype=np.int64)
+        # only the timeline objects with a location in the radius or tagged TYPE_HOME are modified
+        touched = sorted(tagged.union(owners[inside].tolist()))
+        first = np.searchsorted(owners, touched, side="left")
+        last = np.searchsorted(owners, touched, side="right")
+        suppressed = set()
+        for i, lo, hi in zip(touched, first.tolist(), last.tolist()):
+            if self._anonymize(timeline_objects[i], refs[lo:hi], inside[lo:hi], random_noise) is None:
+                suppressed.add(i)
+        if not suppressed:
+            return timeline_objects
+        return [timeline_object for i, timeline_object in enumerate(timeline_objects) if i not in suppressed]
+
+    def apply_one(self, timeline_object, random_noise):
+        """
+        Anonymize a single timeline object (E.g. of a streamed month), see `apply`
+
+        Returns: the anonymized timeline object, or None if it is suppressed
+        """
+        refs, _, _ = self._collect([timeline_object])
+        inside = self.contains([container[key]["latitudeE7"] for _, container, key in refs],
+                               [container[key]["longitudeE7"] for _, container, key in refs])
+        return self._anonymize(timeline_object, refs, inside, random_noise)
+
+    def apply_points(self, points, random_noise):
+        """
+        Anonymize the Instagram story points (the (Point, properties) tuples of `create_story_point`) in the radius of
+        the anchors: moved by the participant's noise like the place visits, or removed
+
+        Returns: the list of the points, without the suppressed ones
+        """
+        if not points:
+            return points
+        lat_e7 = [round(point["coordinates"][1] * 10 ** 7) for point, _ in points]
+        lon_e7 = [round(point["coordinates"][0] * 10 ** 7) for point, _ in points]
+        result = []
+        for (point, properties), is_inside in zip(points, self.contains(lat_e7, lon_e7).tolist()):
+            if not is_inside:
+                result.append((point, properties))
+            elif self.mode == "perturb":
+                longitude = point["coordinates"][0] - random_noise / 10 ** 7
+                latitude = point["coordinates"][1] + random_noise / 10 ** 7
+                properties = dict(properties, longitude=longitude, latitude=latitude)
+                result.append((Point((longitude, latitude)), properties))
+        return result
+
+    @classmethod
+    def from_month_files(cls, month_files, radius=200, mode="perturb", infer=True, workers=None, manifest=None):
+        """
+        Derive the anchors of a participant from all of their monthly files: the locations tagged TYPE_HOME or
+        TYPE_WORK and, if `infer` is True, the place where the most time was spent at night (home) and the other place
+        where the most time was spent during weekday office hours (work)
+
+        Parameters:
+            - `month_files` (list): the (subfolder, filename, file_path) tuples returned by `find_month_files`
+            - `workers` (int): number of processes the monthly files are read by
+            - `manifest` (RunManifest): if given, the statistics of the months that did not change since the previous
+              run are reused from it (see `cached_month_anchor_stats`)
+        """
+        if manifest is not None:
+            month_stats = cached_month_anchor_stats(manifest, month_files, workers)
+        else:
+            month_stats = parallel_map(month_anchor_stats, month_files, workers)
+        tagged = set()
+        dwell = {}
+        for month_tagged, month_dwell in (stats or (set(), {}) for stats in month_stats):
+            tagged.update(month_tagged)
+            for place, (lat_e7, lon_e7, night_hours, work_hours) in month_dwell.items():
+                total = dwell.setdefault(place, [lat_e7, lon_e7, 0.0, 0.0])
+                total[2] += night_hours
+                total[3] += work_hours
+
+        anchors = set(tagged)
+        if infer and dwell:
+            home = max(dwell, key=lambda place: dwell[place][2])
+            if dwell[home][2] >= MIN_ANCHOR_HOURS:
+                anchors.add(tuple(dwell[home][:2]))
+            work = max((place for place in dwell if place != home), key=lambda place: dwell[place][3], default=None)
+            if work is not None and dwell[work][3] >= MIN_ANCHOR_HOURS:
+                anchors.add(tuple(dwell[work][:2]))
+        return cls(anchors, radius, mode)
+
+
+def month_anchor_stats(month_file):
+    """
+    Returns the visited locations tagged as anchors in a monthly file and the hours spent at each place at night (22:00-06:00)
+    and during weekday office hours (09:00-17:00). A visit counts in full towards the period of its middle, in the
+    local solar time of its longitude since the timestamps are in UTC.
+
+    Returns: a (set of (latitudeE7, longitudeE7), {place: (latitudeE7, longitudeE7, night_hours, work_hours)}) tuple,
+    or None if the file cannot be parsed
+    """
+    subfolder, filename, file_path = month_file
+    tagged = set()
+    visits = []
+    try:
+        timeline_objects = list(iter_timeline_objects(file_path))
+    except json.JSONDecodeError:
+        print(f"Error parsing JSON in file: {file_path}")
+        return None
+    for timeline_object in timeline_objects:
+        if "placeVisit" not in timeline_object:
+            continue
+        # the candidate locations are only alternative guesses, their tags do not make anchors
+        location = timeline_object["placeVisit"].get("location", {})
+        if "latitudeE7" in location and "longitudeE7" in location:
+            if location.get("semanticType") in ANCHOR_TYPES:
+                tagged.add((location["latitudeE7"], location["longitudeE7"]))
+            visit = timeline_object["placeVisit"]
+            duration = visit.get("duration", {})
+            visits.append((location.get("placeId") or (location["latitudeE7"], location["longitudeE7"]),
+                           location["latitudeE7"], location["longitudeE7"],
+                           duration.get("startTimestamp"), duration.get("endTimestamp")))
+
+    dwell = {}
+    if not visits:
+        return tagged, dwell
+    starts = parse_epoch_array([visit[3] for visit in visits])
+    ends = parse_epoch_array([visit[4] for visit in visits])
+    longitudes = np.array([visit[2] for visit in visits], dtype=np.float64) / 10 ** 7
+    valid = (starts != MISSING_TIME) & (ends != MISSING_TIME) & (ends > starts)
+    local_middle = (starts + ends) // 2 + (longitudes / 15 * 3600).astype(np.int64)
+    hours = (ends - starts) / 3600
+    hour_of_day = (local_middle // 3600) % 24
+    # 1970-01-01 was a Thursday, Monday is 0
+    weekday = (local_middle // 86400 + 3) % 7
+    night = valid & ((hour_of_day >= 22) | (hour_of_day < 6))
+    work = valid & (weekday < 5) & (hour_of_day >= 9) & (hour_of_day < 17)
+    for i in np.flatnonzero(night | work):
+        place, lat_e7, lon_e7 = visits[i][:3]
+        total = dwell.setdefault(place, [lat_e7, lon_e7, 0.0, 0.0])
+        total[2 if night[i] else 3] += hours[i]
+    return tagged, {place: tuple(total) for place, total in dwell.items()}
+
+
+def cached_month_anchor_stats(manifest, month_files, workers=None):
+    """
+    Returns the `month_anchor_stats` of every monthly file in order. The statistics are recorded in the run manifest
+    under "anchors/<subfolder>/<filename>", so only the months that changed since the previous run are parsed again.
+    They hold the raw locations of home and work, like the rest of the .cache folder they must not be shared.
+    """
+    stats = [None] * len(month_files)
+    changed = []
+    for i, (subfolder, filename, file_path) in enumerate(month_files):
+        artifact = manifest.lookup(f"anchors/{subfolder}/{filename}", [file_path])
+        if artifact is not None:
+            with open(artifact, 'r') as f:
+                cached = json.load(f)
+            # JSON turns the (latitudeE7, longitudeE7) tuples into lists, the placeIds stay strings
+            stats[i] = ({tuple(location) for location in cached["tagged"]},
+                        {place if isinstance(place, str) else tuple(place): tuple(total)
+                         for place, *total in cached["dwell"]})
+        else:
+            changed.append(i)
+
+    for i, month_stats in zip(changed, parallel_map(month_anchor_stats, [month_files[i] for i in changed], workers)):
+        stats[i] = month_stats
+        if month_stats is None:
+            continue
+        subfolder, filename, file_path = month_files[i]
+        key = f"anchors/{subfolder}/{filename}"
+        artifact = manifest.artifact_path(key, ".json")
+        month_tagged, month_dwell = month_stats
+        with open(artifact, 'w') as f:
+            json.dump({"tagged": sorted(month_tagged),
+                       "dwell": [[place, *total] for place, total in month_dwell.items()]}, f)
+        manifest.record(key, [file_path], artifact)
+    return stats
+
+
+def add_geofence_arguments(parser):
+    """
+    Add the options of the geofencing of home and work to an argument parser
+    """
+    parser.add_argument("--geofence-radius", type=float, default=None,
+                        help="also anonymize every location within this many meters of home and work, tagged or not")
+    parser.add_argument("--geofence-mode", choices=GEOFENCE_MODES, default="perturb",
+                        help="move the locations in the radius by the participant's noise, or remove them")
+    parser.add_argument("--no-infer-anchors", action="store_true",
+                        help="only use the locations tagged TYPE_HOME/TYPE_WORK as anchors, not the places inferred from the time spent there")
+
+
+def geofence_from_args(args, month_files, manifest=None):
+    """
+    Returns the Geofence of the command line `args` of `add_geofence_arguments`, or None if it is not enabled
+
+    Parameters:
+        - `manifest` (RunManifest): if given, the anchor statistics of the unchanged months are reused from it
+    """
+    if args.geofence_radius is None:
+        return None
+    with metrics.stage("geofence_anchors", len(month_files)):
+        geofence = Geofence.from_month_files(month_files, args.geofence_radius, args.geofence_mode,
+                                             not args.no_infer_anchors, getattr(args, "workers", None), manifest)
+    print(f"Geofencing {len(geofence.anchors)} home/work anchors within {args.geofence_radius:g} m ({args.geofence_mode})")
+    return geofence
+
+
+def month_params(noise_fingerprint, geofence=None):
     """
-    Generate a random noise specifically used for this participant. 
+    Returns the parameters an anonymized month depends on, as recorded in the run manifest
+
+    Parameters:
+        - `noise_fingerprint` (str): the fingerprint of the participant's noise (see `RunManifest.noise_fingerprint`),
+          never the noise itself
+    """
+    if geofence is None:
+        return {"noise": noise_fingerprint}
+    return {"noise": noise_fingerprint, "geofence": geofence.signature()}
+
+
+def iter_anonymized_timeline_objects(timeline_objects, random_noise, geofence=None):
+    """
+    Yield the anonymized timeline objects of an iterable (E.g. a streamed monthly file) one at a time
+
+    Raises: `json.JSONDecodeError` if a streamed file turns out not to be valid JSON, so that the truncated month is
+    not taken as complete
+    """
+    for timeline_object in timeline_objects:
+        if geofence is None:
+            yield anonymize_timeline_object(timeline_object, random_noise)
+        else:
+            timeline_object = geofence.apply_one(timeline_object, random_noise)
+            if timeline_object is not None:
+                yield timeline_object
+
+
+def anonymize_month_file(file_path, random_noise, stream=False, geofence=None):
+    """
+    Load a monthly file and anonymize its timeline objects
+
+    Parameters:
+        - `file_path` (str): path to the monthly JSON file
+        - `random_noise` (int): the noise value of this participant
+        - `stream` (bool): if True, `timelineObjects` of the result is a generator that parses and anonymizes one timeline object at a time;
+          it raises `json.JSONDecodeError` if the file is not valid JSON
+        - `geofence` (Geofence): if given, also anonymize the locations around home and work
+
+    Returns: the anonymized monthly data, or None if the file is empty or cannot be parsed
+    """
+    if stream:
+        return {"timelineObjects": iter_anonymized_timeline_objects(
+            iter_timeline_objects(file_path, stream=True), random_noise, geofence)}
+
+    with metrics.stage("parse_json") as stage, open(file_path, 'r', encoding='utf-8') as json_file:
+        try:
+            maps_json = json.load(json_file)
+        except json.JSONDecodeError:
+            print(f"Error parsing JSON in file: {file_path}")
+            return None
+        stage["items"] = len(maps_json.get("timelineObjects", [])) if maps_json else 0
+    if not maps_json:
+        print(f"No data found in the file {file_path}")
+        return None
+    # anonymize locations
+    with metrics.stage("anonymize", len(maps_json["timelineObjects"])):
+        if geofence is None:
+            maps_json["timelineObjects"] = anonymize_sensitive_locations(
+                maps_json["timelineObjects"], random_noise)
+        else:
+            maps_json["timelineObjects"] = geofence.apply(maps_json["timelineObjects"], random_noise)
+    return maps_json
+
+
+def iter_anonymized_timelines(input_dir, random_noise, stream=False):
+    """
+    Yield the anonymized data of every monthly file without writing it to disk
+
+    Parameters:
+        - `input_dir` (str): path to the Semantic-Location-History folder
+        - `random_noise` (int): the noise value of this participant
+        - `stream` (bool): if True, the timeline objects of each month are parsed incrementally (see `anonymize_month_file`)
+
+    Returns: a generator of (subfolder, filename, maps_json) tuples
+    """
+    for subfolder, filename, file_path in find_month_files(input_dir):
+        maps_json = anonymize_month_file(file_path, random_noise, stream)
+        if maps_json is not None:
+            yield subfolder, filename, maps_json
+
+
+def save_anonymized_timeline(maps_json, output_dir, subfolder, filename):
+    """
+    Save the anonymized data of a monthly file under `output_dir`/anonymized_location_data.
+    A streamed `timelineObjects` generator is written one timeline object at a time.
+    """
+    output_file_dir = os.path.join(output_dir, "anonymized_location_data", subfolder)
+    os.makedirs(output_file_dir, exist_ok=True)
+    output_file = os.path.join(output_file_dir, filename)
+    # a streamed month is parsed and anonymized while it is written, so its time is part of this stage
+    with metrics.stage("save_anonymized", 1), open(output_file, "w") as f:
+        if isinstance(maps_json["timelineObjects"], list):
+            json.dump(maps_json, f, indent=2)
+        else:
+            dump_timeline_objects(maps_json["timelineObjects"], f)
+
+
+def dump_timeline_objects(timeline_objects, f):
+    """
+    Write {"timelineObjects": [...]} to `f` one timeline object at a time, formatted like `json.dump(..., indent=2)`
+    """
+    f.write('{\n  "timelineObjects": [')
+    separator = '\n    '
+    for timeline_object in timeline_objects:
+        f.write(separator)
+        f.write(json.dumps(timeline_object, indent=2).replace('\n', '\n    '))
+        separator = ',\n    '
+    f.write('\n  ]\n}' if separator != '\n    ' else ']\n}')
+
+
+def anonymize_and_save_month_file(month_file, random_noise, output_dir, stream=False, geofence=None):
+    """
+    Anonymize a monthly file and save it under `output_dir`/anonymized_location_data
+
+    Parameters:
+        - `month_file` (tuple): a (subfolder, filename, file_path) tuple as returned by `find_month_files`
+
+    Returns: True if the file has been saved
+    """
+    subfolder, filename, file_path = month_file
+    maps_json = anonymize_month_file(file_path, random_noise, stream, geofence)
+    if maps_json is None:
+        return False
+    try:
+        save_anonymized_timeline(maps_json, output_dir, subfolder, filename)
+    except json.JSONDecodeError:
+        # a streamed month is only found to be invalid while it is written, remove what was written of it
+        print(f"Error parsing JSON in file: {file_path}")
+        os.remove(os.path.join(output_dir, "anonymized_location_data", subfolder, filename))
+        return False
+    return True
+
+
+def anonymize_data(input_dir, output_dir, random_noise=None, stream=False, workers=None, force=False, geofence=None):
+    """
+    Anonymize every monthly file and save the result under `output_dir`. A random noise is generated specifically for this participant unless one is given.
+    The fingerprint of every monthly file is recorded in a manifest under `output_dir`/.cache, so that a re-run only anonymizes the months that changed.
+    The noise is kept outside `output_dir`, see `RunManifest.random_noise`.
+
+    Parameters:
+        - `workers` (int): number of processes the monthly files are spread over; every process uses the same participant noise
+        - `force` (bool): anonymize every monthly file again, with a new noise unless one is given
+        - `geofence` (Geofence): if given, also anonymize the locations around home and work (see `Geofence`)
 
     Returns:
         - `output_dir`: the path to the output directory
     """
-    random_noise = generate_noise()
-
-    subfolders = [folder for folder in os.listdir(
-        input_dir) if os.path.isdir(os.path.join(input_dir, folder))]
-
-    for subfolder in subfolders:
-        subfolder_path = os.path.join(input_dir, subfolder)
-        for filename in os.listdir(subfolder_path):
-            if filename.endswith('.json'):
-                file_path = os.path.join(subfolder_path, filename)
-                with open(file_path, 'r', encoding='utf-8') as json_file:
-                    try:
-                        maps_json = json.load(json_file)
-                        if not maps_json:
-                            print(f"No data found in the file {file_path}")
-                            continue
-                        # anonymize locations
-                        maps_json["timelineObjects"] = anonymize_sensitive_locations(
-                            maps_json["timelineObjects"], random_noise)
-                        output_file_dir = os.path.join(output_dir, "anonymized_location_data",subfolder)
-                        if not os.path.exists(output_file_dir):
-                            os.makedirs(output_file_dir)
-                        output_file = os.path.join(output_file_dir, filename)
-                        json.dump(maps_json, open(output_file, "w"), indent=2)
-
-                    except json.JSONDecodeError:
-                        print(f"Error parsing JSON in file: {file_path}")
-                        return None
+    manifest = RunManifest(output_dir, force)
+    if random_noise is None:
+        random_noise = manifest.random_noise(generate_noise)
+
+    params = month_params(manifest.noise_fingerprint(random_noise), geofence)
+    changed = []
+    for month_file in find_month_files(input_dir):
+        subfolder, filename, file_path = month_file
+        if manifest.lookup(f"anonymized/{subfolder}/{filename}", [file_path], params) is None:
+            changed.append(month_file)
+
+    saved = parallel_map(
+        partial(anonymize_and_save_month_file, random_noise=random_noise, output_dir=output_dir, stream=stream,
+                geofence=geofence),
+        changed, workers)
+    for (subfolder, filename, file_path), month_saved in zip(changed, saved):
+        if month_saved:
+            anonymized_file = os.path.join(output_dir, "anonymized_location_data", subfolder, filename)
+            manifest.record(f"anonymized/{subfolder}/{filename}", [file_path], anonymized_file, params)
+    manifest.prune("anonymized/")
+    manifest.save()
+    manifest.print_report()
     print(f"Sensitive data has been anonymized and saved at {output_dir}")
 
     return os.path.join(output_dir, "anonymized_location_data")
 
 
 if __name__ == "__main__":
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
-    anonymize_data(input_dir, output_dir)
+    parser = argparse.ArgumentParser(description="Anonymize sensitive locations in a Semantic-Location-History folder")
+    parser.add_argument("input_dir", help="path to the Semantic-Location-History folder")
+    parser.add_argument("output_dir", help="path to the output folder")
+    parser.add_argument("--stream-json", action="store_true",
+                        help="parse the monthly files incrementally instead of loading each one whole")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes the monthly files are spread over")
+    parser.add_argument("--force", action="store_true",
+                        help="anonymize every monthly file again instead of only those that changed since the previous run")
+    add_geofence_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented_run(args, "location_anonymizer"):
+        # the anchor statistics are cached in the manifest that anonymize_data then loads and updates
+        manifest = RunManifest(args.output_dir, args.force)
+        geofence = geofence_from_args(args, find_month_files(args.input_dir), manifest)
+        if geofence is not None:
+            manifest.prune("anchors/")
+            manifest.save()
+        anonymize_data(args.input_dir, args.output_dir, stream=args.stream_json, workers=args.workers, force=args.force,
+                       geofence=geofence)
+
@@ -1,6 +1,13 @@
+import json
+import argparse
+from functools import partial
 from filter_locations import *
 from location_anonymizer import *
 from to_heatmap import *
+from run_manifest import RunManifest
+from dedup_media import load_media_mapping
+from history_store import HistoryStore
+import metrics
 
 def get_filter_keywords():
     while True:
@@ -37,71 +44,220 @@ def get_buffer_hours():
         except ValueError:
             print("Invalid input. Please enter an integer value.")
         
-def main():
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
-    ins_stories_file_path = sys.argv[3]
+def process_month_file(month_file, random_noise, stream=False, anonymized_data_dir=None, geofence=None):
+    """
+    Anonymize a monthly file and return its place visits. Run in a worker process when `--workers` is given.
 
-    filter_enabled = ask_true_false("Filter Locations?")
-    filter_keywords = None
-    if filter_enabled:
-        filter_keywords = get_filter_keywords()
-        filtered_filename = get_filter_filename()
-    
-    buffer_hours = get_buffer_hours()
+    Parameters:
+        - `month_file` (tuple): a (subfolder, filename, file_path) tuple as returned by `find_month_files`
+        - `random_noise` (int): the noise value shared by every month of the participant
+        - `anonymized_data_dir` (str): if given, the anonymized month is also saved under this output folder
+        - `geofence` (Geofence): if given, also anonymize the locations around home and work
+
+    Returns: a VisitTable of the place visits, or None if the file is empty or cannot be parsed
+    """
+    subfolder, filename, file_path = month_file
+    maps_json = anonymize_month_file(file_path, random_noise, stream, geofence)
+    if maps_json is None:
+        return None
+    try:
+        if anonymized_data_dir is not None and stream:
+            # the streamed timeline objects can only be consumed once, keep this month in memory
+            maps_json["timelineObjects"] = list(maps_json["timelineObjects"])
+        # with --stream-json the month is parsed and anonymized while its visits are extracted
+        with metrics.stage("extract_visits") as stage:
+            table = VisitTable.from_timeline_objects(maps_json["timelineObjects"], month=month_code(filename))
+            stage["items"] = len(table)
+    except json.JSONDecodeError:
+        # a streamed file is skipped like a loaded one instead of exporting the part read before the error
+        print(f"Error parsing JSON in file: {file_path}")
+        return None
+    if anonymized_data_dir is not None:
+        save_anonymized_timeline(maps_json, anonymized_data_dir, subfolder, filename)
+    return table
+
+def story_points(manifest, stories_file, input_dir, month_files, buffer_hours, media_mapping_file=None,
+                 history_store_dir=None, random_noise=None, geofence=None):
+    """
+    Returns a VisitTable of the Instagram story points, reused from the previous run if neither the stories file,
+    the monthly files they are matched against, the media mapping nor the buffer hours changed
+
+    Parameters:
+        - `history_store_dir` (str): if given, the stories are matched against the HistoryStore kept in this folder
+          (built or updated first if needed) instead of parsing every monthly file
+        - `random_noise` (int), `geofence` (Geofence): if a geofence is given, the story points in its radius are
+          moved by the participant's noise or removed like the place visits (see `Geofence.apply_points`)
+    """
+    key = "stories"
+    input_paths = [stories_file] + [file_path for _, _, file_path in month_files]
+    if media_mapping_file is not None:
+        input_paths.append(media_mapping_file)
+    params = {"buffer_hours": buffer_hours, "visit_table": VisitTable.FORMAT_VERSION}
+    if geofence is not None:
+        params.update(month_params(manifest.noise_fingerprint(random_noise), geofence))
+    artifact = manifest.lookup(key, input_paths, params)
+    if artifact is not None:
+        return VisitTable.load(artifact)
+
+    table = VisitTable()
+    stories_info = extract_stories_with_exif_data(stories_file)
+    media_mapping = load_media_mapping(media_mapping_file) if media_mapping_file is not None else None
+    history_store = HistoryStore.open_or_build(input_dir, history_store_dir) if history_store_dir is not None else None
+    points = create_story_point(stories_info, stories_file, input_dir, buffer_hours, media_mapping, history_store)
+    if geofence is not None:
+        points = geofence.apply_points(points, random_noise)
+    for point, properties in points:
+        table.append_story_point(point, properties)
+    artifact = manifest.artifact_path(key, ".npz")
+    table.save(artifact)
+    manifest.record(key, input_paths, artifact, params)
+    return table
+
+def month_place_visit_tables(manifest, month_files, random_noise, args, output_dir, geofence=None):
+    """
+    Returns the VisitTable of every monthly file in order. Only the months that changed since the previous run
+    (or whose anonymized copy is missing when `--keep-anonymized-data` is given) are parsed again.
+    """
+    anonymized_data_dir = output_dir if args.keep_anonymized_data else None
+    params = dict(month_params(manifest.noise_fingerprint(random_noise), geofence), visit_table=VisitTable.FORMAT_VERSION)
+    tables = [None] * len(month_files)
+    changed = []
+    for i, (subfolder, filename, file_path) in enumerate(month_files):
+        key = f"visits/{subfolder}/{filename}"
+        artifact = manifest.lookup(key, [file_path], params)
+        anonymized_file = os.path.join(output_dir, "anonymized_location_data", subfolder, filename)
+        if artifact is not None and (anonymized_data_dir is None or os.path.exists(anonymized_file)):
+            with metrics.stage("load_cached") as stage:
+                tables[i] = VisitTable.load(artifact)
+                stage["items"] = len(tables[i])
+        else:
+            changed.append(i)
+
+    month_results = parallel_map(
+        partial(process_month_file, random_noise=random_noise, stream=args.stream_json,
+                anonymized_data_dir=anonymized_data_dir, geofence=geofence),
+        [month_files[i] for i in changed], args.workers)
+    for i, table in zip(changed, month_results):
+        if table is None:
+            # a month that cannot be read is not recorded, so it is tried again by the next run
+            tables[i] = VisitTable()
+            continue
+        subfolder, filename, file_path = month_files[i]
+        key = f"visits/{subfolder}/{filename}"
+        artifact = manifest.artifact_path(key, ".npz")
+        table.save(artifact)
+        manifest.record(key, [file_path], artifact, params)
+        tables[i] = table
+    return tables
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Anonymize a participant's location history and export it as GeoJSON")
+    parser.add_argument("input_dir", help="path to the Semantic-Location-History folder")
+    parser.add_argument("output_dir", help="path to the output folder")
+    parser.add_argument("stories_file", nargs="?", default=None, help="path to the stories.json file")
+    parser.add_argument("--keep-anonymized-data", action="store_true",
+                        help="also save the anonymized location data under <output_dir>/anonymized_location_data")
+    parser.add_argument("--stream-json", action="store_true",
+                        help="parse the monthly files incrementally instead of loading each one whole")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes the monthly files are spread over")
+    parser.add_argument("--media-mapping", default=None,
+                        help="media_mapping.json written by dedup_media.py, so that duplicate story images share one url")
+    parser.add_argument("--history-store", default=None,
+                        help="folder of a memory-mapped store of the raw history (see history_store.py), built on first use "
+                             "and reused while the monthly files do not change, to match the stories against")
+    parser.add_argument("--force", action="store_true",
+                        help="reprocess every monthly file instead of reusing the results of the previous run")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="geojson",
+                        help="write the visits as GeoJSON, as a binary <name>_visits.npz store read by filter_locations.py, "
+                             "to_heatmap.py and validator.py, or both")
+    add_geofence_arguments(parser)
+    add_geojson_arguments(parser)
+    add_aggregate_arguments(parser)
+    add_tile_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
+def run_participant(args, buffer_hours, keyword_sets=None):
+    """
+    Anonymize and export the data of one participant without asking anything (see batch_runner.py)
+
+    Parameters:
+        - `args` (argparse.Namespace): the options of `parse_args`
+        - `buffer_hours` (int): number of hours each place visit is extended on both sides when matching stories
+        - `keyword_sets` (dict): maps the name of each filtered output file (without .json extension) to its keywords
+
+    Returns: the path of the GeoJSON file, or of the visits store if no GeoJSON is written
+    """
+    input_dir = args.input_dir
+    output_dir = args.output_dir
+    ins_stories_file_path = args.stories_file
 
     os.makedirs(output_dir, exist_ok=True)
 
-    print("Start anonymizing participant's data")
-    anonymized_data_dir = anonymize_data(input_dir, output_dir)
+    # results of the previous run are reused for the input files that did not change
+    manifest = RunManifest(output_dir, args.force)
+    month_files = find_month_files(input_dir)
 
-    places_visited = []
+    random_noise = manifest.random_noise(generate_noise)
+    geofence = geofence_from_args(args, month_files, manifest)
+
+    places_visited = VisitTable()
     if ins_stories_file_path is not None:
-        path_to_stories_data = ins_stories_file_path
-        stories_info = extract_stories_with_exif_data(path_to_stories_data)
-        points = create_story_point(stories_info, ins_stories_file_path, input_dir, buffer_hours)
-        for point in points:
-            places_visited.append(point)
-
-    subfolders = [f for f in os.listdir(anonymized_data_dir) if os.path.isdir(os.path.join(anonymized_data_dir, f))]
-    for subfolder in subfolders:
-        subfolder_path = os.path.join(anonymized_data_dir, subfolder)
-        for filename in os.listdir(subfolder_path):
-            if filename.endswith('.json'):
-                file_path = os.path.join(subfolder_path, filename)
-                with open(file_path, 'r', encoding='utf-8') as json_file:
-                    try:
-                        maps_json = json.load(json_file)
-                    except json.JSONDecodeError:
-                        print(f"Error parsing JSON in file: {file_path}")
-
-                    for idx, timeline_object in enumerate(maps_json["timelineObjects"]):
-                        if "placeVisit" in timeline_object:
-                            if "activitySegment" in maps_json["timelineObjects"][idx - 1]:
-                                activitySegment = maps_json["timelineObjects"][idx - 1]["activitySegment"]
-                                if "activityType" in activitySegment:
-                                    transportation_mode = maps_json["timelineObjects"][idx - 1]["activitySegment"]["activityType"]
-                                    places_visited.append(place_visit(timeline_object["placeVisit"], transportation_mode))
-                                else:
-                                    places_visited.append(place_visit(timeline_object["placeVisit"]))
-                            else:
-                                places_visited.append(place_visit(timeline_object["placeVisit"]))
-        
+        places_visited.extend(story_points(manifest, ins_stories_file_path, input_dir, month_files, buffer_hours,
+                                           args.media_mapping, args.history_store, random_noise, geofence))
+
+    # anonymized timeline objects flow straight into the place_visit stage
+    print("Start anonymizing participant's data")
+    for month_places_visited in month_place_visit_tables(manifest, month_files, random_noise, args, output_dir, geofence):
+        places_visited.extend(month_places_visited)
+    # the "anonymized/" entries of location_anonymizer.py share the manifest, only this run's own entries are pruned
+    for prefix in ("visits/", "stories", "anchors/"):
+        manifest.prune(prefix)
+    manifest.save()
+    manifest.print_report()
+    if args.keep_anonymized_data:
+        print(f"Sensitive data has been anonymized and saved at {output_dir}")
+
+    output_file = None
+    if args.output_format in ("visits", "both"):
+        output_file = visits_output_path(output_dir)
+        with metrics.stage("save_visits", len(places_visited)):
+            places_visited.save(output_file)
+        print(f"Visits store saved at {output_file}")
+    if args.output_format in ("geojson", "both"):
+        output_file = geojson_output_path(output_dir, args.gzip)
+        write_geojson(places_visited, output_file, args.compact, args.precision, args.gzip)
+    if args.aggregate:
+        write_aggregated_geojson(places_visited, geojson_output_path(output_dir, args.gzip, "_" + args.aggregate),
+                                 args.aggregate, args.cell_size, args.dwell_weights, args.compact, args.gzip)
+    if args.tiles:
+        tiles_dir = os.path.join(output_dir, "tiles")
+        with metrics.stage("tiles", len(places_visited)):
+            build_tile_pyramid(places_visited, tiles_dir, args.min_zoom, args.max_zoom, args.raw_zoom)
+        print(f"Tile pyramid (zoom {args.min_zoom}-{args.max_zoom}) saved at {tiles_dir}")
+
+    if keyword_sets:
+        # filtered straight from the visits in memory instead of reading the GeoJSON file back
+        output_paths = {filename: os.path.join(output_dir, filename) + ".json" for filename in keyword_sets}
+        filter_visit_table(places_visited, output_paths, keyword_sets, precision=args.precision)
+    return output_file
 
-    output_geojson = make_geojson(places_visited)
-    output_file = os.path.join(output_dir, output_dir.split("/")[-1]) + ".json"
-    json.dump(output_geojson, open(output_file, "w"), indent=2)
+def main():
+    args = parse_args()
 
+    filter_enabled = ask_true_false("Filter Locations?")
+    keyword_sets = None
     if filter_enabled:
-        filtered_output_file = os.path.join(output_dir, filtered_filename) + ".json"
-        if filter_keywords is None:
-            filter_locations(output_file, filtered_output_file)
-        else:
-            filter_locations(output_file, filtered_output_file, filter_keywords)
+        filter_keywords = get_filter_keywords()
+        filtered_filename = get_filter_filename()
+        keyword_sets = {filtered_filename: DEFAULT_KEYWORDS if filter_keywords is None else filter_keywords}
     
-    # remove the folder containing all anonymized Google location data
-    # comment out this line if want to keep the anonymized location data
-    shutil.rmtree(anonymized_data_dir)
+    buffer_hours = get_buffer_hours()
+
+    with metrics.instrumented_run(args, "main"):
+        run_participant(args, buffer_hours, keyword_sets)
+
 if __name__ == "__main__":
     main()
 
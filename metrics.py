@@ -0,0 +1,192 @@
+import sys
+import json
+import time
+import logging
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_mb(who="self"):
+    """
+    Returns the peak resident memory in MB of this process ("self") or of its finished child processes ("children")
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+class RunMetrics:
+    """
+    Wall time, number of calls, number of items and memory of the stages of a run (E.g. "parse_json", "anonymize",
+    "story_matching", "write_geojson"). Stages can be recorded from several threads, and from worker processes through
+    `parallel_map`.
+
+    The memory of a stage is reported as:
+        - `peak_rss_growth_mb`: how much the stage raised the peak memory of the process (the largest rise over its
+          calls), i.e. the memory it needed beyond what earlier stages had already used; 0 when it stayed below them
+        - `process_peak_rss_mb`: the peak memory of the process so far when the stage ended, which includes every
+          earlier stage
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _new_stage():
+        return {"seconds": 0.0, "calls": 0, "items": 0, "peak_rss_growth_mb": None, "process_peak_rss_mb": None}
+
+    def add(self, name, seconds=0.0, items=0, calls=1, peak_rss_growth_mb=None):
+        """
+        Add the time and items of one (or `calls`) execution of a stage, and by how much it raised the peak memory of
+        the process if it was measured (see `stage`)
+        """
+        with self.lock:
+            stage = self.stages.setdefault(name, self._new_stage())
+            stage["seconds"] += seconds
+            stage["calls"] += calls
+            stage["items"] += items
+            if peak_rss_growth_mb is not None:
+                stage["peak_rss_growth_mb"] = max(stage["peak_rss_growth_mb"] or 0, peak_rss_growth_mb)
+            rss = peak_rss_mb()
+            if rss is not None:
+                stage["process_peak_rss_mb"] = max(stage["process_peak_rss_mb"] or 0, rss)
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """
+        Time the body of a `with` block as a stage. The yielded dict can be updated with the number of items processed:
+
+            with metrics.stage("write_geojson") as stage:
+                stage["items"] = writer.count
+        """
+        counter = {"items": items}
+        peak_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield counter
+        finally:
+            seconds = time.perf_counter() - start
+            # the peak of the process only rises if this stage used more memory than any earlier one
+            growth = peak_rss_mb() - peak_before if peak_before is not None else None
+            self.add(name, seconds, counter["items"], peak_rss_growth_mb=growth)
+
+    def merge(self, stages):
+        """
+        Add the stages recorded by another RunMetrics (E.g. in a worker process)
+        """
+        for name, stage in stages.items():
+            with self.lock:
+                own = self.stages.setdefault(name, self._new_stage())
+                own["seconds"] += stage["seconds"]
+                own["calls"] += stage["calls"]
+                own["items"] += stage["items"]
+                for key in ("peak_rss_growth_mb", "process_peak_rss_mb"):
+                    if stage[key] is not None:
+                        own[key] = max(own[key] or 0, stage[key])
+
+    def report(self):
+        """
+        Returns the stages with their throughput in items per second
+        """
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            stages[name]["items_per_second"] = stage["items"] / stage["seconds"] if stage["items"] and stage["seconds"] else None
+        return stages
+
+
+# the metrics of the current run (or of the current task in a worker process)
+_current = RunMetrics()
+
+
+def current():
+    return _current
+
+
+def stage(name, items=0):
+    """
+    Time a stage of the current run, see `RunMetrics.stage`
+    """
+    return _current.stage(name, items)
+
+
+def run_instrumented(func, item):
+    """
+    Call `func(item)` with fresh metrics and return the result along with the stages it recorded, so that a worker
+    process can send them back to the parent (see `common_utils.parallel_map`)
+    """
+    global _current
+    parent, _current = _current, RunMetrics()
+    try:
+        result = func(item)
+        return result, _current.stages
+    finally:
+        _current = parent
+
+
+def configure_logging(level="INFO"):
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s", level=getattr(logging, level.upper()))
+
+
+def add_metrics_arguments(parser):
+    """
+    Add the options of the run report, the profiler and the log level to an argument parser
+    """
+    parser.add_argument("--metrics", default=None,
+                        help="write a JSON report of the wall time, items, throughput and memory of every stage to this file")
+    parser.add_argument("--profile", default=None,
+                        help="write cProfile statistics to this file (open with `python -m pstats` or snakeviz)")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs every story match")
+
+
+@contextmanager
+def instrumented_run(args, name):
+    """
+    Configure the logging from the command line `args` of `add_metrics_arguments`, profile the body of the `with` block
+    if `--profile` is given, and write the run report if `--metrics` is given
+    """
+    configure_logging(args.log_level)
+    profiler = cProfile.Profile() if args.profile else None
+    started = datetime.datetime.now()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield _current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info("cProfile statistics saved at %s", args.profile)
+        if args.metrics:
+            write_report(args.metrics, name, started, time.perf_counter() - start)
+
+
+def write_report(path, name, started, wall_seconds):
+    report = {
+        "run": name,
+        "argv": sys.argv,
+        "started": started.isoformat(timespec="seconds"),
+        "wall_seconds": wall_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_children_mb": peak_rss_mb("children"),
+        "stages": _current.report(),
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    for stage_name, stage in report["stages"].items():
+        throughput = f", {stage['items_per_second']:.0f} items/s" if stage["items_per_second"] else ""
+        logger.info("%s: %.3f s, %d items%s", stage_name, stage["seconds"], stage["items"], throughput)
+    print(f"Run report saved at {path}")
@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+
+MANIFEST_VERSION = 2
+
+
+def user_data_dir():
+    """
+    Returns the per-user folder ($XDG_DATA_HOME/sound-of-silence, ~/.local/share/sound-of-silence by default) of the data
+    that must never be written to an output folder, like the anonymization noise of the participants
+    """
+    base_dir = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base_dir, "sound-of-silence")
+
+
+def file_fingerprint(path, previous=None):
+    """
+    Returns the size, modification time and SHA-256 of a file. The hash of `previous` is reused when the size and
+    modification time have not changed.
+
+    Parameters:
+        - `path` (str): path to the file
+        - `previous` (dict): a fingerprint returned by an earlier call
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        fingerprint["sha256"] = previous["sha256"]
+        return fingerprint
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    fingerprint["sha256"] = digest.hexdigest()
+    return fingerprint
+
+
+class RunManifest:
+    """
+    Records, under `output_dir`/.cache, the fingerprint of every input file of a run along with the artifacts derived
+    from it (E.g. the extracted visits of a month), so that a re-run only reprocesses the inputs that changed.
+
+    The participant's anonymization noise, which reused and reprocessed months must share, is kept outside the output
+    folder in the per-user data folder (see `user_data_dir`), under a name derived from the path of `output_dir`; the
+    manifest only records a salted fingerprint of it (see `noise_fingerprint`).
+
+    Parameters:
+        - `output_dir` (str): the output folder of the participant
+        - `force` (bool): ignore the previous manifest and reprocess everything
+    """
+
+    def __init__(self, output_dir, force=False):
+        self.cache_dir = os.path.join(output_dir, ".cache")
+        self.path = os.path.join(self.cache_dir, "manifest.json")
+        self.force = force
+        self.noise_path = os.path.join(user_data_dir(), "noise",
+                                       hashlib.sha256(os.path.abspath(output_dir).encode()).hexdigest()[:32] + ".json")
+        self.data = {"version": MANIFEST_VERSION, "entries": {}}
+        if not force and os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.data = data
+        self.seen = set()
+        self.report = {"reused": [], "processed": [], "removed": []}
+
+    def _load_noise(self):
+        if os.path.exists(self.noise_path):
+            with open(self.noise_path, 'r') as f:
+                return json.load(f)
+        noise = {"random_noise": None, "salt": os.urandom(16).hex()}
+        self._save_noise(noise)
+        return noise
+
+    def _save_noise(self, noise):
+        os.makedirs(os.path.dirname(self.noise_path), exist_ok=True)
+        tmp_path = f"{self.noise_path}.{os.getpid()}.tmp"
+        # only readable by the user
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(noise, f)
+        os.replace(tmp_path, self.noise_path)
+
+    def random_noise(self, generate):
+        """
+        Returns the noise of the participant recorded by a previous run, or a new one from `generate()` (always with
+        `force`). The noise is kept in the per-user data folder, never in the output folder where anyone receiving the
+        anonymized outputs could subtract it.
+        """
+        noise = self._load_noise()
+        if noise["random_noise"] is None or self.force:
+            noise["random_noise"] = generate()
+            self._save_noise(noise)
+        return noise["random_noise"]
+
+    def noise_fingerprint(self, random_noise):
+        """
+        Returns a salted digest of a noise value, recorded in the manifest instead of the noise so that the artifacts
+        anonymized with another noise are not reused. The salt is kept along with the noise, so with only a handful of
+        possible noise values the digest still cannot be reversed from the output folder.
+        """
+        salt = self._load_noise()["salt"]
+        return hashlib.sha256(f"{salt}:{random_noise}".encode()).hexdigest()[:16]
+
+    def artifact_path(self, key, extension):
+        """
+        Returns the path under the cache folder where the artifact of `key` is stored, creating its folder
+        """
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        artifact_dir = os.path.join(self.cache_dir, "artifacts")
+        os.makedirs(artifact_dir, exist_ok=True)
+        return os.path.join(artifact_dir, digest + extension)
+
+    def lookup(self, key, input_paths, params=None):
+        """
+        Returns the artifact recorded for `key` if its input files and parameters are unchanged, otherwise None
+
+        Parameters:
+            - `key` (str): identifies the unit of work (E.g. "visits/2020/2020_JANUARY.json")
+            - `input_paths` (list): the files the artifact is derived from
+            - `params` (dict): the settings the artifact depends on
+        """
+        self.seen.add(key)
+        entry = self.data["entries"].get(key)
+        if entry is None or entry["params"] != (params or {}):
+            return None
+        artifact = os.path.join(self.cache_dir, entry["artifact"])
+        if not os.path.exists(artifact):
+            return None
+        previous = entry["inputs"]
+        if sorted(previous) != sorted(input_paths):
+            return None
+        fingerprints = {path: file_fingerprint(path, previous[path]) for path in input_paths}
+        if any(fingerprints[path]["sha256"] != previous[path]["sha256"] for path in input_paths):
+            return None
+        # remember new modification times so that the hash is not recomputed next time
+        entry["inputs"] = fingerprints
+        self.report["reused"].append(key)
+        return artifact
+
+    def record(self, key, input_paths, artifact, params=None):
+        """
+        Record the artifact derived from `input_paths` for `key`. `artifact` is either a file under the cache folder
+        (see `artifact_path`) or an output file (E.g. an anonymized month), which is then not removed by `prune`.
+        """
+        self.seen.add(key)
+        self.data["entries"][key] = {
+            "inputs": {path: file_fingerprint(path) for path in input_paths},
+            "params": params or {},
+            # relative to the cache folder so that the output folder can be moved
+            "artifact": os.path.relpath(artifact, self.cache_dir),
+        }
+        self.report["processed"].append(key)
+
+    def prune(self, prefix=""):
+        """
+        Forget the entries starting with `prefix` that were not looked up or recorded in this run (E.g. deleted months)
+        """
+        for key in list(self.data["entries"]):
+            if key.startswith(prefix) and key not in self.seen:
+                entry = self.data["entries"].pop(key)
+                artifact = os.path.join(self.cache_dir, entry["artifact"])
+                if entry["artifact"].startswith("artifacts") and os.path.exists(artifact):
+                    os.remove(artifact)
+                self.report["removed"].append(key)
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def print_report(self):
+        report = self.report
+        print(f"Reused {len(report['reused'])}, reprocessed {len(report['processed'])}, removed {len(report['removed'])} cached results")
+        for key in report["processed"]:
+            print("  reprocessed " + key)
+        for key in report["removed"]:
+            print("  removed " + key)
@@ -0,0 +1,177 @@
+import os
+import json
+import random
+import argparse
+import datetime
+from common_utils import MONTHS
+
+CITY_CENTER = (34.05, -118.25)
+PLACE_NAMES = ["Central Park", "Lincoln Elementary School", "Westfield Mall", "Community Center", "Santa Monica Beach",
+               "Grand Plaza", "Rose Garden", "Blue Bottle Coffee", "Trader Joe's", "City Library", "Echo Park Playground",
+               "St. Mary's Church", "Venice Boardwalk", "Parking Lot 4", "Fitness Club", "Office Tower"]
+ACTIVITY_TYPES = ["WALKING", "IN_PASSENGER_VEHICLE", "CYCLING", "IN_BUS", "RUNNING"]
+
+
+def _takeout_time(dt, milliseconds):
+    # Takeout mixes "2020-01-01T10:00:00Z" and "2020-01-01T10:00:00.123Z"
+    if milliseconds:
+        return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def make_places(rng, num_places, spread=0.3):
+    """
+    Returns a list of random places around the city center: (placeId, latitudeE7, longitudeE7, name, address)
+    """
+    places = []
+    for i in range(num_places):
+        latitude = CITY_CENTER[0] + rng.uniform(-spread, spread)
+        longitude = CITY_CENTER[1] + rng.uniform(-spread, spread)
+        name = rng.choice(PLACE_NAMES)
+        address = f"{rng.randint(1, 9999)} {rng.choice(['Main', 'Oak', 'Sunset', 'Pine', 'Ocean'])} St, Los Angeles, CA 900{i % 100:02d}, USA"
+        places.append((f"ChIJsynthetic{i:06d}", round(latitude * 10 ** 7), round(longitude * 10 ** 7), name, address))
+    return places
+
+
+def generate_month(rng, year, month, places, home, visits_per_month, home_ratio=0.15):
+    """
+    Returns the content of one monthly Semantic Location History file: `visits_per_month` placeVisits, each preceded by
+    an activitySegment, spread over the month
+    """
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    step = (end - start) / max(visits_per_month, 1)
+    timeline_objects = []
+    for i in range(visits_per_month):
+        segment_start = start + step * i + datetime.timedelta(seconds=rng.randint(0, 600), milliseconds=rng.randint(0, 999))
+        segment_end = segment_start + step * rng.uniform(0.05, 0.2)
+        visit_end = segment_start + step * rng.uniform(0.5, 0.95)
+        place_id, latitude, longitude, name, address = rng.choice(places)
+        location = {"latitudeE7": latitude, "longitudeE7": longitude, "placeId": place_id, "address": address,
+                    "name": name, "sourceInfo": {"deviceTag": 1234567}, "locationConfidence": rng.uniform(40, 100)}
+        if rng.random() < home_ratio:
+            location.update({"latitudeE7": home[0], "longitudeE7": home[1], "placeId": "ChIJsyntheticHOME",
+                             "name": "Home", "semanticType": "TYPE_HOME"})
+        milliseconds = rng.random() < 0.5
+        timeline_objects.append({"activitySegment": {
+            "startLocation": {"latitudeE7": latitude + rng.randint(-3000, 3000), "longitudeE7": longitude + rng.randint(-3000, 3000)},
+            "endLocation": {"latitudeE7": latitude, "longitudeE7": longitude},
+            "duration": {"startTimestamp": _takeout_time(segment_start, milliseconds),
+                         "endTimestamp": _takeout_time(segment_end, milliseconds)},
+            "distance": rng.randint(100, 20000),
+            "activityType": rng.choice(ACTIVITY_TYPES),
+            "confidence": "HIGH",
+        }})
+        candidates = [{"latitudeE7": candidate[1], "longitudeE7": candidate[2], "placeId": candidate[0],
+                       "semanticType": "TYPE_HOME" if rng.random() < 0.05 else "TYPE_UNKNOWN",
+                       "locationConfidence": rng.uniform(0, 40)} for candidate in rng.sample(places, min(3, len(places)))]
+        timeline_objects.append({"placeVisit": {
+            "location": location,
+            "duration": {"startTimestamp": _takeout_time(segment_end, milliseconds),
+                         "endTimestamp": _takeout_time(visit_end, milliseconds)},
+            "placeConfidence": "HIGH_CONFIDENCE",
+            "otherCandidateLocations": candidates,
+        }})
+    return {"timelineObjects": timeline_objects}
+
+
+def generate_stories(rng, num_stories, first_year, num_years, exif_ratio=0.3, gps_ratio=0.5, duplicate_ratio=0.1):
+    """
+    Returns the content of a stories.json file. A share `exif_ratio` of the stories has EXIF data, of which a share
+    `gps_ratio` has coordinates; the others are matched against the timeline by time. A share `duplicate_ratio`
+    reuses the image of an earlier story.
+    """
+    start = datetime.datetime(first_year, 1, 1)
+    span = (datetime.datetime(first_year + num_years, 1, 1) - start).total_seconds()
+    stories = []
+    for i in range(num_stories):
+        created = start + datetime.timedelta(seconds=rng.uniform(0, span))
+        uri = f"media/stories/{created:%Y%m}/{rng.getrandbits(60)}_n_{i}.jpg"
+        if stories and rng.random() < duplicate_ratio:
+            uri = rng.choice(stories)["uri"]
+        story = {"uri": uri, "creation_timestamp": int(created.replace(tzinfo=datetime.timezone.utc).timestamp()),
+                 "title": "", "media_metadata": {"photo_metadata": {"exif_data": [{"scene_capture_type": "standard"}]}}}
+        if rng.random() < exif_ratio:
+            taken = created - datetime.timedelta(minutes=rng.randint(0, 600))
+            location = {"scene_capture_type": "standard"}
+            if rng.random() < gps_ratio:
+                location = {"latitude": CITY_CENTER[0] + rng.uniform(-0.3, 0.3), "longitude": CITY_CENTER[1] + rng.uniform(-0.3, 0.3)}
+            story["media_metadata"]["photo_metadata"]["exif_data"] = [location, {"date_time_original": f"{taken:%Y:%m:%d %H:%M:%S}"}]
+        stories.append(story)
+    return {"ig_stories": stories}
+
+
+def write_image(path, rng, size=(640, 1136)):
+    """
+    Write a small random JPEG story image
+    """
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + rng.randrange(40, 300), y + rng.randrange(40, 300)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img.save(path, quality=85)
+
+
+def generate_participant(output_dir, participant="participant1", num_years=2, visits_per_month=100, num_stories=100,
+                         exif_ratio=0.3, num_places=500, first_year=2020, images=False, seed=0):
+    """
+    Write a synthetic participant under `output_dir` with the layout of the real data:
+        <participant>/google-takeout/Semantic-Location-History/<year>/<year>_<MONTH>.json
+        <participant>/instagram/content/stories.json (and the story images under instagram/media/stories if `images`)
+
+    Parameters:
+        - `num_years` (int): number of years of location history
+        - `visits_per_month` (int): number of placeVisits in each monthly file
+        - `num_stories` (int): number of Instagram stories
+        - `exif_ratio` (float): share of the stories with EXIF data
+        - `num_places` (int): number of distinct places visited
+        - `images` (bool): also write a JPEG image per distinct story uri
+        - `seed` (int): seed of the random generator; the same seed writes the same data
+
+    Returns: a dict with the paths of the Semantic-Location-History folder and of the stories.json file
+    """
+    rng = random.Random(seed)
+    participant_dir = os.path.join(output_dir, participant)
+    history_dir = os.path.join(participant_dir, "google-takeout", "Semantic-Location-History")
+    places = make_places(rng, num_places)
+    home = (round((CITY_CENTER[0] + rng.uniform(-0.1, 0.1)) * 10 ** 7), round((CITY_CENTER[1] + rng.uniform(-0.1, 0.1)) * 10 ** 7))
+    for year in range(first_year, first_year + num_years):
+        year_dir = os.path.join(history_dir, str(year))
+        os.makedirs(year_dir, exist_ok=True)
+        for month in range(1, 13):
+            with open(os.path.join(year_dir, f"{year}_{MONTHS[month - 1]}.json"), 'w') as f:
+                json.dump(generate_month(rng, year, month, places, home, visits_per_month), f, indent=2)
+
+    instagram_dir = os.path.join(participant_dir, "instagram")
+    stories_file = os.path.join(instagram_dir, "content", "stories.json")
+    os.makedirs(os.path.dirname(stories_file), exist_ok=True)
+    stories = generate_stories(rng, num_stories, first_year, num_years, exif_ratio)
+    with open(stories_file, 'w') as f:
+        json.dump(stories, f, indent=2)
+    if images:
+        for uri in sorted({story["uri"] for story in stories["ig_stories"]}):
+            write_image(os.path.join(instagram_dir, uri), rng)
+
+    return {"input_dir": history_dir, "stories_file": stories_file}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic Google Takeout and Instagram data for benchmarks")
+    parser.add_argument("output_dir", help="the folder the participants are written to")
+    parser.add_argument("--participants", type=int, default=1)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--visits-per-month", type=int, default=100)
+    parser.add_argument("--stories", type=int, default=100)
+    parser.add_argument("--exif-ratio", type=float, default=0.3)
+    parser.add_argument("--places", type=int, default=500)
+    parser.add_argument("--images", action="store_true", help="also write the story images")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for i in range(args.participants):
+        paths = generate_participant(args.output_dir, f"participant{i + 1}", args.years, args.visits_per_month, args.stories,
+                                     args.exif_ratio, args.places, images=args.images, seed=args.seed + i)
+        print(f"participant{i + 1}: {paths['input_dir']} {paths['stories_file']}")
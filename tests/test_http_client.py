@@ -0,0 +1,103 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from http_client import RetryableError, call_with_retry, download_to_file, make_session, request
+
+BODY = b"image bytes" * 1000
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # the status codes answered to the next requests of each path, 200 once they are used up
+    statuses = {}
+    hits = {}
+
+    def do_GET(self):
+        self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        queued = self.statuses.get(self.path) or []
+        status = queued.pop(0) if queued else 200
+        if self.path == "/truncated":
+            # announce more bytes than are sent, then drop the connection
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY) * 2))
+            self.end_headers()
+            self.wfile.write(BODY)
+            self.close_connection = True
+            return
+        body = BODY if status == 200 else b""
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    StubHandler.statuses = {}
+    StubHandler.hits = {}
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_call_with_retry():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RetryableError("try again", retry_after=0)
+        return "done"
+
+    assert call_with_retry(flaky, backoff=0) == "done"
+    assert len(attempts) == 3
+
+
+def test_call_with_retry_gives_up():
+    def failing():
+        raise RetryableError("try again")
+
+    with pytest.raises(RetryableError):
+        call_with_retry(failing, retries=1, backoff=0)
+
+
+def test_request_retries_429_and_5xx(server):
+    StubHandler.statuses["/image"] = [429, 503]
+    with make_session() as session:
+        response = request(session, "GET", server + "/image", backoff=0)
+    assert response.status_code == 200
+    assert response.content == BODY
+    assert StubHandler.hits["/image"] == 3
+
+
+def test_request_gives_up(server):
+    StubHandler.statuses["/image"] = [500, 500, 500]
+    with make_session() as session, pytest.raises(RetryableError):
+        request(session, "GET", server + "/image", retries=2, backoff=0)
+    assert StubHandler.hits["/image"] == 3
+
+
+def test_download_to_file(server, tmp_path):
+    save_path = str(tmp_path / "image.jpg")
+    StubHandler.statuses["/image"] = [502]
+    with make_session() as session:
+        assert download_to_file(session, server + "/image", save_path, backoff=0)
+    with open(save_path, "rb") as f:
+        assert f.read() == BODY
+    assert os.listdir(tmp_path) == ["image.jpg"]
+
+
+def test_download_to_file_removes_partial_file(server, tmp_path):
+    save_path = str(tmp_path / "image.jpg")
+    with make_session() as session, pytest.raises(requests.RequestException):
+        download_to_file(session, server + "/truncated", save_path, backoff=0)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,14 @@
+from timestamps import MISSING_TIME, parse_epoch_array
+
+JANUARY_FIRST = 1577872800
+
+
+def test_parse_epoch_array_iso():
+    epochs = parse_epoch_array(["2020-01-01T10:00:00.000Z", "2020-01-01T10:00:01Z", None, ""])
+    assert epochs.tolist() == [JANUARY_FIRST, JANUARY_FIRST + 1, MISSING_TIME, MISSING_TIME]
+
+
+def test_parse_epoch_array_mixed_formats():
+    assert parse_epoch_array(["2020-01-01T10:00:00Z", "1577872800"]).tolist() == [JANUARY_FIRST, JANUARY_FIRST]
+    assert parse_epoch_array(["1577872800", "2020:01:01 10:00:00"]).tolist() == [JANUARY_FIRST, JANUARY_FIRST]
+    assert parse_epoch_array(["2020-01-01T10:00:00Z", "not a time"], unit="ms").tolist() == [JANUARY_FIRST * 1000, MISSING_TIME]
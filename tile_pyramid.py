@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import numpy as np
+from common_utils import iter_json_array_items
+from visit_table import VisitTable
+from aggregate_visits import MAX_LATITUDE
+
+
+def world_pixels(longitudes, latitudes, zoom):
+    """
+    Returns the integer Web Mercator pixel coordinates of points on a 2^zoom x 2^zoom grid covering the world
+    """
+    scale = 2 ** zoom
+    latitudes = np.radians(np.clip(latitudes, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitudes) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(latitudes) + 1.0 / np.cos(latitudes)) / np.pi) / 2.0 * scale
+    return (np.clip(np.floor(x), 0, scale - 1).astype(np.int64),
+            np.clip(np.floor(y), 0, scale - 1).astype(np.int64))
+
+
+def pixel_to_lnglat(x, y, zoom):
+    """
+    Returns the longitudes and latitudes of (fractional) pixel coordinates on the 2^zoom grid
+    """
+    scale = 2 ** zoom
+    longitudes = np.asarray(x) / scale * 360.0 - 180.0
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / scale))))
+    return longitudes, latitudes
+
+
+def build_tile_pyramid(table, output_dir, min_zoom=0, max_zoom=14, raw_zoom=None, bin_bits=5):
+    """
+    Write a pyramid of z/x/y GeoJSON tiles of the visits of a VisitTable under `output_dir`, along with an index.json manifest.
+    The pyramid is built in a sibling folder and then swapped in, so the tiles of a previous run (E.g. of visits that are
+    gone) are not left behind. A non-empty `output_dir` that is not a pyramid (no index.json) is never replaced.
+
+    Tiles below `raw_zoom` hold one Point per occupied bin (a tile is split into 2^bin_bits x 2^bin_bits bins) with the
+    number of visits in it. Tiles at `raw_zoom` and above hold the visits themselves. The visits are projected once at the
+    deepest resolution and every zoom level is derived from those coordinates by bit shifts.
+
+    Parameters:
+        - `table` (VisitTable): the place visits
+        - `output_dir` (str): the folder the tiles and the manifest are written to
+        - `min_zoom`, `max_zoom` (int): the zoom levels of the pyramid
+        - `raw_zoom` (int): first zoom level holding raw points; `max_zoom` by default
+        - `bin_bits` (int): log2 of the number of bins along each side of a tile
+
+    Returns: the manifest
+
+    Raises: `ValueError` if `output_dir` holds something else than a tile pyramid
+    """
+    output_dir = os.path.normpath(output_dir)
+    if os.path.isdir(output_dir) and os.listdir(output_dir) and not os.path.exists(os.path.join(output_dir, "index.json")):
+        raise ValueError(f"{output_dir} is not a tile pyramid, not replacing it")
+    build_dir = output_dir + ".building"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    manifest = _build_tile_pyramid(table, build_dir, min_zoom, max_zoom, raw_zoom, bin_bits)
+
+    old_dir = output_dir + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(output_dir):
+        os.rename(output_dir, old_dir)
+    os.rename(build_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def _build_tile_pyramid(table, output_dir, min_zoom, max_zoom, raw_zoom, bin_bits):
+    raw_zoom = max_zoom if raw_zoom is None else raw_zoom
+    depth = max_zoom + bin_bits
+    longitudes, latitudes = table.longitudes(), table.latitudes()
+    px, py = world_pixels(longitudes, latitudes, depth)
+
+    manifest = {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "raw_zoom": raw_zoom,
+        "bins_per_tile": 2 ** bin_bits,
+        "url_template": "{z}/{x}/{y}.json",
+        "num_visits": len(table),
+        "bounds": [float(longitudes.min()), float(latitudes.min()), float(longitudes.max()), float(latitudes.max())] if len(table) else None,
+        "zooms": {},
+    }
+
+    for zoom in range(min_zoom, max_zoom + 1):
+        tile_x = px >> (depth - zoom)
+        tile_y = py >> (depth - zoom)
+        if zoom >= raw_zoom:
+            tiles = _write_raw_tiles(table, output_dir, zoom, tile_x, tile_y)
+        else:
+            tiles = _write_count_tiles(output_dir, zoom, bin_bits, px >> (max_zoom - zoom), py >> (max_zoom - zoom))
+        manifest["zooms"][str(zoom)] = {"num_tiles": len(tiles), "tiles": tiles}
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    return manifest
+
+
+def _tile_path(output_dir, zoom, x, y):
+    tile_dir = os.path.join(output_dir, str(zoom), str(x))
+    os.makedirs(tile_dir, exist_ok=True)
+    return os.path.join(tile_dir, f"{y}.json")
+
+
+def _write_feature_collection(path, features):
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f, separators=(',', ':'))
+
+
+def _group_boundaries(keys):
+    """
+    Returns the order sorting `keys` and the start of every run of equal keys in that order
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(keys) else np.empty(0, np.int64)
+    return order, sorted_keys, starts
+
+
+def _write_count_tiles(output_dir, zoom, bin_bits, bin_x, bin_y):
+    # bin_x/bin_y are pixel coordinates at zoom + bin_bits: one pixel per bin
+    bins, counts = np.unique((bin_x << 32) | bin_y, return_counts=True)
+    bx, by = bins >> 32, bins & 0xFFFFFFFF
+    tile_keys = ((bx >> bin_bits) << 32) | (by >> bin_bits)
+    order, sorted_keys, starts = _group_boundaries(tile_keys)
+    centers_lng, centers_lat = pixel_to_lnglat(bx + 0.5, by + 0.5, zoom + bin_bits)
+    centers_lng, centers_lat = centers_lng.tolist(), centers_lat.tolist()
+    counts = counts.tolist()
+
+    tiles = []
+    bounds = np.r_[starts, len(order)].tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        key = int(sorted_keys[start])
+        x, y = key >> 32, key & 0xFFFFFFFF
+        features = []
+        for i in order[start:end].tolist():
+            features.append({
+                "type": "Feature",
+                "properties": {"count": counts[i]},
+                "geometry": {"type": "Point", "coordinates": [round(centers_lng[i], 6), round(centers_lat[i], 6)]},
+            })
+        _write_feature_collection(_tile_path(output_dir, zoom, x, y), features)
+        tiles.append([x, y, sum(counts[i] for i in order[start:end].tolist())])
+    return tiles
+
+
+def _write_raw_tiles(table, output_dir, zoom, tile_x, tile_y):
+    order, sorted_keys, starts = _group_boundaries((tile_x << 32) | tile_y)
+    tiles = []
+    bounds = np.r_[starts, len(order)].tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        key = int(sorted_keys[start])
+        x, y = key >> 32, key & 0xFFFFFFFF
+        _write_feature_collection(_tile_path(output_dir, zoom, x, y), list(table.iter_features(order[start:end])))
+        tiles.append([x, y, end - start])
+    return tiles
+
+
+def load_visit_table(geojson_paths):
+    """
+    Returns a VisitTable of the Point features of one or more GeoJSON outputs (E.g. of several participants), read incrementally
+    """
+    table = VisitTable()
+    for path in geojson_paths:
+        for feature in iter_json_array_items(path, "features"):
+            if feature.get("geometry") and feature["geometry"].get("type") == "Point":
+                table.append_feature(feature)
+    return table
+
+
+def add_tile_arguments(parser):
+    """
+    Add the options of the tiled output to an argument parser
+    """
+    parser.add_argument("--tiles", action="store_true",
+                        help="also write a pyramid of z/x/y tiles with an index.json manifest under <output_dir>/tiles")
+    parser.add_argument("--min-zoom", type=int, default=0)
+    parser.add_argument("--max-zoom", type=int, default=14)
+    parser.add_argument("--raw-zoom", type=int, default=None,
+                        help="first zoom level whose tiles hold the visits themselves instead of counts (max zoom by default)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a z/x/y tile pyramid from one or more GeoJSON outputs of main.py")
+    parser.add_argument("output_dir", help="the folder the tiles are written to")
+    parser.add_argument("geojson_files", nargs="+", help="GeoJSON files (E.g. one per participant)")
+    parser.add_argument("--min-zoom", type=int, default=0)
+    parser.add_argument("--max-zoom", type=int, default=14)
+    parser.add_argument("--raw-zoom", type=int, default=None)
+    args = parser.parse_args()
+
+    for path in args.geojson_files:
+        if not os.path.exists(path):
+            print("Invalid path: " + str(path))
+            sys.exit(1)
+    table = load_visit_table(args.geojson_files)
+    manifest = build_tile_pyramid(table, args.output_dir, args.min_zoom, args.max_zoom, args.raw_zoom)
+    num_tiles = sum(zoom["num_tiles"] for zoom in manifest["zooms"].values())
+    print(f"Wrote {num_tiles} tiles of {len(table)} visits to {args.output_dir}")
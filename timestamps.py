@@ -0,0 +1,259 @@
+import sys
+import math
+import time
+import argparse
+import datetime
+import warnings
+import numpy as np
+
+UTC = datetime.timezone.utc
+# pass as `naive_tz` to read timestamps without an offset in the local time zone of the machine
+LOCAL = None
+
+MISSING_TIME = np.iinfo(np.int64).min
+
+UNITS = {"s": 10 ** 6, "ms": 10 ** 3, "us": 1}
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# datetime.fromisoformat only accepts a trailing "Z" and the basic format (20200101T100000) from Python 3.11
+_FROMISOFORMAT_Z = sys.version_info >= (3, 11)
+
+
+def sniff_format(timestamp_str):
+    """
+    Returns the format of a timestamp string from a few character checks, without parsing it:
+        - "unix": seconds since the epoch (E.g. "1577872800")
+        - "iso": ISO 8601 with an optional offset or "Z" (E.g. "2020-01-01T10:00:00.000Z", Google Takeout)
+        - "exif": "%Y:%m:%d %H:%M:%S" (E.g. "2020:01:01 10:00:00", EXIF DateTimeOriginal)
+        - "compact": "%Y%m%dT%H%M%S.%fZ" (E.g. "20200101T100000.000Z")
+
+    Returns None if the string matches none of them
+    """
+    if not timestamp_str:
+        return None
+    if timestamp_str.isdigit() or (timestamp_str[0] == '-' and timestamp_str[1:].isdigit()):
+        return "unix"
+    if len(timestamp_str) >= 10 and timestamp_str[4] == '-' and timestamp_str[7] == '-':
+        return "iso"
+    if len(timestamp_str) >= 19 and timestamp_str[4] == ':' and timestamp_str[7] == ':' and timestamp_str[10] == ' ':
+        return "exif"
+    if len(timestamp_str) >= 15 and timestamp_str[8] == 'T' and timestamp_str[:8].isdigit():
+        return "compact"
+    return None
+
+
+def _parse_unix(timestamp_str):
+    return datetime.datetime.fromtimestamp(int(timestamp_str), UTC)
+
+
+def _parse_iso(timestamp_str):
+    if timestamp_str.endswith('Z') and not _FROMISOFORMAT_Z:
+        return datetime.datetime.fromisoformat(timestamp_str[:-1]).replace(tzinfo=UTC)
+    return datetime.datetime.fromisoformat(timestamp_str)
+
+
+def _parse_exif(timestamp_str):
+    return datetime.datetime.fromisoformat(f"{timestamp_str[0:4]}-{timestamp_str[5:7]}-{timestamp_str[8:]}")
+
+
+def _parse_compact(timestamp_str):
+    s = timestamp_str
+    return _parse_iso(f"{s[0:4]}-{s[4:6]}-{s[6:8]}T{s[9:11]}:{s[11:13]}:{s[13:]}")
+
+
+PARSERS = {"unix": _parse_unix, "iso": _parse_iso, "exif": _parse_exif, "compact": _parse_compact}
+
+
+def parse_datetime(timestamp_str, fmt=None):
+    """
+    Returns the datetime of a timestamp string. It is timezone-aware if the string has an offset or a "Z", or is a
+    UNIX timestamp (UTC), and naive otherwise.
+
+    Parameters:
+        - `timestamp_str` (str): the timestamp, in any of the formats of `sniff_format`
+        - `fmt` (str): the format, sniffed from the string when not given
+
+    Raises: ValueError if the string is not a valid timestamp
+    """
+    fmt = fmt or sniff_format(timestamp_str)
+    if fmt is None:
+        raise ValueError(f"Unrecognized timestamp format: {timestamp_str!r}")
+    return PARSERS[fmt](timestamp_str)
+
+
+def to_epoch(dt, naive_tz=UTC):
+    """
+    Returns the POSIX timestamp (float seconds) of a datetime. Naive datetimes are read in `naive_tz` (UTC by default,
+    LOCAL for the time zone of the machine) and aware ones are converted using their offset.
+    """
+    if dt.tzinfo is None and naive_tz is not LOCAL:
+        dt = dt.replace(tzinfo=naive_tz)
+    return dt.timestamp()
+
+
+def epoch_seconds(timestamp_str, naive_tz=UTC):
+    """
+    Returns the POSIX timestamp in whole seconds of an ISO 8601 timestamp such as Google Takeout's "2020-01-01T10:00:00.000Z".
+    This is the fast path of the per-visit loops: any other format goes through `parse_datetime`.
+    """
+    if timestamp_str[4:5] == '-':
+        dt = _parse_iso(timestamp_str)
+    else:
+        dt = parse_datetime(timestamp_str)
+    if dt.tzinfo is None and naive_tz is UTC:
+        return (dt.toordinal() - _EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+    return math.floor(to_epoch(dt, naive_tz))
+
+
+class TimestampParser:
+    """
+    Parses timestamps whose format is detected once per source (E.g. the "datetime_original" field of the stories) and
+    then reused for every string of that source; a string of another format falls back to sniffing it.
+
+    Parameters:
+        - `naive_tz` (tzinfo): time zone of the timestamps without an offset (UTC by default, LOCAL for the machine's)
+    """
+
+    def __init__(self, naive_tz=UTC):
+        self.naive_tz = naive_tz
+        self.formats = {}
+
+    def parse(self, timestamp_str, source=None):
+        """
+        Returns the datetime of `timestamp_str` (see `parse_datetime`), or None if it cannot be parsed
+        """
+        if not timestamp_str:
+            return None
+        fmt = self.formats.get(source)
+        if fmt is not None:
+            try:
+                return PARSERS[fmt](timestamp_str)
+            except ValueError:
+                pass
+        fmt = sniff_format(timestamp_str)
+        if fmt is None:
+            return None
+        try:
+            dt = PARSERS[fmt](timestamp_str)
+        except ValueError:
+            return None
+        self.formats[source] = fmt
+        return dt
+
+    def epoch(self, timestamp_str, source=None):
+        """
+        Returns the POSIX timestamp (float seconds) of `timestamp_str`, or None if it cannot be parsed
+        """
+        dt = self.parse(timestamp_str, source)
+        return None if dt is None else to_epoch(dt, self.naive_tz)
+
+
+def parse_epoch_array(timestamp_strs, unit="s", naive_tz=UTC):
+    """
+    Returns the epochs of a list of timestamp strings as an int64 NumPy array (MISSING_TIME for None or unparseable strings)
+
+    The format is sniffed from the first string and checked against every other one. ISO 8601 and EXIF strings are parsed
+    by NumPy's datetime64 in a single vectorized call; anything else (or a list mixing formats) falls back to parsing
+    each string.
+
+    Parameters:
+        - `timestamp_strs` (list): the timestamps
+        - `unit` (str): "s", "ms" or "us"
+        - `naive_tz` (tzinfo): time zone of the timestamps without an offset
+    """
+    divisor = UNITS[unit]
+    result = np.full(len(timestamp_strs), MISSING_TIME, dtype=np.int64)
+    present = [i for i, timestamp_str in enumerate(timestamp_strs) if timestamp_str]
+    if not present:
+        return result
+    raw_values = values = [timestamp_strs[i] for i in present]
+    fmt = sniff_format(values[0])
+    # NumPy would read a unix timestamp among ISO strings as a year instead of rejecting it
+    if any(sniff_format(timestamp_str) != fmt for timestamp_str in values):
+        fmt = None
+
+    parsed = None
+    if fmt == "unix":
+        try:
+            parsed = np.array(values, dtype=np.int64) * (10 ** 6 // divisor)
+        except (ValueError, OverflowError):
+            parsed = None
+    elif fmt in ("iso", "exif"):
+        if fmt == "exif":
+            values = [f"{s[0:4]}-{s[5:7]}-{s[8:10]}T{s[11:]}" for s in values]
+        # NumPy reads naive strings as UTC and converts offsets to UTC, but parses them much more slowly
+        utc = all(s.endswith('Z') for s in values)
+        if utc:
+            values = [s[:-1] for s in values]
+        if utc or naive_tz is UTC:
+            try:
+                with warnings.catch_warnings():
+                    # "no explicit representation of timezones available for np.datetime64"
+                    warnings.simplefilter("ignore")
+                    micros = np.array(values, dtype='datetime64[us]').astype(np.int64)
+                parsed = micros // divisor
+            except ValueError:
+                parsed = None
+
+    if parsed is None:
+        parsed = np.empty(len(values), dtype=np.int64)
+        for i, timestamp_str in enumerate(raw_values):
+            try:
+                dt = parse_datetime(timestamp_str)
+            except ValueError:
+                parsed[i] = MISSING_TIME
+                continue
+            if dt.tzinfo is None and naive_tz is not LOCAL:
+                dt = dt.replace(tzinfo=naive_tz)
+            if dt.tzinfo is None:
+                dt = dt.astimezone()
+            micros = (dt - datetime.datetime(1970, 1, 1, tzinfo=UTC)) // datetime.timedelta(microseconds=1)
+            parsed[i] = micros // divisor
+    result[np.array(present, dtype=np.int64)] = parsed
+    return result
+
+
+def _legacy_convert_to_timestamp(time_str):
+    # the strptime loop formerly used by common_utils.convert_to_timestamp
+    for date_format in ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ", "%Y:%m:%d %H:%M:%S", "%Y%m%dT%H%M%S.%fZ"]:
+        try:
+            return datetime.datetime.strptime(time_str, date_format).timestamp()
+        except ValueError:
+            continue
+
+
+def _legacy_epoch_seconds(timestamp_str):
+    # the fromisoformat(...rstrip('Z')) parsing formerly used for the place visits
+    dt = datetime.datetime.fromisoformat(timestamp_str.rstrip('Z'))
+    return (dt - datetime.datetime(1970, 1, 1)) // datetime.timedelta(seconds=1)
+
+
+def benchmark(n=100000):
+    """
+    Print the time per timestamp of the legacy parsing and of this module on `n` Google Takeout and EXIF timestamps
+    """
+    base = datetime.datetime(2020, 1, 1, tzinfo=UTC)
+    google = [(base + datetime.timedelta(seconds=97 * i)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z" for i in range(n)]
+    exif = [(base + datetime.timedelta(seconds=97 * i)).strftime("%Y:%m:%d %H:%M:%S") for i in range(n)]
+
+    def run(label, func):
+        start = time.perf_counter()
+        func()
+        print(f"{label:<45} {(time.perf_counter() - start) / n * 1e9:8.0f} ns/timestamp")
+
+    parser = TimestampParser()
+    run("Google, strptime loop (legacy)", lambda: [_legacy_convert_to_timestamp(s) for s in google])
+    run("Google, fromisoformat + rstrip (legacy)", lambda: [_legacy_epoch_seconds(s) for s in google])
+    run("Google, epoch_seconds", lambda: [epoch_seconds(s) for s in google])
+    run("Google, TimestampParser.epoch", lambda: [parser.epoch(s, "google") for s in google])
+    run("Google, parse_epoch_array", lambda: parse_epoch_array(google))
+    run("EXIF, strptime loop (legacy)", lambda: [_legacy_convert_to_timestamp(s) for s in exif])
+    run("EXIF, TimestampParser.epoch", lambda: [parser.epoch(s, "exif") for s in exif])
+    run("EXIF, parse_epoch_array", lambda: parse_epoch_array(exif))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the timestamp parsers")
+    parser.add_argument("-n", type=int, default=100000, help="number of timestamps of each format")
+    args = parser.parse_args()
+    benchmark(args.n)
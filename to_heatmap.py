@@ -1,10 +1,21 @@
 import sys
+import argparse
+from functools import partial
 import json
+import gzip
 from geojson import Point
 from tqdm import tqdm
 import os
 from from_instagram import *
 from common_utils import *
+from visit_table import VisitTable
+from aggregate_visits import aggregate, iter_cell_features, add_aggregate_arguments
+from tile_pyramid import build_tile_pyramid, add_tile_arguments
+from dedup_media import load_media_mapping
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
 
 
 def place_visit(visit, transportation=None):
@@ -46,63 +57,297 @@ def place_visit(visit, transportation=None):
     )
 
 
+def extract_place_visits(timeline_objects):
+    """
+    Returns the place visits of a month as (Point, properties) tuples. The transportation mode is taken from the activitySegment preceding each placeVisit.
+
+    Parameters:
+        - `timeline_objects` (iterable): the timelineObjects of a monthly file, either a list or a generator streaming them
+    """
+    places_visited = []
+    previous_object = None
+    first_visit = None
+    for timeline_object in timeline_objects:
+        if "placeVisit" in timeline_object:
+            if previous_object is None:
+                # like timeline_objects[-1], the first placeVisit looks at the last object of the month,
+                # which is only known once the whole month has been read
+                first_visit = timeline_object["placeVisit"]
+                places_visited.append(None)
+            else:
+                places_visited.append(place_visit_after(previous_object, timeline_object["placeVisit"]))
+        previous_object = timeline_object
+    if first_visit is not None:
+        places_visited[0] = place_visit_after(previous_object, first_visit)
+    return places_visited
+
+
+def place_visit_after(previous_object, visit):
+    """
+    Returns the placeVisit as a (Point, properties) tuple, using the activityType of `previous_object` as the transportation mode
+    """
+    if "activitySegment" in previous_object and "activityType" in previous_object["activitySegment"]:
+        return place_visit(visit, previous_object["activitySegment"]["activityType"])
+    return place_visit(visit)
+
+
+def month_place_visits(month_file, stream=False):
+    """
+    Returns the place visits of a monthly file as a VisitTable
+
+    Parameters:
+        - `month_file` (tuple): a (subfolder, filename, file_path) tuple as returned by `find_month_files`
+    """
+    subfolder, filename, file_path = month_file
+    with metrics.stage("extract_visits") as stage:
+        try:
+            table = VisitTable.from_timeline_objects(iter_timeline_objects(file_path, stream=stream), with_transportation=False,
+                                                     month=month_code(filename))
+        except json.JSONDecodeError:
+            print(f"Error parsing JSON in file: {file_path}")
+            table = VisitTable()
+        stage["items"] = len(table)
+    return table
+
+
 def features_and_properties(timeline_objects):
     lst = []
     for idx, timeline_object in enumerate(timeline_objects):
         if "placeVisit" in timeline_object:
-            print(idx)
+            logger.debug("placeVisit at index %d", idx)
             lst.append(place_visit(timeline_object["placeVisit"]))
         else:
             lst.append((None, None))
     return lst
 
 
+def iter_features(fs_and_ps):
+    """
+    Yields the place visits as GeoJSON Feature dicts
+
+    Parameters:
+        - `fs_and_ps`: a VisitTable, or an iterable of (Point, properties) tuples
+    """
+    if isinstance(fs_and_ps, VisitTable):
+        yield from fs_and_ps.iter_features()
+        return
+    for feature, properties in fs_and_ps:
+        if feature:
+            yield {"type": "Feature", "properties": properties, "geometry": feature}
+
+
 def make_geojson(fs_and_ps):
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {"type": "Feature", "properties": properties, "geometry": feature}
-            for feature, properties in fs_and_ps
-            if feature
-        ],
-    }
+    """
+    Returns a FeatureCollection of the place visits
+
+    Parameters:
+        - `fs_and_ps`: a VisitTable, or a list of (Point, properties) tuples
+    """
+    return {"type": "FeatureCollection", "features": list(iter_features(fs_and_ps))}
+
+
+class GeoJSONWriter:
+    """
+    Writes a FeatureCollection to a file one feature at a time, so the collection never has to be held in memory
+
+    Parameters:
+        - `output_path` (str): path to the output file
+        - `compact` (bool): write without whitespace; otherwise indent like `json.dump(..., indent=2)`
+        - `precision` (int): number of decimals the coordinates are rounded to (in the geometry and the longitude/latitude properties)
+        - `gzip_output` (bool): gzip the file
+    """
+
+    def __init__(self, output_path, compact=False, precision=None, gzip_output=False):
+        self.output_path = output_path
+        self.compact = compact
+        self.precision = precision
+        self.count = 0
+        if gzip_output:
+            self.file = gzip.open(output_path, "wt", encoding="utf-8")
+        else:
+            self.file = open(output_path, "w", encoding="utf-8")
+        if compact:
+            self.file.write('{"type":"FeatureCollection","features":[')
+        else:
+            self.file.write('{\n  "type": "FeatureCollection",\n  "features": [')
+
+    def write(self, feature):
+        if self.precision is not None:
+            feature = round_feature(feature, self.precision)
+        if self.compact:
+            if self.count:
+                self.file.write(',')
+            self.file.write(json.dumps(feature, separators=(',', ':')))
+        else:
+            self.file.write(',\n    ' if self.count else '\n    ')
+            self.file.write(json.dumps(feature, indent=2).replace('\n', '\n    '))
+        self.count += 1
+
+    def close(self):
+        if self.compact:
+            self.file.write(']}')
+        else:
+            self.file.write('\n  ]\n}' if self.count else ']\n}')
+        self.file.close()
+
+    def abort(self):
+        """
+        Close the file and delete it, so that a failed export does not leave a well-formed but truncated collection
+        """
+        self.file.close()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def round_feature(feature, precision):
+    """
+    Returns a copy of a Point feature with its coordinates rounded to `precision` decimals
+    """
+    properties = feature.get("properties") or {}
+    if "longitude" in properties or "latitude" in properties:
+        properties = dict(properties)
+        for key in ("longitude", "latitude"):
+            if isinstance(properties.get(key), float):
+                properties[key] = round(properties[key], precision)
+    geometry = feature.get("geometry")
+    if geometry and geometry.get("type") == "Point":
+        geometry = {"type": "Point", "coordinates": [round(coordinate, precision) for coordinate in geometry["coordinates"]]}
+    return dict(feature, properties=properties, geometry=geometry)
+
+
+def write_geojson(fs_and_ps, output_path, compact=False, precision=None, gzip_output=False):
+    """
+    Stream the place visits to `output_path` as a FeatureCollection (see GeoJSONWriter)
+
+    Returns: the number of features written
+    """
+    with metrics.stage("write_geojson") as stage, GeoJSONWriter(output_path, compact, precision, gzip_output) as writer:
+        for feature in iter_features(fs_and_ps):
+            writer.write(feature)
+        stage["items"] = writer.count
+    return writer.count
+
+
+def write_aggregated_geojson(table, output_path, mode="grid", cell_size=250, dwell_weights=False, compact=False, gzip_output=False):
+    """
+    Bin the visits of a VisitTable into grid cells or hexagons and write one feature per occupied cell
+
+    Returns: the number of cells written
+    """
+    with metrics.stage("aggregate", len(table)):
+        cells = aggregate(table, mode, cell_size, dwell_weights)
+        with GeoJSONWriter(output_path, compact, gzip_output=gzip_output) as writer:
+            for feature in iter_cell_features(cells, mode, cell_size):
+                writer.write(feature)
+    print(f"Aggregated {len(table)} visits into {writer.count} {mode} cells saved at {output_path}")
+    return writer.count
+
+
+def add_geojson_arguments(parser):
+    """
+    Add the options of the GeoJSON output to an argument parser
+    """
+    parser.add_argument("--compact", action="store_true",
+                        help="write the GeoJSON without indentation or whitespace")
+    parser.add_argument("--precision", type=int, default=None,
+                        help="number of decimals the coordinates are rounded to")
+    parser.add_argument("--gzip", action="store_true",
+                        help="gzip the GeoJSON output (a .gz suffix is added to the file name)")
+
+
+def geojson_output_path(output_dir, gzip_output=False, suffix=""):
+    """
+    Returns the path of the GeoJSON file of a participant: <output_dir>/<name of output_dir><suffix>.json(.gz)
+    """
+    output_file = os.path.join(output_dir, output_dir.split("/")[-1]) + suffix + ".json"
+    return output_file + ".gz" if gzip_output else output_file
+
+
+OUTPUT_FORMATS = ("geojson", "visits", "both")
+
+
+def visits_output_path(output_dir):
+    """
+    Returns the path of the visits store of a participant: <output_dir>/<name of output_dir>_visits.npz
+    """
+    return os.path.join(output_dir, output_dir.split("/")[-1]) + "_visits.npz"
+
+
+def iter_output_features(path):
+    """
+    Yields the features of a GeoJSON output or of a visits store (.npz), converting the store to GeoJSON on the fly
+    """
+    if path.endswith(".npz"):
+        yield from VisitTable.load(path).iter_features()
+    else:
+        yield from iter_json_array_items(path, "features")
 
 
 if __name__ == "__main__":
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
-    tmp = sys.argv[3] if len(sys.argv) >= 4 else None
+    parser = argparse.ArgumentParser(description="Export the place visits of a Semantic-Location-History folder as GeoJSON")
+    parser.add_argument("input_dir", help="path to the Semantic-Location-History folder, or to a visits store (.npz) written by main.py")
+    parser.add_argument("output_dir", help="path to the output folder")
+    parser.add_argument("stories_file", nargs="?", default=None, help="path to the stories.json file")
+    parser.add_argument("--stream-json", action="store_true",
+                        help="parse the monthly files incrementally instead of loading each one whole")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes the monthly files are spread over")
+    parser.add_argument("--media-mapping", default=None,
+                        help="media_mapping.json written by dedup_media.py, so that duplicate story images share one url")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="geojson",
+                        help="write the visits as GeoJSON, as a binary <name>_visits.npz store, or both")
+    add_geojson_arguments(parser)
+    add_aggregate_arguments(parser)
+    add_tile_arguments(parser)
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented_run(args, "to_heatmap"):
+        input_dir = args.input_dir
+        output_dir = args.output_dir
+        tmp = args.stories_file
 
-    os.makedirs(output_dir, exist_ok=True)
-    subfolders = [f for f in os.listdir(
-        input_dir) if os.path.isdir(os.path.join(input_dir, f))]
+        os.makedirs(output_dir, exist_ok=True)
 
-    places_visited = []
+        places_visited = VisitTable()
+
+        if input_dir.endswith(".npz"):
+            # a visits store already holds the anonymized visits and story points, it is only exported
+            with metrics.stage("load_visits") as stage:
+                places_visited = VisitTable.load(input_dir)
+                stage["items"] = len(places_visited)
+        elif tmp is not None:
+            path_to_stories_data = tmp
+            stories_info = extract_stories_with_exif_data(path_to_stories_data)
+            media_mapping = load_media_mapping(args.media_mapping) if args.media_mapping is not None else None
+            points = create_story_point(stories_info, tmp, input_dir, media_mapping=media_mapping)
+            for point, properties in points:
+                places_visited.append_story_point(point, properties)
+
+        if not input_dir.endswith(".npz"):
+            month_results = parallel_map(partial(month_place_visits, stream=args.stream_json),
+                                         find_month_files(input_dir), args.workers)
+            for month_places_visited in month_results:
+                places_visited.extend(month_places_visited)
 
-    if tmp is not None:
-        path_to_stories_data = tmp
-        stories_info = extract_stories_with_exif_data(path_to_stories_data)
-        points = create_story_point(stories_info, tmp)
-        for point in points:
-            places_visited.append(point)
-
-    for subfolder in subfolders:
-        subfolder_path = os.path.join(input_dir, subfolder)
-        print(f"Processing subfolder: {subfolder_path}")
-        for filename in os.listdir(subfolder_path):
-            if filename.endswith('.json'):
-                file_path = os.path.join(subfolder_path, filename)
-                with open(file_path, 'r', encoding='utf-8') as json_file:
-                    try:
-                        maps_json = json.load(json_file)
-                    except json.JSONDecodeError:
-                        print(f"Error parsing JSON in file: {file_path}")
-
-                for timeline_object in maps_json["timelineObjects"]:
-                    if "placeVisit" in timeline_object:
-                        places_visited.append(place_visit(
-                            timeline_object["placeVisit"]))
-
-    output_geojson = make_geojson(places_visited)
-    output_file = os.path.join(output_dir, output_dir.split("/")[-1]) + ".json"
-    json.dump(output_geojson, open(output_file, "w"), indent=2)
+        if args.output_format in ("visits", "both"):
+            places_visited.save(visits_output_path(output_dir))
+            print(f"Visits store saved at {visits_output_path(output_dir)}")
+        if args.output_format in ("geojson", "both"):
+            write_geojson(places_visited, geojson_output_path(output_dir, args.gzip), args.compact, args.precision, args.gzip)
+        if args.aggregate:
+            write_aggregated_geojson(places_visited, geojson_output_path(output_dir, args.gzip, "_" + args.aggregate),
+                                     args.aggregate, args.cell_size, args.dwell_weights, args.compact, args.gzip)
+        if args.tiles:
+            tiles_dir = os.path.join(output_dir, "tiles")
+            with metrics.stage("tiles", len(places_visited)):
+                build_tile_pyramid(places_visited, tiles_dir, args.min_zoom, args.max_zoom, args.raw_zoom)
+            print(f"Tile pyramid (zoom {args.min_zoom}-{args.max_zoom}) saved at {tiles_dir}")
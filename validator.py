@@ -1,4 +1,6 @@
 import json
+import argparse
+from functools import lru_cache
 import plotly.express as px
 from dash import Dash, dcc, html, dash_table, callback, Output, Input
 from data_validator import *
@@ -6,12 +8,28 @@ from location_anonymizer import *
 from pprint import pprint
 
 if __name__ == "__main__":
-    input_dir = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Dashboard of the statistics of a participant's location history")
+    parser.add_argument("input_dir", help="path to the Semantic-Location-History folder, to a history store folder "
+                             "(see history_store.py), or to a visits store (.npz) written by main.py")
+    parser.add_argument("output_dir", nargs="?", default=None, help="path to the output folder of the participant")
+    parser.add_argument("--production", action="store_true",
+                        help="serve without debug mode and its reloader, which loads the data twice")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    args = parser.parse_args()
+    input_dir = args.input_dir
     participant = os.path.dirname(os.path.dirname(input_dir))
     print(participant)
 
-    data_validator = DataValidator(input_dir)
-    data_validator.load_history()
+    output_dir = args.output_dir
+
+    data_validator = DataValidator(input_dir, output_dir)
+    if input_dir.endswith(".npz"):
+        data_validator.load_store(input_dir)
+    elif HistoryStore.is_store(input_dir):
+        data_validator.load_history_store(input_dir)
+    else:
+        data_validator.load_history()
 
     # stats = load_basic_stats(input_file)
     stats = data_validator.stats
@@ -29,12 +47,45 @@ if __name__ == "__main__":
     app = Dash(__name__)
 
 
-    unique_years = sorted({month.split('_')[0]
-                           for month in num_of_unique_places_visited_by_month})
+    # group the months by year once so that the callbacks do not rescan every month
+    months_by_year = {}
+    for month in num_of_unique_places_visited_by_month:
+        months_by_year.setdefault(month.split('_')[0], []).append(month)
+    unique_years = sorted(months_by_year)
     dropdown_options = [{'label': year, 'value': year}
                         for year in unique_years]
     dropdown_options.append({'label': 'All Years', 'value': 'All'})
 
+    def months_of(selected_year):
+        if selected_year and selected_year != 'All':
+            return months_by_year.get(selected_year, [])
+        return list(num_of_unique_places_visited_by_month)
+
+    # figures are built once per year and reused when switching back and forth in the dropdowns
+    @lru_cache(maxsize=256)
+    def histogram_figure(selected_year):
+        data = [num_of_unique_places_visited_by_month[month] for month in months_of(selected_year)]
+        return px.histogram(
+            x=data,
+            nbins=20,
+            labels={'x': 'Number of Unique Places Visited', 'y': 'Frequency'},
+            title='Histogram of Unique Places Visited'
+        )
+
+    @lru_cache(maxsize=256)
+    def line_chart_figure(selected_year):
+        months = months_of(selected_year)
+        if selected_year and selected_year != 'All':
+            title = f'Line Chart of Number of Unique Places Visited per Month in {selected_year}'
+        else:
+            title = 'Line Chart of Number of Unique Places Visited per Month'
+        return px.line(
+            x=months,
+            y=[num_of_unique_places_visited_by_month[month] for month in months],
+            labels={'x': 'Month', 'y': 'Number of Unique Places Visited'},
+            title=title
+        )
+
     fig1 = px.histogram(
         x=num_of_unique_places_visited_by_month.values(),
         nbins=20,
@@ -42,12 +93,7 @@ if __name__ == "__main__":
         title='Distribution of Monthly Unique Places Visited'
     )
 
-    fig_line_chart = px.line(
-        x=list(num_of_unique_places_visited_by_month.keys()),
-        y=list(num_of_unique_places_visited_by_month.values()),
-        labels={'x': 'Month', 'y': 'Number of Unique Places Visited'},
-        title='Line Chart of Number of Unique Places Visited per Month'
-    )
+    fig_line_chart = line_chart_figure(None)
 
     basic_stats_section = html.Div(
         children=[html.H1(children="File Statistics"),
@@ -118,42 +164,13 @@ if __name__ == "__main__":
         [Input('year-dropdown', 'value')]
     )
     def update_histogram(selected_year):
-        if selected_year and selected_year != 'All':
-            data = [num_of_unique_places_visited_by_month[month]
-                    for month in num_of_unique_places_visited_by_month if month.startswith(selected_year)]
-        else:
-            data = list(num_of_unique_places_visited_by_month.values())
-        fig = px.histogram(
-            x=data,
-            nbins=20,
-            labels={'x': 'Number of Unique Places Visited', 'y': 'Frequency'},
-            title='Histogram of Unique Places Visited'
-        )
-        return fig
+        return histogram_figure(selected_year)
 
     @app.callback(
         Output('line-chart', 'figure'),
         [Input('year-dropdown-line-chart', 'value')]
     )
     def update_line_chart(selected_year):
-        if selected_year and selected_year != 'All':
-            months_in_year = [
-                month for month in num_of_unique_places_visited_by_month if month.startswith(selected_year)]
-            data = [num_of_unique_places_visited_by_month[month]
-                    for month in months_in_year]
-            fig = px.line(
-                x=months_in_year,
-                y=data,
-                labels={'x': 'Month', 'y': 'Number of Unique Places Visited'},
-                title=f'Line Chart of Number of Unique Places Visited per Month in {selected_year}'
-            )
-        else:
-            fig = px.line(
-                x=list(num_of_unique_places_visited_by_month.keys()),
-                y=list(num_of_unique_places_visited_by_month.values()),
-                labels={'x': 'Month', 'y': 'Number of Unique Places Visited'},
-                title='Line Chart of Number of Unique Places Visited per Month'
-            )
-        return fig
-
-    app.run(debug=True)
+        return line_chart_figure(selected_year)
+
+    app.run(debug=not args.production, host=args.host, port=args.port)
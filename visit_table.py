@@ -0,0 +1,273 @@
+import json
+from array import array
+import numpy as np
+from timestamps import MISSING_TIME, epoch_seconds
+
+GOOGLE = 0
+INSTAGRAM = 1
+
+MISSING = -1
+
+
+def _visit_time(duration, key):
+    # a missing or malformed timestamp leaves the visit without a time instead of aborting the export
+    if key not in duration:
+        return MISSING_TIME
+    try:
+        return epoch_seconds(duration[key])
+    except (ValueError, TypeError, OverflowError):
+        return MISSING_TIME
+
+
+class VisitTable:
+    """
+    Columnar container of place visits: int32 E7 coordinates, int64 start/end epochs, codes into an interned
+    string table for the name/address/transportation mode/placeId, the month of the file each visit comes from
+    (E.g. 202001, 0 for story points) and the source of each visit (Google or Instagram story).
+
+    Columns are filled into compact `array.array` buffers and exposed as NumPy arrays without copying.
+    Instagram story points keep their original geometry and properties in `extras` so they are exported unchanged.
+    Saved with `save`, a table is the binary store read by filter_locations.py, to_heatmap.py and the validator.
+    """
+
+    # version of the .npz layout written by `save`
+    FORMAT_VERSION = 2
+    INT_COLUMNS = {"lat_e7": "i", "lon_e7": "i", "name": "i", "address": "i", "transportation": "i", "place_id": "i",
+                   "month": "i"}
+    TIME_COLUMNS = {"start": "q", "end": "q"}
+    STRING_COLUMNS = ("name", "address", "transportation", "place_id")
+    PLACE_VISIT_PROPERTIES = {"name", "address", "longitude", "latitude", "transportation"}
+
+    def __init__(self):
+        self.buffers = {column: array(typecode) for column, typecode in {**self.INT_COLUMNS, **self.TIME_COLUMNS}.items()}
+        self.buffers["source"] = array("b")
+        self.strings = []
+        self.string_codes = {}
+        self.extras = {}
+
+    def __len__(self):
+        return len(self.buffers["source"])
+
+    def __getitem__(self, column):
+        """
+        Returns a column as a NumPy array sharing the memory of the table
+        """
+        return np.frombuffer(self.buffers[column], dtype=self.buffers[column].typecode)
+
+    def intern(self, string):
+        """
+        Returns the code of `string` in the string table (MISSING for None)
+        """
+        if string is None:
+            return MISSING
+        code = self.string_codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(string)
+            self.string_codes[string] = code
+        return code
+
+    def string(self, code):
+        return None if code == MISSING else self.strings[code]
+
+    def _append(self, lat_e7, lon_e7, start, end, name, address, transportation, source, place_id=MISSING, month=0):
+        buffers = self.buffers
+        buffers["lat_e7"].append(lat_e7)
+        buffers["lon_e7"].append(lon_e7)
+        buffers["start"].append(start)
+        buffers["end"].append(end)
+        buffers["name"].append(name)
+        buffers["address"].append(address)
+        buffers["transportation"].append(transportation)
+        buffers["source"].append(source)
+        buffers["place_id"].append(place_id)
+        buffers["month"].append(month)
+
+    def append_place_visit(self, visit, transportation=None, month=0):
+        """
+        Add a placeVisit of Google Maps Takeout data
+
+        Parameters:
+            - `visit` (dict): the placeVisit
+            - `transportation` (str): the activityType of the activitySegment leading to the visit
+            - `month` (int): the month of the file of the visit, see `common_utils.month_code`
+        """
+        location = visit["location"]
+        duration = visit.get("duration", {})
+        start = _visit_time(duration, "startTimestamp")
+        end = _visit_time(duration, "endTimestamp")
+        self._append(location["latitudeE7"], location["longitudeE7"], start, end,
+                     self.intern(location.get("name")), self.intern(location.get("address")),
+                     self.intern(transportation), GOOGLE, self.intern(location.get("placeId")), month)
+
+    def append_story_point(self, point, properties):
+        """
+        Add an Instagram story point as returned by `create_story_point`
+        """
+        longitude, latitude = point["coordinates"]
+        timestamp = properties.get("timestamp")
+        time = int(timestamp) if timestamp is not None else MISSING_TIME
+        self.extras[len(self)] = (point, properties)
+        self._append(round(latitude * 10 ** 7), round(longitude * 10 ** 7), time, time,
+                     MISSING, MISSING, MISSING, INSTAGRAM)
+
+    def append_feature(self, feature):
+        """
+        Add a Point feature read back from a GeoJSON output. Place visits (only name/address/longitude/latitude/transportation
+        properties) are stored in the columns, any other feature is kept unchanged like a story point.
+        """
+        properties = feature.get("properties") or {}
+        longitude, latitude = feature["geometry"]["coordinates"][:2]
+        if set(properties) <= self.PLACE_VISIT_PROPERTIES and "longitude" in properties and "latitude" in properties:
+            self._append(round(properties["latitude"] * 10 ** 7), round(properties["longitude"] * 10 ** 7),
+                         MISSING_TIME, MISSING_TIME,
+                         self.intern(properties.get("name")), self.intern(properties.get("address")),
+                         self.intern(properties.get("transportation")), GOOGLE)
+        else:
+            self.extras[len(self)] = (feature["geometry"], properties)
+            self._append(round(latitude * 10 ** 7), round(longitude * 10 ** 7), MISSING_TIME, MISSING_TIME,
+                         MISSING, MISSING, MISSING, INSTAGRAM)
+
+    def extend(self, other):
+        """
+        Append the rows of another table, re-coding its strings into this table's string table
+        """
+        offset = len(self)
+        recode = np.array([self.intern(string) for string in other.strings] + [MISSING], dtype=np.int32)
+        for column, buffer in other.buffers.items():
+            if column in self.STRING_COLUMNS:
+                # MISSING (-1) indexes the trailing MISSING entry of `recode`
+                self.buffers[column].frombytes(recode[other[column]].tobytes())
+            else:
+                self.buffers[column].extend(buffer)
+        for row, extra in other.extras.items():
+            self.extras[offset + row] = extra
+
+    @classmethod
+    def from_timeline_objects(cls, timeline_objects, with_transportation=True, month=0):
+        """
+        Build a table from the placeVisits of a month. The transportation mode is taken from the activitySegment
+        preceding each placeVisit (the first placeVisit looks at the last object, like `extract_place_visits`).
+
+        Parameters:
+            - `timeline_objects` (iterable): the timelineObjects of a monthly file, either a list or a generator streaming them
+            - `with_transportation` (bool): whether to record the transportation mode
+            - `month` (int): the month of the file, see `common_utils.month_code`
+        """
+        table = cls()
+        previous_object = None
+        first_visit = None
+        for timeline_object in timeline_objects:
+            if "placeVisit" in timeline_object:
+                if not with_transportation:
+                    table.append_place_visit(timeline_object["placeVisit"], month=month)
+                elif previous_object is None:
+                    first_visit = timeline_object["placeVisit"]
+                else:
+                    table.append_place_visit(timeline_object["placeVisit"], cls._transportation(previous_object), month)
+            previous_object = timeline_object
+        if first_visit is not None:
+            first = cls()
+            first.append_place_visit(first_visit, cls._transportation(previous_object), month)
+            first.extend(table)
+            table = first
+        return table
+
+    @staticmethod
+    def _transportation(previous_object):
+        if "activitySegment" in previous_object and "activityType" in previous_object["activitySegment"]:
+            return previous_object["activitySegment"]["activityType"]
+        return None
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Returns a new table holding the rows of every table in order
+        """
+        result = cls()
+        for table in tables:
+            result.extend(table)
+        return result
+
+    def longitudes(self):
+        return self["lon_e7"] / 10e6
+
+    def latitudes(self):
+        return self["lat_e7"] / 10e6
+
+    def iter_features(self, rows=None):
+        """
+        Yields the rows as GeoJSON Feature dicts, with the same properties as `place_visit` / `create_story_point`
+
+        Parameters:
+            - `rows` (iterable): indices of the rows to export; every row when None
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        longitudes = self.longitudes()[rows].tolist()
+        latitudes = self.latitudes()[rows].tolist()
+        names = self["name"][rows].tolist()
+        addresses = self["address"][rows].tolist()
+        transportations = self["transportation"][rows].tolist()
+        sources = self["source"][rows].tolist()
+        strings = self.strings
+        for i, row in enumerate(rows.tolist()):
+            if sources[i] == INSTAGRAM:
+                point, properties = self.extras[row]
+                yield {"type": "Feature", "properties": properties, "geometry": point}
+                continue
+            properties = {}
+            if names[i] != MISSING:
+                properties["name"] = strings[names[i]]
+            if addresses[i] != MISSING:
+                properties["address"] = strings[addresses[i]]
+            properties["longitude"] = longitudes[i]
+            properties["latitude"] = latitudes[i]
+            if transportations[i] != MISSING:
+                properties["transportation"] = strings[transportations[i]]
+            yield {
+                "type": "Feature",
+                "properties": properties,
+                # geojson.Point rounds its coordinates to 6 decimals
+                "geometry": {"type": "Point", "coordinates": [round(longitudes[i], 6), round(latitudes[i], 6)]},
+            }
+
+    def save(self, path):
+        """
+        Save the table to a .npz file: one array per column, plus the string table and the story points as JSON
+        """
+        arrays = {column: self[column] for column in self.buffers}
+        arrays["format_version"] = np.array([self.FORMAT_VERSION], dtype=np.int32)
+        arrays["strings"] = np.frombuffer(json.dumps(self.strings).encode("utf-8"), dtype=np.uint8)
+        extras = [[row, point, properties] for row, (point, properties) in self.extras.items()]
+        arrays["extras"] = np.frombuffer(json.dumps(extras).encode("utf-8"), dtype=np.uint8)
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a table saved with `save`. The placeId and month of the tables saved before they were recorded are MISSING and 0.
+        """
+        table = cls()
+        with np.load(path) as arrays:
+            version = int(arrays["format_version"][0]) if "format_version" in arrays else 1
+            if version > cls.FORMAT_VERSION:
+                raise ValueError(f"{path} was saved by a newer version (format {version})")
+            num_rows = len(arrays["source"])
+            for column, buffer in table.buffers.items():
+                if column in arrays:
+                    buffer.frombytes(arrays[column].astype(buffer.typecode, copy=False).tobytes())
+                else:
+                    buffer.frombytes(np.full(num_rows, MISSING if column in cls.STRING_COLUMNS else 0,
+                                             dtype=buffer.typecode).tobytes())
+            table.strings = json.loads(arrays["strings"].tobytes().decode("utf-8"))
+            extras = json.loads(arrays["extras"].tobytes().decode("utf-8"))
+        table.string_codes = {string: code for code, string in enumerate(table.strings)}
+        table.extras = {row: (point, properties) for row, point, properties in extras}
+        return table
+
+    def nbytes(self):
+        """
+        Returns the number of bytes used by the columns
+        """
+        return sum(buffer.itemsize * len(buffer) for buffer in self.buffers.values())